@@ -0,0 +1,144 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Fast acknowledgements. make_ack() builds the ACK for an inbound message straight from its
+raw MSH segment, without parsing the message or building any Segment/Node objects.
+"""
+import time
+from HL7py.constants import CR, LF, SECOND_TIME_FORMAT
+
+ACK_CODES = ('AA', 'AE', 'AR', 'CA', 'CE', 'CR')
+
+#MSH positions (as numbered in hl7fields.py, where 0 is the segment code).
+_ENCODING_CHARS = 1
+_SEND_APP = 2
+_SEND_FAC = 3
+_RECV_APP = 4
+_RECV_FAC = 5
+_MSG_TYPE = 8
+_MSG_CTL_ID = 9
+_PROC_ID = 10
+_VERSION = 11
+
+_templates = {}
+_timestamp = [None, '']
+
+
+def _template(sep, encoding_chars):
+    """
+    ACK template for a given field separator and encoding characters, built once.
+    """
+    key = (sep, encoding_chars)
+    template = _templates.get(key)
+    if template is None:
+        msh = ['MSH', encoding_chars.replace('%', '%%')] + ['%s'] * 4 + ['%s', '', 'ACK%s', '%s',
+                                                                        '%s', '%s']
+        msa = ['MSA', '%s', '%s']
+        template = _templates[key] = sep.join(msh) + CR + sep.join(msa) + '%s'
+    return template
+
+
+def _now():
+    #strftime is the slowest part of an ACK; it only changes once per second.
+    now = int(time.time())
+    if _timestamp[0] != now:
+        _timestamp[0] = now
+        _timestamp[1] = time.strftime(SECOND_TIME_FORMAT, time.localtime(now))
+    return _timestamp[1]
+
+
+def escape(text, sep, encoding_chars):
+    """
+    Escape delimiter characters in free text using the HL7 escape sequences.
+    """
+    if len(encoding_chars) < 4:
+        return text
+    comp, reptn, esc, subcomp = encoding_chars[:4]
+    text = text.replace(esc, esc + 'E' + esc)
+    for char, name in ((sep, 'F'), (comp, 'S'), (subcomp, 'T'), (reptn, 'R')):
+        text = text.replace(char, esc + name + esc)
+    return text.replace(CR, ' ').replace(LF, ' ')
+
+
+def make_ack(raw, code='AA', text=None, control_id=None, timestamp=None):
+    """
+    Return the ACK message for the inbound message `raw` (text or bytes, MLLP framing
+    allowed). The reply swaps the sending and receiving application/facility, echoes
+    the delimiters, processing ID and version, and acknowledges MSH-10 in MSA-2.
+
+    code is the acknowledgment code (AA, AE, AR, CA, CE or CR). text goes to MSA-3.
+    control_id (MSH-10 of the ACK) defaults to the inbound control ID and timestamp
+    (MSH-7, a string) to the current local time. The result has the same type as raw.
+    """
+    if code not in ACK_CODES:
+        raise ValueError("Unknown acknowledgment code '%s'." % (code,))
+
+    is_bytes = isinstance(raw, bytes) and not isinstance(raw, str)
+    if is_bytes:
+        #Only the header line is decoded.
+        start = raw.find(b'MSH')
+        if start < 0:
+            raise ValueError("No MSH segment found in message.")
+        header = raw[start:start + _header_length(raw, start, b'\r', b'\n')]
+        header = header.decode('latin-1')
+    else:
+        start = raw.find('MSH')
+        if start < 0:
+            raise ValueError("No MSH segment found in message.")
+        header = raw[start:start + _header_length(raw, start, CR, LF)]
+
+    if len(header) < 8:
+        raise ValueError("MSH segment is too short.")
+    sep = header[3]
+    fields = header.split(sep, _VERSION + 1)
+    fields += [''] * (_VERSION + 1 - len(fields))
+    encoding_chars = fields[_ENCODING_CHARS]
+    msg_type = fields[_MSG_TYPE].split(encoding_chars[:1] or '^')
+    event = encoding_chars[:1] + msg_type[1] if len(msg_type) > 1 and msg_type[1] else ''
+    ctl_id = fields[_MSG_CTL_ID]
+
+    if text:
+        text = sep + escape(text, sep, encoding_chars)
+    else:
+        text = ''
+    ack = _template(sep, encoding_chars) % (
+        fields[_RECV_APP], fields[_RECV_FAC], fields[_SEND_APP], fields[_SEND_FAC],
+        timestamp or _now(), event,
+        ctl_id if control_id is None else control_id,
+        fields[_PROC_ID], fields[_VERSION],
+        code, ctl_id, text)
+    if is_bytes:
+        return ack.encode('latin-1')
+    return ack
+
+
+def _header_length(raw, start, cr, lf):
+    end = raw.find(cr, start)
+    lf_end = raw.find(lf, start)
+    if end < 0 or 0 <= lf_end < end:
+        end = lf_end
+    if end < 0:
+        end = len(raw)
+    return end - start
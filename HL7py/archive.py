@@ -0,0 +1,304 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Find messages in large HL7 archive files without parsing them all.
+
+    python -m HL7py.archive index /archive/2016/*.hl7
+    python -m HL7py.archive find --ctl-id 0417 /archive/2016/*.hl7
+
+Each archive file is scanned once, through mmap, for MSH boundaries, and a sidecar index
+(the file name plus INDEX_SUFFIX) records the offset and length of every message with
+its control ID (MSH-10), timestamp (MSH-7), type (MSH-9) and patient IDs (PID-3). A
+lookup then reads and parses just that byte range:
+
+    archive = Archive(paths)
+    for entry in archive.find(mrn='123456789'):
+        message = archive.parse(entry)
+
+Archives are expected to grow only at the end. When a file has been appended to, only
+the new part (and the message that was last before) is scanned and the new entries are
+appended to the sidecar; if it has shrunk, it is indexed again from the start.
+"""
+import argparse
+import collections
+import io
+import mmap
+import os
+import re
+import sys
+from HL7py.batch import string_types
+from HL7py.parser import parse
+
+INDEX_SUFFIX = '.hl7idx'
+_INDEX_VERSION = '1'
+
+#Positions of the indexed fields, numbered as in hl7fields.py (MSH-1 is the separator).
+MSH_TIMESTAMP = 6
+MSH_MSG_TYPE = 8
+MSH_CTL_ID = 9
+PID_PATIENT_ID = 3
+
+#Text of the indexed values is decoded with latin-1 so any byte round-trips.
+_VALUE_ENCODING = 'latin-1'
+
+#A message starts at MSH at the beginning of a line (or of an MLLP frame), and ends at
+#the next one or at a batch envelope segment.
+_re_msh = re.compile(b'(?:^|(?<=[\r\n\x0b\x1c]))MSH')
+_re_envelope = re.compile(b'[\r\n](?:FHS|BHS|BTS|FTS)')
+_re_pid = re.compile(b'[\r\n]PID')
+_re_eol = re.compile(b'[\r\n]')
+_TRAILING = b'\r\n\x0b\x1c \t'
+
+
+IndexEntry = collections.namedtuple('IndexEntry', ['path', 'offset', 'length', 'msg_ctl_id',
+                                                   'timestamp', 'msg_type', 'patient_ids'])
+
+
+def scan_messages(buf, start=0):
+    """
+    Yield (offset, length) of every message in `buf` (bytes or an mmap) from `start`.
+    """
+    end = len(buf)
+    starts = [m.start() for m in _re_msh.finditer(buf, start)]
+    for i, offset in enumerate(starts):
+        stop = starts[i + 1] if i + 1 < len(starts) else end
+        envelope = _re_envelope.search(buf, offset, stop)
+        if envelope is not None:
+            stop = envelope.start()
+        yield offset, len(buf[offset:stop].rstrip(_TRAILING))
+
+
+def message_keys(raw):
+    """
+    (msg_ctl_id, timestamp, msg_type, patient_ids) of a raw message in bytes, as text.
+    patient_ids holds the ID number of every repetition of PID-3.
+    """
+    eol = _re_eol.search(raw)
+    msh = raw[:eol.start()] if eol else raw
+    delims = msh[3:4], msh[4:5], msh[5:6]
+    fields = msh.split(delims[0])
+
+    def component(i, count):
+        if len(fields) <= i:
+            return u''
+        return delims[1].join(fields[i].split(delims[1])[:count]).decode(_VALUE_ENCODING)
+
+    patient_ids = ()
+    pid = _re_pid.search(raw)
+    if pid is not None:
+        line = raw[pid.start() + 1:]
+        eol = _re_eol.search(line)
+        pid_fields = (line[:eol.start()] if eol else line).split(delims[0])
+        if len(pid_fields) > PID_PATIENT_ID:
+            patient_ids = [rep.split(delims[1])[0].decode(_VALUE_ENCODING)
+                           for rep in pid_fields[PID_PATIENT_ID].split(delims[2])]
+            patient_ids = tuple(value for value in patient_ids if value)
+    return (component(MSH_CTL_ID, None), component(MSH_TIMESTAMP, 1),
+            component(MSH_MSG_TYPE, 2), patient_ids)
+
+
+def _open_map(f):
+    """
+    Read-only mmap of a file, or None for an empty file (which can't be mapped).
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class FileIndex(object):
+    """
+    The index of one archive file, kept in sync with its sidecar. `entries` lists the
+    messages in file order; `size` is how much of the file has been indexed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.entries = []
+        self.size = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        by_offset = collections.OrderedDict()
+        with io.open(self.index_path, encoding='utf-8') as f:
+            header = f.readline().split()
+            if header[:2] != ['#HL7py-index', _INDEX_VERSION]:
+                f.close()
+                os.remove(self.index_path)  #Written by another version; build it again.
+                return
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('@size '):
+                    self.size = int(line[6:])
+                    continue
+                try:
+                    offset, length, ctl_id, timestamp, msg_type, ids = line.split('\t')
+                except ValueError:
+                    continue    #Cut off by a crash; the scan after it is redone.
+                #Entries written later for the same offset (a message that was appended
+                #to) replace the earlier ones.
+                by_offset[int(offset)] = IndexEntry(self.path, int(offset), int(length),
+                                                    ctl_id, timestamp, msg_type,
+                                                    tuple(ids.split('~')) if ids else ())
+        self.entries = sorted(by_offset.values(), key=lambda entry: entry.offset)
+
+    def update(self):
+        """
+        Scan whatever was added to the file since the last update and append it to the
+        sidecar. Returns the number of messages added.
+        """
+        size = os.path.getsize(self.path)
+        if size == self.size:
+            return 0
+        if size < self.size:
+            #Not an append; start over.
+            self.entries = []
+            self.size = 0
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+        before = len(self.entries)
+        #The last message may have been cut off mid-write; scan it again.
+        start = self.entries.pop().offset if self.entries else 0
+
+        new = []
+        with open(self.path, 'rb') as f:
+            buf = _open_map(f)
+            if buf is not None:
+                try:
+                    for offset, length in scan_messages(buf, start):
+                        keys = message_keys(buf[offset:offset + length])
+                        new.append(IndexEntry(self.path, offset, length, *keys))
+                    size = len(buf)
+                finally:
+                    buf.close()
+
+        write_header = not os.path.exists(self.index_path)
+        with io.open(self.index_path, 'a', encoding='utf-8') as f:
+            if write_header:
+                f.write(u'#HL7py-index %s\n' % (_INDEX_VERSION,))
+            for entry in new:
+                f.write(u'%d\t%d\t%s\t%s\t%s\t%s\n' % (
+                    entry.offset, entry.length, _clean(entry.msg_ctl_id),
+                    _clean(entry.timestamp), _clean(entry.msg_type),
+                    u'~'.join(_clean(value) for value in entry.patient_ids)))
+            f.write(u'@size %d\n' % (size,))
+        self.entries.extend(new)
+        self.size = size
+        return len(self.entries) - before
+
+
+def _clean(value):
+    return value.replace(u'\t', u' ').replace(u'\n', u' ').replace(u'~', u' ')
+
+
+class Archive(object):
+    """
+    Indexes for a set of archive files, updated (or built) when the Archive is created
+    unless update=False. Look messages up with find() and load them with read() or
+    parse().
+    """
+    def __init__(self, paths, update=True):
+        if isinstance(paths, string_types):
+            paths = [paths]
+        self.files = [FileIndex(path) for path in paths]
+        if update:
+            self.update()
+
+    def update(self):
+        """
+        Bring every index up to date with its file. Returns the number of messages added.
+        """
+        count = sum(index.update() for index in self.files)
+        self._by_ctl_id = collections.defaultdict(list)
+        self._by_patient_id = collections.defaultdict(list)
+        for index in self.files:
+            for entry in index.entries:
+                self._by_ctl_id[entry.msg_ctl_id].append(entry)
+                for patient_id in entry.patient_ids:
+                    self._by_patient_id[patient_id].append(entry)
+        return count
+
+    def __len__(self):
+        return sum(len(index.entries) for index in self.files)
+
+    def __iter__(self):
+        for index in self.files:
+            for entry in index.entries:
+                yield entry
+
+    def find(self, msg_ctl_id=None, mrn=None, msg_type=None, timestamp=None):
+        """
+        Entries matching every criterion given: the control ID, a patient ID (any
+        repetition of PID-3), the message type (e.g. 'ADT^A08') and the start of the
+        timestamp (e.g. '20121018' for that day).
+        """
+        if msg_ctl_id is not None:
+            entries = self._by_ctl_id.get(msg_ctl_id, [])
+        elif mrn is not None:
+            entries = self._by_patient_id.get(mrn, [])
+        else:
+            entries = self
+        return [entry for entry in entries
+                if (mrn is None or mrn in entry.patient_ids) and
+                (msg_type is None or entry.msg_type == msg_type) and
+                (timestamp is None or entry.timestamp.startswith(timestamp))]
+
+    def read(self, entry):
+        """
+        The raw bytes of one message.
+        """
+        with open(entry.path, 'rb') as f:
+            f.seek(entry.offset)
+            return f.read(entry.length)
+
+    def parse(self, entry, custom_levels=None, lazy=False):
+        return parse(self.read(entry), custom_levels, lazy=lazy)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    arg_parser.add_argument('command', choices=['index', 'find'])
+    arg_parser.add_argument('paths', nargs='+', help='archive files')
+    arg_parser.add_argument('--ctl-id', help='control ID (MSH-10)')
+    arg_parser.add_argument('--mrn', help='patient ID (PID-3)')
+    arg_parser.add_argument('--type', help="message type (MSH-9), e.g. 'ADT^A08'")
+    arg_parser.add_argument('--date', help='start of the timestamp (MSH-7), e.g. 20121018')
+    args = arg_parser.parse_args(argv)
+
+    archive = Archive(args.paths)
+    if args.command == 'index':
+        print('%d messages in %d files' % (len(archive), len(archive.files)))
+        return 0
+    entries = archive.find(args.ctl_id, args.mrn, args.type, args.date)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    for entry in entries:
+        out.write(archive.read(entry).replace(b'\r', b'\n') + b'\n\n')
+    return 0 if entries else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
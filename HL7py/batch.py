@@ -0,0 +1,292 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Reading (and writing) files that hold many HL7 messages, optionally wrapped in FHS/BHS
+batch envelopes, without loading the whole file into memory.
+"""
+import datetime
+import gzip
+import re
+from HL7py.constants import CR, LF, FS, VT, DEFAULT_DELIMS, DEFAULT_ENCODING
+from HL7py.emit import compile_emitter
+from HL7py.parser import Parser, Message, encode_message
+
+#Bytes read from the underlying file per call to read().
+CHUNK_SIZE = 1 << 16
+
+#Bytes BatchWriter collects before handing them to the file in one writelines() call.
+BUFFER_SIZE = 1 << 20
+
+#gzip level used by BatchWriter(compress=True).
+COMPRESS_LEVEL = 6
+
+#MSH-2/FHS-2/BHS-2 for the default delimiters: component, repetition, escape, subcomponent.
+ENCODING_CHARS = DEFAULT_DELIMS[1] + DEFAULT_DELIMS[3] + DEFAULT_DELIMS[4] + DEFAULT_DELIMS[2]
+
+#Batch envelope segments. They delimit messages but do not belong to any of them.
+ENVELOPE_CODES = ('FHS', 'BHS', 'BTS', 'FTS')
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class _Markers(object):
+    """
+    Separator strings in the same type (bytes or text) as the data being read.
+    """
+    def __init__(self, convert):
+        self.empty = convert('')
+        self.CR = convert(CR)
+        self.FS = convert(FS)
+        self.VT = convert(VT)
+        self.MSH = convert('MSH')
+        self.envelopes = tuple(convert(code) for code in ENVELOPE_CODES)
+        self.re_eol = re.compile(convert('[\r\n]'))
+
+
+_byte_markers = _Markers(lambda s: s.encode('ascii'))
+_text_markers = _Markers(lambda s: s)
+
+
+def iter_raw_messages(source, chunk_size=CHUNK_SIZE):
+    """
+    Yield the text of each message in `source`, one at a time, with its segments joined
+    by CR. `source` is either a path or a file-like object with a read() method; it may
+    return bytes or text. Segments may end with CR or LF.
+
+    A message starts at each MSH segment. FHS/BHS/BTS/FTS envelope segments end the
+    current message and are dropped, as is anything before the first MSH. Only one chunk
+    and the message being assembled are held in memory at any time.
+    """
+    if isinstance(source, string_types):
+        with open(source, 'rb') as f:
+            for raw in iter_raw_messages(f, chunk_size):
+                yield raw
+        return
+
+    markers = None
+    pending = None
+    segments = []
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        if markers is None:
+            markers = _byte_markers if isinstance(chunk, bytes) else _text_markers
+            pending = markers.empty
+        lines = markers.re_eol.split(pending + chunk)
+        #The last piece may be a partial segment; keep it for the next chunk.
+        pending = lines.pop()
+        for raw in _collect(lines, segments, markers):
+            yield raw
+
+    if markers is None:
+        return
+    for raw in _collect([pending], segments, markers):
+        yield raw
+    if segments:
+        yield markers.CR.join(segments)
+
+
+def _collect(lines, segments, markers):
+    """
+    Add lines to the message being assembled in `segments`, yielding each message that
+    is completed along the way.
+    """
+    for line in lines:
+        line = line.replace(markers.VT, markers.empty).replace(markers.FS, markers.empty)
+        line = line.strip()
+        if not line:
+            continue
+        code = line[:3]
+        if code == markers.MSH:
+            if segments:
+                yield markers.CR.join(segments)
+                del segments[:]
+            segments.append(line)
+        elif code in markers.envelopes:
+            if segments:
+                yield markers.CR.join(segments)
+                del segments[:]
+        elif segments:
+            segments.append(line)
+
+
+def iter_messages(source, chunk_size=CHUNK_SIZE, custom_levels=None, lazy=False):
+    """
+    Parse each message in `source` (a path or file-like object) and yield it as a
+    Message. This is the streaming counterpart of MultiMessage: memory use depends on
+    the size of the largest message, not the size of the file. See iter_raw_messages.
+    """
+    parser = Parser(custom_levels=custom_levels, lazy=lazy)
+    for raw in iter_raw_messages(source, chunk_size):
+        yield parser.parse(raw)
+
+
+class BatchWriter(object):
+    """
+    Stream messages to a file in a FHS/BHS batch envelope:
+
+        with BatchWriter('nightly.hl7', header={'send_app': 'ANKHOS'}) as writer:
+            for message in messages:
+                writer.write(message)
+
+    writes FHS, BHS, the messages, then BTS (with the number of messages in the batch)
+    and FTS (with the number of batches) on close(). With `batch_size`, a new BHS/BTS
+    batch is started every `batch_size` messages.
+
+    `target` is a path, a binary file-like object or a socket. Messages can be Message
+    objects, text or bytes. Text is encoded with the character set in its MSH-18, or with
+    `encoding` when MSH-18 is empty; the envelope segments, which have no MSH-18, always
+    use `encoding`. Messages are collected into blocks of about `buffer_size` bytes and
+    written with writelines(), so memory use does not grow with the size of the file. `header` and `batch_header` are data dictionaries for the
+    FHS and BHS segments (see emit.compile_emitter); their timestamp defaults to now.
+    compress=True gzips the output. envelope=False writes the messages alone.
+
+    Files opened from a path are closed by close(); file objects and sockets are left
+    open, but are flushed.
+    """
+    def __init__(self, target, header=None, batch_header=None, batch_size=None,
+                 compress=False, buffer_size=BUFFER_SIZE, encoding=DEFAULT_ENCODING,
+                 envelope=True):
+        self._owned = None
+        if isinstance(target, string_types):
+            target = self._owned = open(target, 'wb')
+        elif not hasattr(target, 'write') and hasattr(target, 'makefile'):
+            target = self._owned = target.makefile('wb')
+        self._target = target
+        if compress:
+            target = gzip.GzipFile(fileobj=target, mode='wb', compresslevel=COMPRESS_LEVEL)
+        self._file = target
+        self.header = header or {}
+        self.batch_header = batch_header or {}
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.envelope = envelope
+        self.message_count = 0
+        self.batch_count = 0
+        self._batch_messages = 0
+        self._pending = []
+        self._pending_size = 0
+        self._in_batch = False
+        self.closed = False
+        if envelope:
+            self._segment('FHS', _with_defaults(self.header))
+
+    def _add(self, data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.buffer_size:
+            self._write_pending()
+
+    def _write_pending(self):
+        if self._pending:
+            self._file.writelines(self._pending)
+            self._pending = []
+            self._pending_size = 0
+
+    def _segment(self, code, data):
+        text = compile_emitter(code)(data)
+        try:
+            self._add(text.encode(self.encoding) + _CR)
+        except UnicodeError as e:
+            raise ValueError("%s segment cannot be encoded as %s (%s); pass a BatchWriter "
+                             "encoding that can hold it." % (code, self.encoding, e))
+
+    def _start_batch(self):
+        self._segment('BHS', _with_defaults(self.batch_header))
+        self._in_batch = True
+        self._batch_messages = 0
+        self.batch_count += 1
+
+    def _end_batch(self):
+        self._segment('BTS', {'batch_msg_count': self._batch_messages})
+        self._in_batch = False
+
+    def write(self, message):
+        """
+        Add one message to the file.
+        """
+        if self.closed:
+            raise ValueError("Write to a closed BatchWriter.")
+        if isinstance(message, Message):
+            message = message._base.get_as_str()
+        message = encode_message(message, self.encoding)
+        if self.envelope:
+            if self._in_batch and self._batch_messages == self.batch_size:
+                self._end_batch()
+            if not self._in_batch:
+                self._start_batch()
+            self._batch_messages += 1
+        self.message_count += 1
+        self._add(message.strip(_FRAMING) + _CR)
+
+    def write_many(self, messages):
+        for message in messages:
+            self.write(message)
+
+    def flush(self):
+        """
+        Write out the buffered messages (the envelope stays open).
+        """
+        self._write_pending()
+        self._file.flush()
+
+    def close(self):
+        """
+        Write the trailers and any buffered messages, and flush the target.
+        """
+        if self.closed:
+            return
+        if self.envelope:
+            if self._in_batch:
+                self._end_batch()
+            self._segment('FTS', {'file_batch_count': self.batch_count})
+        self._write_pending()
+        self.closed = True
+        if self._file is not self._target:
+            self._file.close()
+        self._target.flush()
+        if self._owned is not None:
+            self._owned.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_CR = CR.encode('ascii')
+_FRAMING = (VT + FS + CR + LF).encode('ascii')
+
+
+def _with_defaults(header):
+    data = {'encoding_chars': ENCODING_CHARS, 'timestamp': datetime.datetime.now()}
+    data.update(header)
+    return data
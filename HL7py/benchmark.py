@@ -0,0 +1,318 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Benchmarks for parsing, serializing and reading messages. Messages are generated from the
+hl7fields.py specification, so every field the spec knows about gets a plausible value.
+
+    python -m HL7py.benchmark --output current.json
+    python -m HL7py.benchmark --baseline current.json
+
+Each operation reports messages/sec, latency percentiles (microseconds) and the peak
+memory allocated while it runs over the whole sample (Python 3 only, via tracemalloc).
+Results are written as JSON; with --baseline, operations that got slower by more than
+--threshold are listed and the exit status is 1.
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import string
+import sys
+from timeit import default_timer
+from HL7py.constants import DEFAULT_DELIMS, CR
+from HL7py.parser import parse, MultiMessage
+from HL7py.schema import DEFAULT_SPEC
+from HL7py.pool import message_data
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+#Segments following MSH in each generated message type. OBX and MFE/STF/PRA repeat.
+ADT_A08_SEGMENTS = ('EVN', 'PID', 'PD1', 'NK1', 'PV1', 'IN1', 'IN2', 'GT1')
+MFN_RECORD_SEGMENTS = ('MFE', 'STF', 'PRA')
+
+PERCENTILES = (50, 90, 99)
+_WORD_CHARS = string.ascii_uppercase + string.digits
+
+
+class MessageGenerator(object):
+    """
+    Build synthetic messages from the field specification. `fill` is the share of
+    optional fields that get a value; the rest are left empty, as real feeds do.
+    Generation is deterministic for a given seed.
+    """
+    def __init__(self, seed=0, fill=0.6, spec=DEFAULT_SPEC, delims=DEFAULT_DELIMS):
+        self.random = random.Random(seed)
+        self.fill = fill
+        self.spec = spec
+        self.delims = delims
+        self.control_id = 0
+
+    def _leaf(self, data_type):
+        rand = self.random
+        if data_type == 'timestamp':
+            return '%04d%02d%02d%02d%02d' % (rand.randint(1950, 2020), rand.randint(1, 12),
+                                             rand.randint(1, 28), rand.randint(0, 23),
+                                             rand.randint(0, 59))
+        if data_type == 'date':
+            return '%04d%02d%02d' % (rand.randint(1920, 2020), rand.randint(1, 12),
+                                     rand.randint(1, 28))
+        return ''.join(rand.choice(_WORD_CHARS) for _ in range(rand.randint(1, 12)))
+
+    def _value(self, field, delim_idx):
+        subfields = field.get('subfields')
+        if not subfields:
+            return self._leaf(field.get('data_type', 'string'))
+        values = [self._value(sf, delim_idx + 1) if self.random.random() < self.fill else ''
+                  for sf in subfields]
+        return self.delims[delim_idx + 1].join(values).rstrip(self.delims[delim_idx + 1])
+
+    def segment(self, code, **values):
+        """
+        Return one segment as text. Keyword arguments set fields by name, e.g.
+        segment('OBX', set_id='1').
+        """
+        subfields = self.spec[code]['subfields']
+        fields = [code]
+        for field in subfields[1:]:
+            if field['code'] in values:
+                fields.append(values[field['code']])
+            elif self.random.random() < self.fill:
+                fields.append(self._value(field, 0))
+            else:
+                fields.append('')
+        if code == 'MSH':
+            delims = self.delims
+            fields[1] = delims[1] + delims[3] + delims[4] + delims[2]
+        return self.delims[0].join(fields).rstrip(self.delims[0])
+
+    def msh(self, message_type):
+        self.control_id += 1
+        return self.segment('MSH', msg_type=message_type, msg_ctl_id=str(self.control_id),
+                            proc_id='P', version='2.3')
+
+    def adt_a08(self):
+        """
+        ADT^A08 (update patient information) with the usual demographic segments.
+        """
+        segments = [self.msh('ADT^A08')]
+        segments.extend(self.segment(code, set_id='1') if code != 'EVN' else
+                        self.segment(code) for code in ADT_A08_SEGMENTS)
+        return CR.join(segments)
+
+    def oru_r01(self, n_obx=10):
+        """
+        ORU^R01 (observation result) with one order holding `n_obx` OBX segments.
+        """
+        segments = [self.msh('ORU^R01'), self.segment('PID', set_id='1'),
+                    self.segment('ORC'), self.segment('OBR', set_id='1')]
+        for i in range(n_obx):
+            segments.append(self.segment('OBX', set_id=str(i + 1), value_type='NM'))
+        return CR.join(segments)
+
+    def mfn(self, n_records=5):
+        """
+        MFN^M02 (staff master file) with `n_records` MFE/STF/PRA records.
+        """
+        segments = [self.msh('MFN^M02'), self.segment('MFI')]
+        for i in range(n_records):
+            segments.extend(self.segment(code) for code in MFN_RECORD_SEGMENTS)
+        return CR.join(segments)
+
+
+def _deep_access(message):
+    """
+    Read a few fields at the bottom of the segment tree, the way a mapping script does.
+    """
+    msh = message.MSH
+    values = [msh.msg_type.event_code.data, msh.msg_ctl_id.data]
+    for segment in message._base.child_segments:
+        for child in segment.child_segments:
+            for grandchild in child.child_segments:
+                values.append(grandchild.set_id.data)
+    for orc in message.ORC_list:
+        for obr in orc.OBR_list:
+            values.extend(obx.obs_id.label.data for obx in obr.OBX_list)
+    for pid in message.PID_list:
+        values.append(pid.pat_name.family_name.data)
+    return values
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    i = int(round((len(sorted_values) - 1) * pct / 100.0))
+    return sorted_values[i]
+
+
+def measure(operation, items, repeat=3, prepare=None):
+    """
+    Run `operation` on every item `repeat` times and summarize the timings. Peak memory
+    is measured on one further pass that keeps all the results alive.
+
+    If `prepare` is given, operation(prepare(item)) is timed instead, with prepare run
+    outside the timing before every call, e.g. to hand each run a freshly parsed message
+    rather than one whose .hl7 is already cached.
+    """
+    latencies = []
+    for _ in range(repeat):
+        for item in items:
+            if prepare is not None:
+                item = prepare(item)
+            start = default_timer()
+            operation(item)
+            latencies.append(default_timer() - start)
+    latencies.sort()
+    total = sum(latencies)
+
+    result = {
+        'count': len(latencies),
+        'seconds': total,
+        'msgs_per_sec': len(latencies) / total if total else None,
+    }
+    for pct in PERCENTILES:
+        result['p%d_us' % pct] = _percentile(latencies, pct) * 1e6
+    result['peak_kib'] = None
+    if tracemalloc is not None:
+        if prepare is not None:
+            items = [prepare(item) for item in items]
+        tracemalloc.start()
+        kept = [operation(item) for item in items]
+        result['peak_kib'] = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+        del kept
+    return result
+
+
+def scenarios(count, n_obx, seed=0):
+    """
+    Return {name: list of raw messages} for the generated message types.
+    """
+    gen = MessageGenerator(seed)
+    return {
+        'ADT^A08': [gen.adt_a08() for _ in range(count)],
+        'ORU^R01': [gen.oru_r01(n_obx) for _ in range(count)],
+        'MFN^M02': [gen.mfn() for _ in range(count)],
+    }
+
+
+def run(count=200, n_obx=20, repeat=3, batch_size=50, seed=0):
+    """
+    Run every benchmark and return the results as a JSON-serializable dict.
+    """
+    results = {}
+    for name, raws in sorted(scenarios(count, n_obx, seed).items()):
+        parsed = [parse(raw) for raw in raws]
+        batches = [CR.join(raws[i:i + batch_size]) for i in range(0, len(raws), batch_size)]
+        ops = {
+            'parse': measure(parse, raws, repeat),
+            'parse_lazy': measure(lambda raw: parse(raw, lazy=True), raws, repeat),
+            #Serialized text is cached per node, so every run gets a new message.
+            'hl7': measure(lambda message: message.hl7, raws, repeat, prepare=parse),
+            'data': measure(message_data, parsed, repeat),
+            'deep_access': measure(_deep_access, parsed, repeat),
+        }
+        multi = measure(MultiMessage, batches, repeat)
+        #Latencies are per batch, but report throughput per message so it compares with
+        #parse. The last batch may be short, so count the messages rather than batches.
+        multi['msgs_per_sec'] = len(raws) * repeat / multi['seconds'] if multi['seconds'] \
+            else None
+        ops['multimessage'] = multi
+        results[name] = ops
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.now().isoformat(),
+            'count': count,
+            'n_obx': n_obx,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold=0.1):
+    """
+    Return (scenario, operation, baseline msgs/sec, current msgs/sec) for every
+    operation whose throughput dropped by more than `threshold` (a fraction).
+    """
+    regressions = []
+    for name, ops in sorted(current['results'].items()):
+        for op, result in sorted(ops.items()):
+            old = baseline['results'].get(name, {}).get(op)
+            if not old or not old['msgs_per_sec'] or not result['msgs_per_sec']:
+                continue
+            if result['msgs_per_sec'] < old['msgs_per_sec'] * (1 - threshold):
+                regressions.append((name, op, old['msgs_per_sec'], result['msgs_per_sec']))
+    return regressions
+
+
+def format_results(results):
+    lines = ['%-8s %-13s %12s %10s %10s %10s %10s' % (
+        'message', 'operation', 'msgs/sec', 'p50 us', 'p90 us', 'p99 us', 'peak KiB')]
+    for name, ops in sorted(results['results'].items()):
+        for op, r in sorted(ops.items()):
+            peak = '%10.0f' % r['peak_kib'] if r['peak_kib'] is not None else '%10s' % '-'
+            lines.append('%-8s %-13s %12.0f %10.1f %10.1f %10.1f %s' % (
+                name, op, r['msgs_per_sec'], r['p50_us'], r['p90_us'], r['p99_us'], peak))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    arg_parser.add_argument('--count', type=int, default=200,
+                            help='messages generated per message type')
+    arg_parser.add_argument('--obx', type=int, default=20, help='OBX segments per ORU^R01')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', help='write the results to this JSON file')
+    arg_parser.add_argument('--baseline', help='compare against a previous JSON file')
+    arg_parser.add_argument('--threshold', type=float, default=0.1,
+                            help='allowed throughput drop against the baseline')
+    args = arg_parser.parse_args(argv)
+
+    results = run(args.count, args.obx, args.repeat, seed=args.seed)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, op, old, new in regressions:
+            print('REGRESSION %s %s: %.0f -> %.0f msgs/sec' % (name, op, old, new))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
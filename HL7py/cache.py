@@ -0,0 +1,130 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+A cache in front of parse() for feeds that deliver the same message more than once
+(retransmissions when an ACK is late, replays from an interface engine).
+
+    cache = ParseCache(max_entries=4096, max_bytes=64 << 20)
+    message = cache.parse(raw)
+
+Each entry keeps only the segment texts and the shape of the segment tree. Every call
+returns a new Message built from them with lazy segments (see parse(lazy=True)), so a
+caller that changes its message never changes what the next caller gets, and a
+segment's fields are only split once that caller reads them.
+
+A cache can be shared by threads: lookups, inserts and evictions hold a lock, but
+parsing happens outside of it.
+"""
+import collections
+import sys
+import threading
+from HL7py.parser import parse, _message_template, _build_message
+from HL7py.schema import DEFAULT_SPEC
+from HL7py.intern import _move_to_end
+
+#Rough cost of an entry beyond its strings: the tuples that describe each segment.
+_SEGMENT_OVERHEAD = 120
+
+
+class ParseCache(object):
+    """
+    LRU cache of parse results keyed by the raw text (str or bytes) and custom_levels.
+    The key is the text itself, so lookups cost one hash of the text (cached by Python
+    for the lifetime of the string) and a comparison, and never mix up two messages.
+    Entries are evicted once there are more than `max_entries` or their estimated size
+    passes `max_bytes`.
+    """
+    def __init__(self, max_entries=1024, max_bytes=32 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def parse(self, raw_text, custom_levels=None, spec=DEFAULT_SPEC):
+        """
+        Same as parse(raw_text, custom_levels, lazy=True, spec=spec), but served from the
+        cache when this text was parsed before with the same custom_levels and spec.
+        """
+        if isinstance(raw_text, (bytearray, memoryview)):
+            raw_text = bytes(raw_text)
+        key = (raw_text, _levels_key(custom_levels), spec.version)
+        entries = self._entries
+        with self._lock:
+            entry = entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                _move_to_end(entries, key, entry)
+            else:
+                self.misses += 1
+        if entry is not None:
+            return _build_message(raw_text, entry[0], entry[2])
+
+        message = parse(raw_text, custom_levels, lazy=True, spec=spec)
+        template = _message_template(message)
+        #Each row's notes are (layout, text) pairs; only their texts are counted.
+        size = sys.getsizeof(raw_text) + sum(
+            _SEGMENT_OVERHEAD + sys.getsizeof(segment_text)
+            for code, layout, text, p, notes in template
+            for segment_text in (text,) + tuple(note[1] for note in notes))
+        with self._lock:
+            if key not in entries:
+                entries[key] = (template, size, message._config)
+                self.size_bytes += size
+                while entries and (len(entries) > self.max_entries or
+                                   self.size_bytes > self.max_bytes):
+                    self.size_bytes -= entries.popitem(last=False)[1][1]
+                    self.evictions += 1
+        #The template only holds immutable strings and layouts, so this message can be
+        #handed out as is.
+        return message
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'size_bytes': self.size_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hit_rate()}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+
+def _levels_key(custom_levels):
+    if not custom_levels:
+        return None
+    return frozenset(custom_levels.items())
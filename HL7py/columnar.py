@@ -0,0 +1,312 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Bulk export of one segment type (OBX by default) from many messages into typed columns.
+Rows are read straight from the raw text, so no Segment, Node or per-segment dict is
+built. Each row also carries the message control ID (MSH-10) and the set ID of the
+segment's parent (the OBR, for an OBX).
+
+Columns come out as plain lists (ColumnarExporter.iter_batches), NumPy arrays
+(iter_numpy), Arrow record batches (iter_arrow) or a Parquet file (write_parquet).
+NumPy and pyarrow are optional and only imported here.
+"""
+import datetime
+from HL7py.constants import DEFAULT_DELIMS
+from HL7py.dtm import parse_dtm, parse_dt
+from HL7py.extract import Extractor
+from HL7py.parser import Message, get_delims, decode_message
+from HL7py.schema import get_layout, DEFAULT_SPEC
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+#Rows per batch.
+BATCH_SIZE = 65536
+
+#Key columns added in front of the segment's own columns.
+KEY_COLUMNS = ('msg_ctl_id', 'parent_set_id')
+
+_MSH_CTL_ID = 9
+_NUMBER = 'number'
+_TEMPORAL = ('timestamp', 'date')
+
+
+class DictionaryColumn(object):
+    """
+    A dictionary-encoded string column as NumPy arrays: `indices` into the sorted,
+    unique `dictionary`. Missing values are empty strings.
+    """
+    __slots__ = ('indices', 'dictionary')
+
+    def __init__(self, indices, dictionary):
+        self.indices = indices
+        self.dictionary = dictionary
+
+    def __len__(self):
+        return len(self.indices)
+
+    def values(self):
+        return self.dictionary[self.indices]
+
+
+def segment_columns(code, fields=None, types=None, spec=DEFAULT_SPEC):
+    """
+    Return (name, positions, data_type) for every leaf field of a segment, named by
+    their dotted path (e.g. 'obs_id.label'). `fields` limits the columns to the given
+    names or to everything under them; `types` overrides the data type of a column
+    (e.g. {'obs_results': 'number'}), which is how numeric columns are asked for since
+    the specification only has strings, dates and timestamps.
+    """
+    layout = get_layout(code, spec=spec)
+    if layout is None:
+        raise ValueError("Message code not in specification: '%s'" % (code,))
+    types = types or {}
+    columns = []
+
+    def add(layout, name, positions):
+        if not layout.children:
+            columns.append((name, positions, types.get(name, layout.data_type)))
+        for i, child in enumerate(layout.children):
+            add(child, name + '.' + child.code, positions + (i,))
+
+    for i, child in enumerate(layout.children[1:], 1):
+        add(child, child.code, (i,))
+    if fields is not None:
+        columns = [column for column in columns
+                   if any(column[0] == f or column[0].startswith(f + '.') for f in fields)]
+    missing = set(types) - set(name for name, p, t in columns)
+    if missing:
+        raise ValueError("Unknown %s columns: %s" % (code, ', '.join(sorted(missing))))
+    return columns
+
+
+def _convert(data_type, values):
+    """
+    Convert a column of raw strings to Python values; empty strings become None except
+    in string columns.
+    """
+    if data_type == _NUMBER:
+        result = []
+        for value in values:
+            try:
+                result.append(float(value) if value else None)
+            except ValueError:
+                result.append(None)
+        return result
+    if data_type == 'timestamp':
+        return [parse_dtm(value) if value else None for value in values]
+    if data_type == 'date':
+        return [parse_dt(value) if value else None for value in values]
+    return values
+
+
+def _naive_utc(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+
+class ColumnarExporter(object):
+    """
+    Export every `code` segment from a stream of messages (raw text or bytes, or parsed
+    Message objects, which are serialized first) as batches of at most `batch_size` rows.
+    Bytes are decoded with their MSH-18 character set (see parser.decode_message). See
+    segment_columns for `fields` and `types`; `custom_levels` and `spec` are used as in
+    parse().
+    """
+    def __init__(self, code='OBX', fields=None, types=None, batch_size=BATCH_SIZE,
+                 custom_levels=None, spec=DEFAULT_SPEC):
+        self.code = code
+        self.columns = segment_columns(code, fields, types, spec)
+        self.batch_size = batch_size
+        self._extractor = Extractor(['%s[*]' % (code,)], custom_levels, spec)
+
+    @property
+    def names(self):
+        return list(KEY_COLUMNS) + [name for name, p, t in self.columns]
+
+    @property
+    def data_types(self):
+        return ['string'] * len(KEY_COLUMNS) + [t for n, p, t in self.columns]
+
+    def _rows(self, raw_text):
+        """
+        Yield one list of raw strings per `code` segment in the message, in the order of
+        self.names.
+        """
+        lines, children = self._extractor._segments(raw_text)
+        delims = DEFAULT_DELIMS
+        ctl_id = ''
+        if len(lines) > 1 and lines[1][:3] == 'MSH':
+            delims = get_delims(lines[1])
+            msh = lines[1].split(delims[0])
+            ctl_id = msh[_MSH_CTL_ID] if len(msh) > _MSH_CTL_ID else ''
+        field_sep, comp_sep, sub_sep = delims[:3]
+
+        found = [(i, parent) for (parent, code), indexes in children.items()
+                 if parent is not None for i in indexes]
+        found.sort()
+        for i, parent in found:
+            parent_set_id = ''
+            if parent:
+                parent_fields = lines[parent].split(field_sep, 2)
+                if len(parent_fields) > 1:
+                    parent_set_id = parent_fields[1]
+            fields = lines[i].split(field_sep)
+            n_fields = len(fields)
+            row = [ctl_id, parent_set_id]
+            components = {}
+            for name, positions, data_type in self.columns:
+                f = positions[0]
+                if f >= n_fields:
+                    row.append('')
+                    continue
+                if len(positions) == 1:
+                    row.append(fields[f])
+                    continue
+                comps = components.get(f)
+                if comps is None:
+                    comps = components[f] = fields[f].split(comp_sep)
+                c = positions[1]
+                value = comps[c] if c < len(comps) else ''
+                if len(positions) == 3:
+                    subs = value.split(sub_sep)
+                    value = subs[positions[2]] if positions[2] < len(subs) else ''
+                row.append(value)
+            yield row
+
+    def iter_raw_batches(self, messages):
+        """
+        Yield batches as lists of columns of raw strings.
+        """
+        width = len(self.names)
+        batch = [[] for _ in range(width)]
+        n_rows = 0
+        for message in messages:
+            if isinstance(message, Message):
+                message = message._base.get_as_str()
+            for row in self._rows(decode_message(message)):
+                for column, value in zip(batch, row):
+                    column.append(value)
+                n_rows += 1
+                if n_rows == self.batch_size:
+                    yield batch
+                    batch = [[] for _ in range(width)]
+                    n_rows = 0
+        if n_rows:
+            yield batch
+
+    def iter_batches(self, messages):
+        """
+        Yield batches as dicts of column name -> list of converted values (float for
+        number columns, datetimes for timestamp/date columns, strings otherwise).
+        """
+        names, data_types = self.names, self.data_types
+        for batch in self.iter_raw_batches(messages):
+            yield dict((name, _convert(data_type, column))
+                       for name, data_type, column in zip(names, data_types, batch))
+
+    def iter_numpy(self, messages):
+        """
+        Yield batches as dicts of column name -> NumPy array: float64 for number
+        columns (NaN when missing), datetime64[us] in UTC for timestamp/date columns
+        (NaT when missing; values without an offset are taken as they are) and
+        DictionaryColumn for strings.
+        """
+        if numpy is None:
+            raise ImportError("iter_numpy needs NumPy.")
+        names, data_types = self.names, self.data_types
+        for batch in self.iter_raw_batches(messages):
+            arrays = {}
+            for name, data_type, column in zip(names, data_types, batch):
+                if data_type == _NUMBER:
+                    arrays[name] = numpy.array(_convert(data_type, column), dtype=float)
+                elif data_type in _TEMPORAL:
+                    values = [_naive_utc(v) for v in _convert(data_type, column)]
+                    arrays[name] = numpy.array(values, dtype='datetime64[us]')
+                else:
+                    dictionary, indices = numpy.unique(numpy.array(column, dtype=str),
+                                                       return_inverse=True)
+                    arrays[name] = DictionaryColumn(indices.astype('int32'), dictionary)
+            yield arrays
+
+    def schema(self):
+        """
+        Arrow schema of the record batches.
+        """
+        if pyarrow is None:
+            raise ImportError("schema needs pyarrow.")
+        types = []
+        for data_type in self.data_types:
+            if data_type == _NUMBER:
+                types.append(pyarrow.float64())
+            elif data_type in _TEMPORAL:
+                types.append(pyarrow.timestamp('us', tz='UTC'))
+            else:
+                types.append(pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))
+        return pyarrow.schema(list(zip(self.names, types)))
+
+    def iter_arrow(self, messages):
+        """
+        Yield pyarrow RecordBatches with the schema from schema().
+        """
+        schema = self.schema()
+        data_types = self.data_types
+        for batch in self.iter_raw_batches(messages):
+            arrays = []
+            for data_type, column, field in zip(data_types, batch, schema):
+                if data_type == _NUMBER or data_type in _TEMPORAL:
+                    values = _convert(data_type, column)
+                    if data_type in _TEMPORAL:
+                        values = [_naive_utc(v) for v in values]
+                    arrays.append(pyarrow.array(values, type=field.type))
+                else:
+                    arrays.append(pyarrow.array(column, type=pyarrow.string())
+                                  .dictionary_encode())
+            yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def write_parquet(self, messages, path, **kwargs):
+        """
+        Write every batch to a Parquet file. Extra keyword arguments go to
+        pyarrow.parquet.ParquetWriter (e.g. compression). Returns the number of rows.
+        """
+        if pyarrow is None:
+            raise ImportError("write_parquet needs pyarrow.")
+        n_rows = 0
+        with pyarrow.parquet.ParquetWriter(path, self.schema(), **kwargs) as writer:
+            for batch in self.iter_arrow(messages):
+                writer.write_batch(batch)
+                n_rows += batch.num_rows
+        return n_rows
@@ -36,7 +36,8 @@ SECOND_TIME_FORMAT = '%Y%m%d%H%M%S'
 LEVELS =\
 {'BASE': 0, 'MSH': 1, 'PID': 1, 'ORC': 1, 'OBR': 2, 'MFI':1,'MFE':1,'STF':1,'PRA':1,
  'OBX': 3, 'ZPS': 1, 'PV1': 1, 'EVN': 1,'NTE':4,'MSA':1,
- 'IN1': 1, 'IN2': 1, 'PD1': 1, 'NK1': 1, 'ZBI': 1, 'GT1': 1,'FTS':1}
+ 'IN1': 1, 'IN2': 1, 'PD1': 1, 'NK1': 1, 'ZBI': 1, 'GT1': 1,'FTS':1,
+ 'FHS': 1, 'BHS': 1, 'BTS': 1}
 
 REMOVE_VT = True
 FALL_BACK_TO_LF = True
@@ -45,6 +46,25 @@ FALL_BACK_TO_LF = True
 delims = ['|','^','&','~','\\']
 DEFAULT_DELIMS = delims
 
-re_index_accessor = re.compile(r'^\w{3}_\d$')
+#Python codecs for the character sets named in MSH-18, used when parsing bytes. Messages
+#without MSH-18 are decoded as latin-1, a superset of the HL7 default (ASCII) that can
+#decode any byte.
+DEFAULT_ENCODING = 'latin-1'
+CHARSETS = {'ASCII': 'ascii', '8859/1': 'latin-1', '8859/2': 'iso8859-2',
+            '8859/3': 'iso8859-3', '8859/4': 'iso8859-4', '8859/5': 'iso8859-5',
+            '8859/6': 'iso8859-6', '8859/7': 'iso8859-7', '8859/8': 'iso8859-8',
+            '8859/9': 'iso8859-9', '8859/15': 'iso8859-15', 'UNICODE': 'utf-8',
+            'UNICODE UTF-8': 'utf-8', 'ISO IR6': 'ascii', 'ISO IR14': 'shift_jis',
+            'ISO IR87': 'iso2022_jp', 'ISO IR159': 'iso2022_jp_2', 'BIG-5': 'big5',
+            'GB 18030-2000': 'gb18030', 'KS X 1001': 'euc_kr'}
+#Codecs (by codecs.lookup() name) whose multibyte characters can contain the bytes of the
+#ASCII delimiters. Messages in these are decoded as a whole before they are split.
+#Codecs that don't encode ASCII as ASCII (UTF-16, UTF-32) are not supported at all.
+DECODE_FIRST = frozenset(['shift_jis', 'cp932', 'shift_jis_2004', 'shift_jisx0213',
+                          'big5', 'big5hkscs', 'cp950', 'gbk', 'gb18030', 'hz',
+                          'iso2022_jp', 'iso2022_jp_1', 'iso2022_jp_2', 'iso2022_jp_2004',
+                          'iso2022_jp_3', 'iso2022_jp_ext', 'iso2022_kr'])
+
+re_index_accessor = re.compile(r'^\w{3}_\d+$')
 re_list_accessor = re.compile(r'^\w{3}_list$')
 re_MSH_split = re.compile("(^|[\n\r\f\t\v])MSH")
@@ -0,0 +1,208 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+import datetime
+
+#Number of distinct strings remembered by parse_dtm. Lab feeds repeat the same handful
+#of timestamps across every OBX in a message, so a small table goes a long way.
+CACHE_SIZE = 4096
+
+#Precision (number of characters, fraction included) used when a datetime that was not
+#parsed by this module is formatted. These match constants.MINUTE_TIME_FORMAT and
+#constants.DATE_TIME_FORMAT, which is what _to_str has always written.
+DEFAULT_TIMESTAMP_PRECISION = 12
+DEFAULT_DATE_PRECISION = 8
+
+_DIGIT_PRECISIONS = (4, 6, 8, 10, 12, 14)
+
+
+class FixedOffset(datetime.tzinfo):
+    """
+    The +/-ZZZZ offset of a HL7 DTM value.
+    """
+    def __init__(self, minutes):
+        self._minutes = minutes
+        self._offset = datetime.timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return format_offset(self._minutes)
+
+    def __getinitargs__(self):
+        return (self._minutes,)
+
+    def __eq__(self, other):
+        return isinstance(other, FixedOffset) and other._minutes == self._minutes
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._minutes)
+
+    def __repr__(self):
+        return "<FixedOffset %s>" % (format_offset(self._minutes),)
+
+
+class HL7DateTime(datetime.datetime):
+    """
+    A datetime that remembers how many characters of the HL7 value it was read from, so
+    that '2012', '201210181' ... '20121018072600.1234' are written back the same way.
+    """
+    __slots__ = ('precision',)
+
+    def __reduce__(self):
+        return (_make_dtm, (self.year, self.month, self.day, self.hour, self.minute,
+                            self.second, self.microsecond, self.tzinfo, self.precision))
+
+    def __reduce_ex__(self, protocol):
+        return self.__reduce__()
+
+
+def _make_dtm(year, month, day, hour, minute, second, microsecond, tzinfo, precision):
+    value = HL7DateTime(year, month, day, hour, minute, second, microsecond, tzinfo)
+    value.precision = precision
+    return value
+
+
+def format_offset(minutes):
+    sign = '-' if minutes < 0 else '+'
+    return '%s%02d%02d' % ((sign,) + divmod(abs(minutes), 60))
+
+
+def _parse(s):
+    s = s.strip()
+    tzinfo = None
+    #The offset can only start after the year.
+    sign_at = max(s.rfind('+'), s.rfind('-'))
+    if sign_at >= 4:
+        offset = s[sign_at + 1:]
+        if len(offset) != 4 or not offset.isdigit():
+            return None
+        minutes = int(offset[:2]) * 60 + int(offset[2:])
+        if s[sign_at] == '-':
+            minutes = -minutes
+        tzinfo = FixedOffset(minutes)
+        s = s[:sign_at]
+
+    n = len(s)
+    microsecond = 0
+    if n in _DIGIT_PRECISIONS:
+        if not s.isdigit():
+            return None
+        precision = n
+    elif n > 15 and s[14] == '.':
+        fraction = s[15:]
+        if not (s[:14].isdigit() and fraction.isdigit()) or len(fraction) > 6:
+            return None
+        microsecond = int(fraction.ljust(6, '0'))
+        precision = n
+    elif n == 17 and s[8] == ' ' and s[11] == ':' and s[14] == ':':
+        #'%Y%m%d %H:%M:%S', which some senders use instead of DTM.
+        s = s[:8] + s[9:11] + s[12:14] + s[15:17]
+        if not s.isdigit():
+            return None
+        n = precision = 14
+    else:
+        return None
+
+    try:
+        value = HL7DateTime(int(s[0:4]),
+                            int(s[4:6]) if n >= 6 else 1,
+                            int(s[6:8]) if n >= 8 else 1,
+                            int(s[8:10]) if n >= 10 else 0,
+                            int(s[10:12]) if n >= 12 else 0,
+                            int(s[12:14]) if n >= 14 else 0,
+                            microsecond, tzinfo)
+    except ValueError:
+        return None
+    value.precision = precision
+    return value
+
+
+_cache = {}
+
+
+def parse_dtm(s):
+    """
+    Parse a HL7 DTM value (YYYY[MM[DD[HH[MM[SS[.S[S[S[S]]]]]]]]][+/-ZZZZ]) into a
+    HL7DateTime. Returns None if the value is not a valid DTM. Results are memoized, which
+    is safe because datetimes are immutable.
+    """
+    try:
+        return _cache[s]
+    except KeyError:
+        pass
+    value = _parse(s)
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    _cache[s] = value
+    return value
+
+
+def parse_dt(s):
+    """
+    Parse a HL7 DT value (YYYY[MM[DD]]). Returns None if the value is not a valid DT.
+    """
+    value = parse_dtm(s)
+    if value is None or value.precision > DEFAULT_DATE_PRECISION or value.tzinfo:
+        return None
+    return value
+
+
+def format_dtm(value, precision=DEFAULT_TIMESTAMP_PRECISION):
+    """
+    Format a date or datetime as a HL7 DTM value. A HL7DateTime is written with the
+    precision it was parsed with; anything else uses the `precision` argument.
+    """
+    precision = getattr(value, 'precision', precision)
+    digits = '%04d%02d%02d' % (value.year, value.month, value.day)
+    if precision > 8:
+        digits += '%02d%02d%02d' % (getattr(value, 'hour', 0), getattr(value, 'minute', 0),
+                                    getattr(value, 'second', 0))
+    if precision > 15:
+        digits += '.' + ('%06d' % (value.microsecond,))[:precision - 15]
+    else:
+        digits = digits[:precision]
+    tzinfo = getattr(value, 'tzinfo', None)
+    if tzinfo is not None:
+        offset = tzinfo.utcoffset(value)
+        if offset is not None:
+            digits += format_offset(offset.days * 1440 + offset.seconds // 60)
+    return digits
+
+
+def format_dt(value):
+    """
+    Format a date or datetime as a HL7 DT value, keeping the precision of a HL7DateTime
+    up to the day.
+    """
+    precision = min(getattr(value, 'precision', DEFAULT_DATE_PRECISION),
+                    DEFAULT_DATE_PRECISION)
+    return ('%04d%02d%02d' % (value.year, value.month, value.day))[:precision]
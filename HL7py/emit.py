@@ -0,0 +1,127 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Write segments straight from data dictionaries, for building outbound messages in bulk.
+
+    from HL7py.emit import compile_emitter
+    pid = compile_emitter('PID')
+    pid({'set_id': 1, 'pat_name': {'family_name': 'Doe', 'given_name': 'Jane'}})
+    'PID|1||||Doe^Jane'
+
+An emitter takes the same dictionaries as Segment(code=..., data=...) and formats values
+with the same rules as .hl7, but no Segment or Node objects are created; the field tree
+is turned into nested functions once, when the emitter is compiled. Trailing empty
+fields, components and subcomponents are left out.
+"""
+import functools
+import weakref
+from HL7py.constants import DEFAULT_DELIMS, CR
+from HL7py.parser import _to_str
+from HL7py.schema import DEFAULT_SPEC
+
+#Compiled emitters per Spec, by (code, delims). Specs are immutable, so an emitter never
+#goes stale, and the emitters of an overlay go away with it.
+_emitters = weakref.WeakKeyDictionary()
+
+
+def _leaf(data_type):
+    """
+    Formatter for a leaf field: parser._to_str, the function .hl7 uses.
+    """
+    return functools.partial(_to_str, data_type)
+
+
+def _composite(layout):
+    """
+    Formatter for a field with subfields: looks each one up in the data dictionary by
+    name, formats it and joins the results.
+    """
+    children = [(child.code, _compile(child)) for child in layout.children]
+    delim = layout.child_delim
+
+    def emit(value):
+        if value is None:
+            return ''
+        assert isinstance(value, dict), "Data for sub-nodes must be a dictionary."
+        parts = [child(value.get(name)) for name, child in children]
+        while parts and not parts[-1]:
+            parts.pop()
+        return delim.join(parts)
+    return emit
+
+
+def _compile(layout):
+    if layout.children:
+        return _composite(layout)
+    return _leaf(layout.data_type)
+
+
+class SegmentEmitter(object):
+    """
+    Turns data dictionaries into the HL7 text of one segment code. Call it (or .emit)
+    with the data; a 'code' key, if given, must match the segment code.
+    """
+    def __init__(self, code, layout):
+        self.code = code
+        self.layout = layout
+        self._emit = _compile(layout)
+
+    def __call__(self, data):
+        code = data.get('code')
+        if code and code != self.code:
+            raise ValueError("'code' attribute in data does not match "
+                             "'code' attribute in segment.")
+        if code is None:
+            data = dict(data, code=self.code)
+        return self._emit(data)
+
+    emit = __call__
+
+    def __repr__(self):
+        return "<SegmentEmitter %s>" % (self.code,)
+
+
+def compile_emitter(code, spec=DEFAULT_SPEC, delims=DEFAULT_DELIMS):
+    """
+    Return the SegmentEmitter for a segment code, compiling it on first use.
+    """
+    emitters = _emitters.get(spec)
+    if emitters is None:
+        emitters = _emitters.setdefault(spec, {})
+    key = (code, tuple(delims))
+    emitter = emitters.get(key)
+    if emitter is None:
+        layout = spec.layout(code, delims)
+        if layout is None:
+            raise Exception("Message code not in specification: '%s'" % (code,))
+        emitter = emitters[key] = SegmentEmitter(code, layout)
+    return emitter
+
+
+def emit_message(segments, spec=DEFAULT_SPEC, delims=DEFAULT_DELIMS):
+    """
+    HL7 text of a message from (code, data) pairs, one per segment, in order.
+    """
+    return CR.join([compile_emitter(code, spec, delims)(data) for code, data in segments])
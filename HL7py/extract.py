@@ -0,0 +1,250 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Pull a few values out of raw messages without building a Message. Paths are written the
+way the tree is accessed,
+
+    extract = compile_paths(['MSH.msg_ctl_id', 'PID.pat_name.family_name',
+                             'ORC.OBR.OBX_list.obs_results', 'OBX[*].obs_id.label'])
+    extract(raw)['PID.pat_name.family_name']
+
+and are resolved to field positions once, when compiled. Extracting splits only the
+segments a path selects; no Segment or Node objects are created.
+"""
+import re
+from HL7py.constants import re_index_accessor, re_list_accessor
+from HL7py.parser import ParserConfig, decode_message, _segment_lines, _to_data, get_delims
+from HL7py.parser import segment_parents, _segment_code
+from HL7py.schema import get_layout, DEFAULT_SPEC
+
+_re_bracket_accessor = re.compile(r'^(\w{3})\[(\*|\d+)\]$')
+
+#How a segment step selects among the matching segments.
+_FIRST = 'first'
+_INDEX = 'index'
+_ALL = 'all'
+
+
+class PathError(ValueError):
+    pass
+
+
+def _shape(layout):
+    """
+    Plain (code, data_type, children) copy of a Layout, so compiled paths pickle.
+    """
+    return (layout.code, layout.data_type, tuple(_shape(child) for child in layout.children))
+
+
+class CompiledPath(object):
+    """
+    One path, resolved. `steps` is a list of (segment code, selection, index) and
+    `positions` the field, component and subcomponent positions below the last segment.
+    `many` is True if the path can select more than one segment, in which case it
+    extracts a list.
+    """
+    __slots__ = ('path', 'steps', 'positions', 'shape', 'many')
+
+    def __init__(self, path, spec=DEFAULT_SPEC):
+        self.path = path
+        self.steps = []
+        names = path.split('.')
+        while names:
+            step = _segment_step(names[0], spec)
+            if step is None:
+                break
+            self.steps.append(step)
+            names.pop(0)
+        if not self.steps:
+            raise PathError("Path must start with a segment code: '%s'" % (path,))
+        if len(names) > 3:
+            raise PathError("Paths can only go down to subcomponents: '%s'" % (path,))
+
+        layout = get_layout(self.steps[-1][0], spec=spec)
+        self.positions = []
+        for name in names:
+            i = layout.position(name)
+            if i is None:
+                raise PathError("%s has no field '%s' (in '%s')" % (layout.code, name, path))
+            self.positions.append(i)
+            layout = layout.children[i]
+        self.shape = _shape(layout)
+        self.many = any(selection is _ALL for code, selection, n in self.steps)
+
+    def __repr__(self):
+        return "<CompiledPath %s>" % (self.path,)
+
+
+def _segment_step(name, spec):
+    """
+    Return (code, selection, index) if `name` selects segments, e.g. OBX, OBX_2,
+    OBX_list, OBX[2] or OBX[*]; otherwise None.
+    """
+    match = _re_bracket_accessor.match(name)
+    if match:
+        code, n = match.groups()
+        if code in spec:
+            return (code, _ALL, None) if n == '*' else (code, _INDEX, int(n))
+    elif re_index_accessor.match(name):
+        code, n = name.rsplit('_', 1)
+        if code in spec:
+            return (code, _INDEX, int(n))
+    elif re_list_accessor.match(name):
+        code = name[:-len('_list')]
+        if code in spec:
+            return (code, _ALL, None)
+    elif name in spec:
+        return (name, _FIRST, None)
+    return None
+
+
+def _value(text, shape, delims, delim_idx):
+    """
+    Convert the text of a node the way Node.data would.
+    """
+    code, data_type, children = shape
+    if not children:
+        return _to_data(data_type, text)
+    sub_vals = text.split(delims[delim_idx + 1])
+    n_vals = len(sub_vals)
+    return dict((child[0], _value(sub_vals[i] if i < n_vals else '', child, delims,
+                                  delim_idx + 1))
+                for i, child in enumerate(children))
+
+
+class Extractor(object):
+    """
+    A set of compiled paths. Call it with the raw text of a message to get a dict of
+    path -> value. Paths that can match several segments (_list or [*] steps) give a
+    list; other paths give the value, or None if the segment is missing. Messages may
+    also be bytes, which are decoded with their MSH-18 character set
+    (parser.decode_message).
+
+    The first segment in a path matches the first segment with that code anywhere in
+    the message, so 'OBX[*]' is every OBX. Further segments must be children of the
+    previous one under constants.LEVELS (plus `custom_levels`), as with attribute access
+    on a parsed Message. NTE segments are not part of that hierarchy and can't be used.
+
+    Lines are split and segments placed according to `config`, a parser.ParserConfig,
+    exactly as Parser(config) would; `custom_levels` and `spec` are applied on top of it.
+    """
+    def __init__(self, paths, custom_levels=None, spec=DEFAULT_SPEC, config=None):
+        if config is None:
+            config = ParserConfig(custom_levels, spec=spec)
+        else:
+            changes = {}
+            if custom_levels is not None:
+                changes['custom_levels'] = custom_levels
+            if spec is not DEFAULT_SPEC:
+                changes['spec'] = spec
+            if changes:
+                config = config.replace(**changes)
+        self.config = config
+        self.spec = config.spec
+        self.levels = config.levels
+        self.paths = [CompiledPath(path, self.spec) for path in paths]
+        self.codes = frozenset(code for path in self.paths for code, s, n in path.steps)
+
+    def _segments(self, raw_text):
+        """
+        Split the message into lines and work out the parent of every segment the same
+        way parse() does. Returns the segment lines (index 0 stands for the root) and the
+        indexes of the segments of interest by (parent index, code); (None, code) lists
+        them regardless of parent.
+        """
+        config = self.config
+        lines = _segment_lines(decode_message(raw_text), False, config)
+        #Codes are read the way parse() reads them, up to the field separator.
+        codes = []
+        sep = config.delims[0]
+        for line in lines:
+            if line[0:3] == 'MSH':
+                sep = line[3:4]
+            codes.append(_segment_code(line, sep))
+        try:
+            parents = segment_parents(codes, self.levels, self.spec, config.z_segments)
+        except (AssertionError, ValueError) as e:
+            raise PathError(str(e))
+
+        wanted = self.codes
+        children = {}
+        for i, code in enumerate(codes):
+            if code in wanted and code != 'NTE':
+                parent = parents[i] + 1
+                children.setdefault((parent, code), []).append(i + 1)
+                children.setdefault((None, code), []).append(i + 1)
+        return [None] + lines, children
+
+    def __call__(self, raw_text):
+        lines, children = self._segments(raw_text)
+        delims = self.config.delims
+        if len(lines) > 1 and lines[1][:3] == 'MSH':
+            delims = get_delims(lines[1])
+        fields = {}
+        result = {}
+        for path in self.paths:
+            selected = [None]
+            for code, selection, n in path.steps:
+                found = []
+                for parent in selected:
+                    matches = children.get((parent, code), ())
+                    if selection is _FIRST:
+                        found.extend(matches[:1])
+                    elif selection is _INDEX:
+                        found.extend(matches[n:n + 1])
+                    else:
+                        found.extend(matches)
+                selected = found
+
+            values = []
+            for i in selected:
+                text = fields.get(i)
+                if text is None:
+                    text = fields[i] = lines[i].split(delims[0])
+                for delim_idx, position in enumerate(path.positions):
+                    if position >= len(text):
+                        text = ''
+                        break
+                    text = text[position]
+                    if delim_idx + 1 < len(path.positions):
+                        text = text.split(delims[delim_idx + 1])
+                if not isinstance(text, str):
+                    text = delims[len(path.positions)].join(text)
+                values.append(_value(text, path.shape, delims, len(path.positions) - 1))
+
+            if path.many:
+                result[path.path] = values
+            else:
+                result[path.path] = values[0] if values else None
+        return result
+
+    extract = __call__
+
+
+def compile_paths(paths, custom_levels=None, spec=DEFAULT_SPEC, config=None):
+    """
+    Compile dotted field paths into an Extractor. See Extractor.
+    """
+    return Extractor(paths, custom_levels, spec, config)
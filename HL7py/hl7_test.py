@@ -22,8 +22,40 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 
 """
+import copy
+import datetime
+import gc
+import gzip
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import threading
 from HL7py.test_messages import *
-from HL7py.parser import parse, MultiMessage, reverse_rep_ch
+from HL7py.parser import parse, MultiMessage, Message, Segment, Node, reverse_rep_ch
+from HL7py.parser import segment_parents, Parser, ParserConfig
+from HL7py.hl7fields import hl7fields
+from HL7py import schema
+from HL7py.schema import get_layout, DEFAULT_SPEC
+from HL7py.dtm import parse_dtm, parse_dt, format_dtm
+from HL7py.batch import iter_messages, iter_raw_messages, BatchWriter
+from HL7py import mllp
+from HL7py import parser
+from HL7py.mllp import MLLPDecoder, MLLPError, encode_frame
+from HL7py.ack import make_ack
+from HL7py.scanner import scan
+from HL7py import pool
+from HL7py import benchmark
+from HL7py.extract import compile_paths, PathError
+from HL7py import columnar
+from HL7py import intern
+from HL7py import instrument
+from HL7py.cache import ParseCache
+from HL7py import emit
+from HL7py.emit import compile_emitter, emit_message
+from HL7py.archive import Archive, INDEX_SUFFIX
+from HL7py.constants import CR, FS, VT, LEVELS, CHARSETS
 
 
 
@@ -36,9 +68,9 @@ def run():
 
     base = parse(reverse_rep_ch(DATA))
 
-    assert base.ORC.OBR.OBX_list[0].hl7 == 'OBX|1|NM|001347^Iron Bind.Cap.(TIBC)^L||476|ug/dL|250-450|H||N|F|||201210180726|BN'
+    assert base.ORC.OBR.OBX_list[0].hl7 == 'OBX|1|NM|001347^Iron Bind.Cap.(TIBC)^L||476|ug/dL|250-450|H||N|F|19840622||201210180726|BN'
     base.ORC.OBR.OBX_list[0].obs_id.label.data = "____MY LABEL___"
-    assert base.ORC.OBR.OBX_list[0].hl7 == 'OBX|1|NM|001347^____MY LABEL___^L||476|ug/dL|250-450|H||N|F|||201210180726|BN',\
+    assert base.ORC.OBR.OBX_list[0].hl7 == 'OBX|1|NM|001347^____MY LABEL___^L||476|ug/dL|250-450|H||N|F|19840622||201210180726|BN',\
     "Can's assign one value."
 
     t = {'code': 'OBX', 'usr_def_access_chk': '', 'obs_dttm': None,
@@ -52,7 +84,7 @@ def run():
 
     base = parse(reverse_rep_ch(DATA))
     assert base.ORC.OBR.OBX_list[2].hl7 == 'OBX|3|NM|001339^Iron, Serum^L||14|ug/dL|35-155'\
-                     '|L||N|F|||201210180726|BN'
+                     '|L||N|F|20010226||201210180726|BN'
     base.ORC.OBR.OBX_list[2].data = t
     assert base.ORC.OBR.OBX_list[2].hl7 == 'OBX|4|NM|100791^eGFR If NonAfricn Am^L||51'\
                                            '|mL/min/1.73|    >59|OMGWTH||N|F||||LOLWTH',\
@@ -64,5 +96,881 @@ def run():
     assert mm.messages[0].PID.pat_name.hl7 == mm.messages[0].PID.pat_name.hl7
 
 
+def test_compiled_layouts():
+    layout = get_layout('OBX')
+    assert layout is get_layout('OBX'), "Layouts should only be compiled once per code."
+    assert get_layout('OBX', ['#', '^', '&', '~', '\\']) is not layout
+    assert layout.children[layout.position('obs_id')].child_delim == '^'
+    for change in [lambda: layout.index.__setitem__('obs_id', 0),
+                   lambda: layout.index.pop('obs_id'), layout.index.clear]:
+        try:
+            change()
+            assert False, "Shared layout indexes should be read-only."
+        except TypeError:
+            pass
+    assert layout.position('obs_id') == 3
+
+    base = parse(reverse_rep_ch(DATA))
+    assert base.ORC.OBR.OBX.node._layout is layout
+    assert 'delims' not in hl7fields['OBX']['subfields'][0], "Parsing must not modify the spec."
+
+
+def test_lazy_parse():
+    base = parse(reverse_rep_ch(DATA), lazy=True)
+    obx = base.ORC.OBR.OBX_list[0]
+    raw_obx = 'OBX|1|NM|001347^Iron Bind.Cap.(TIBC)^L||476|ug/dL|250-450|H||N|F|19840622||201210180726|BN'
+    assert obx.node._child_nodes is None, "Lazy segments should not be split until accessed."
+    assert obx.hl7 == raw_obx, "Untouched lazy segments should serialize verbatim."
+
+    obx.obs_id.label.data = "____MY LABEL___"
+    assert obx.hl7 == raw_obx.replace('Iron Bind.Cap.(TIBC)', '____MY LABEL___')
+    assert obx.node.units._child_nodes is None, "Only accessed fields should be split."
+    assert obx.obs_id.data == {'code': '001347', 'label': '____MY LABEL___',
+                               'system_name': 'L'}
+
+    eager = parse(reverse_rep_ch(DATA))
+    assert base.PID.pat_name.data == eager.PID.pat_name.data
+    assert base.ORC.trans_date_time.data == eager.ORC.trans_date_time.data
+
+
+def test_dtm_codec():
+    for value in ['2012', '201210', '20121018', '2012101807', '201210180726',
+                  '20121018072659', '20121018072659.1', '20121018072659.1234',
+                  '20121018072659.1234-0500', '201210180726+0130']:
+        parsed = parse_dtm(value)
+        assert parsed is not None, "Could not parse DTM '%s'" % (value,)
+        assert format_dtm(parsed) == value, "DTM '%s' did not round trip." % (value,)
+
+    assert parse_dtm('20121018 07:26:59') == datetime.datetime(2012, 10, 18, 7, 26, 59)
+    assert parse_dtm('20121018072659.1234').microsecond == 123400
+    assert parse_dtm('20121018072659-0500').utcoffset() == datetime.timedelta(hours=-5)
+    assert parse_dtm('20121018') is parse_dtm('20121018'), "Repeated values should be memoized."
+    for value in ['', '2012101', '20121318', '2012101807265', 'N/A', '20121018+05']:
+        assert parse_dtm(value) is None, "'%s' should not parse as a DTM." % (value,)
+
+    assert parse_dt('19241010') == datetime.datetime(1924, 10, 10)
+    assert parse_dt('201210180726') is None
+    assert format_dtm(datetime.datetime(2012, 10, 18, 7, 26, 59)) == '201210180726'
+
+    base = parse(reverse_rep_ch(DATA))
+    assert base.ORC.OBR.OBX_list[0].last_obs_normal_va_date.data == datetime.datetime(1984, 6, 22)
+    assert base.PID.date_of_birth.hl7 == '19820620'
+
+
+def test_iter_messages():
+    message = reverse_rep_ch(DATA).strip()
+    batch = '\n'.join(['FHS|^~\\&|LAB', 'BHS|^~\\&|LAB', message, message.replace('0417', '0418'),
+                       'BTS|2', 'FTS|1'])
+    for chunk_size in [7, 1 << 16]:
+        messages = list(iter_messages(io.BytesIO(batch.encode('ascii')), chunk_size=chunk_size))
+        assert len(messages) == 2, "Envelope segments should only separate messages."
+        assert [m.MSH.msg_ctl_id.data for m in messages] == ['0417', '0418']
+        expected = parse(message.encode('ascii')).ORC.OBR.OBX_list[0].hl7
+        assert messages[0].ORC.OBR.OBX_list[0].hl7 == expected
+        assert messages[1].FTS_list == [], "Trailer segments should not end up in a message."
+
+
+def test_mllp_decoder():
+    message = reverse_rep_ch(DATA).strip().encode('ascii')
+    stream = b'noise' + encode_frame(message) + encode_frame(b'MSH|^~\\&|A') + b'\r'
+    decoder = MLLPDecoder()
+    frames = []
+    for i in range(0, len(stream), 5):
+        frames += decoder.feed(stream[i:i + 5])
+    assert frames == [message, b'MSH|^~\\&|A'], "Frames split across reads were not rebuilt."
+    assert decoder.buffered == 0
+
+    small = MLLPDecoder(max_frame_size=10)
+    try:
+        small.feed(b'\x0b' + b'x' * 20)
+    except MLLPError:
+        pass
+    else:
+        raise AssertionError("Oversized frames should be rejected.")
+
+
+def test_mllp_loopback():
+    if mllp.asyncio is None:
+        return
+    loop = mllp.asyncio.new_event_loop()
+
+    def handler(message):
+        ctl_id = message.MSH.msg_ctl_id.data
+        if ctl_id == 'fail':
+            raise ValueError("Handler failed.")
+        if ctl_id == 'slow':
+            return mllp.asyncio.sleep(0.05, 'ACK|slow')
+        if ctl_id == 'utf8':
+            return 'MSH|^~\\&|||||||ACK||P|2.3||||||UNICODE UTF-8\rNTE|1||' + \
+                message.PID.pat_name.family_name.data
+        return 'ACK|' + ctl_id
+
+    server = loop.run_until_complete(mllp.start_server(handler, '127.0.0.1', 0, loop=loop))
+    port = server.sockets[0].getsockname()[1]
+    try:
+        transport, client = loop.run_until_complete(
+            mllp.open_connection('127.0.0.1', port, loop=loop))
+        message = reverse_rep_ch(DATA).strip()
+        replies = [client.send(message.replace('0417', str(i))) for i in range(20)]
+        replies = loop.run_until_complete(mllp.asyncio.gather(*replies))
+        assert replies == ['ACK|%d' % (i,) for i in range(20)], "Replies out of order."
+
+        mllp.logger.disabled = True   # the failure below is logged with its traceback
+        nak = loop.run_until_complete(client.send(message.replace('0417', 'fail')))
+        mllp.logger.disabled = False
+        assert nak.split(CR)[1] == 'MSA|AE|fail'
+        slow = client.send(message.replace('0417', 'slow'))
+        after = client.send(message.replace('0417', 'after'))
+        slow.cancel()
+        assert loop.run_until_complete(after) == 'ACK|after', "Reply went to a cancelled request."
+        #Both ends encode and decode with MSH-18 rather than a fixed codec.
+        utf8 = message.replace('0417', 'utf8').replace('|P|2.3', '|P|2.3||||||UNICODE UTF-8', 1)
+        reply = loop.run_until_complete(client.send(utf8.replace('Test', '\u5f20')))
+        assert reply.split(CR)[1] == 'NTE|1||\u5f20'
+        client.close()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+    class Transport(object):
+        paused = False
+        def __init__(self):
+            self.written = []
+        def is_closing(self):
+            return False
+        def pause_reading(self):
+            self.paused = True
+        def resume_reading(self):
+            self.paused = False
+        def write(self, data):
+            self.written.append(data)
+
+    loop = mllp.asyncio.new_event_loop()
+    try:
+        stuck = loop.create_future()
+        protocol = mllp.MLLPServerProtocol(lambda m: stuck if not stuck.done() and
+                                           m.MSH.msg_ctl_id.data == '0' else 'ACK',
+                                           max_pending=2)
+        protocol.transport, protocol.loop = Transport(), loop
+        protocol.data_received(mllp.encode_frame(message.replace('0417', '0')))
+        protocol.data_received(mllp.encode_frame(message.replace('0417', '1')))
+        assert protocol.transport.paused, "Queued replies count towards max_pending."
+        stuck.set_result('ACK')
+        loop.run_until_complete(mllp.asyncio.sleep(0))
+        assert not protocol.transport.paused and len(protocol.transport.written) == 2
+
+        #Replies without MSH-18 use the charset of the message they answer, and a reply
+        #that can't be encoded becomes an AE acknowledgement.
+        protocol = mllp.MLLPServerProtocol(lambda m: 'ACK|' + m.PID.pat_name.family_name.data)
+        protocol.transport, protocol.loop = Transport(), loop
+        protocol.data_received(mllp.encode_frame(utf8.replace('Test', '\u00e9').encode('utf-8')))
+        assert protocol.transport.written == [mllp.encode_frame('ACK|\u00e9'.encode('utf-8'))]
+        protocol.data_received(mllp.encode_frame(message.replace('Test', '\u00e9')))
+        assert protocol.transport.written[1] == mllp.encode_frame('ACK|\u00e9'.encode('latin-1'))
+        protocol = mllp.MLLPServerProtocol(lambda m: 'ACK|\u5f20')
+        protocol.transport, protocol.loop = Transport(), loop
+        mllp.logger.disabled = True
+        protocol.data_received(mllp.encode_frame(message.replace('0417', 'wide')))
+        mllp.logger.disabled = False
+        assert b'\rMSA|AE|wide' + FS.encode('ascii') in protocol.transport.written[0]
+    finally:
+        loop.close()
+
+
+def test_make_ack():
+    raw = reverse_rep_ch(DATA)
+    ack = make_ack(raw, timestamp='201210180800')
+    assert ack == 'MSH|^~\\&|OPTX|BN002234|1100|BN|201210180800||ACK^R01|0417|P|2.3\rMSA|AA|0417'
+    assert make_ack((VT + raw + FS + CR).encode('ascii'), timestamp='201210180800') == \
+        ack.encode('ascii'), "Framed bytes should get a bytes ACK."
+
+    nak = parse(make_ack(raw, 'AE', 'Unknown|segment'))
+    assert nak.MSA.ack_cd.data == 'AE'
+    assert nak.MSA.msg.hl7 == 'Unknown\\F\\segment', "MSA text should be escaped."
+    assert nak.MSH.recv_app.app_name.data == '1100'
+
+
+def test_child_segment_index():
+    base = parse(reverse_rep_ch(DATA))
+    obr = base.ORC.OBR
+    obx_list = obr.OBX_list
+    obx_list.pop()
+    assert len(obr.OBX_list) == 4, "Changing OBX_list must not change the segment."
+    assert [obx.set_id.data for obx in obr.OBX_list] == ['1', '2', '3', '4']
+    assert obr.OBX_1 is obr.OBX_list[1], "OBX_n should index the OBX children only."
+    assert obr.OBX is obr.OBX_0
+    assert base.ORC_list[1].OBR.set_id.data == '2'
+    assert obr.NTE_list == []
+    for i in range(parser.ACCESSOR_CACHE_SIZE + 10):
+        getattr(obr, 'ZZ%d' % (i,), None)
+    assert len(parser._accessors) <= parser.ACCESSOR_CACHE_SIZE
+
+    msg = Message()
+    msg.add_segments([Segment(code='MSH', data={'version': '2.3'}),
+                      Segment(code='PID', data={'set_id': '1'})])
+    assert msg.PID.set_id.data == '1', "Segments added to a Message should be indexed."
+
+
+def test_compact_nodes():
+    base = parse(reverse_rep_ch(DATA))
+    pid = base.PID
+    assert not hasattr(pid.node, '__dict__') and not hasattr(pid, '__dict__'),\
+        "Nodes and Segments should not carry per-instance dictionaries."
+    assert pid.pat_name.family_name.data == 'Test'
+    assert 'pat_name' in dir(pid.node)
+    try:
+        pid.node.not_a_field
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError("Unknown field names should raise AttributeError.")
+
+    node = Node(subfields=[{'code': 'first', 'data_type': 'string'}])
+    node.add_node(Node(code='second', delim_idx=1))
+    node.set_from_str('a|b')
+    assert node.second.data == 'b' and node.hl7 == 'a|b'
+    assert get_layout('PID').index.get('second') is None, "Shared layouts must not change."
+
+
+def _text(value):
+    return value if isinstance(value, str) else bytes(value).decode('ascii')
+
+
+def test_scanner():
+    raw = reverse_rep_ch(DATA)
+    buffers = [raw, raw.encode('ascii'), bytearray(raw.encode('ascii'))]
+    if bytes is not str:
+        buffers.append(memoryview(raw.encode('ascii')))
+    for buf in buffers:
+        index = scan(buf)
+        text = lambda *path: _text(index.value(*path))
+        assert index.codes[:3] == ['MSH', 'PID', 'ORC'] and len(index) == 14
+        assert text(0, 1) == '^~\\&', "MSH-2 should not be split."
+        assert text(0, 8, 1) == 'R01'
+        assert text(1, 5, 1) == 'Patient' and text(1, 99) == ''
+        obx = index.find('OBX')[0]
+        assert text(obx, 3, 1) == 'Iron Bind.Cap.(TIBC)'
+        assert text(obx).startswith('OBX|1|NM|')
+        if not isinstance(buf, str):
+            label = index.view(obx, 3, 1)
+            assert label.tobytes() == b'Iron Bind.Cap.(TIBC)' and len(index.view(obx, 99)) == 0
+            if isinstance(buf, memoryview):
+                assert label.obj is buf.obj, "view() should not copy the buffer."
+
+    index = scan('\x0bMSH|^~\\&|A^B\r\rPID|1|X&Y^Z\x1c\r')
+    assert index.codes == ['MSH', 'PID'], "Blank lines and framing should be skipped."
+    assert index.value(1, 2, 0, 1) == 'Y' and index.value(1, 2, 1) == 'Z'
+    assert index.field_count(1) == 3 and index.span(1, 3) is None
+
+
+def test_parse_many():
+    raws = [reverse_rep_ch(DATA).replace('MSH|^~\\&|', 'MSH|^~\\&|APP%d|' % i, 1)
+            for i in range(10)]
+    worker_counts = [1, 2] if pool.ProcessPoolExecutor else [1]
+    for workers in worker_counts:
+        results = list(pool.parse_many(raws, workers=workers, chunk_size=3))
+        assert len(results) == 10
+        assert [r[0][1]['send_app']['app_name'] for r in results] == \
+            ['APP%d' % i for i in range(10)], "Results should be in input order."
+        assert results[0][1][0] == 'PID' and results[0][1][1]['pat_name']['family_name'] == 'Test'
+        notes = [data['comment'] for code, data in results[0] if code == 'NTE']
+        assert notes == ['Results confirmed on', 'dilution.']
+    unordered = pool.parse_many(raws, workers=worker_counts[-1], chunk_size=3, ordered=False)
+    assert len(list(unordered)) == 10
+    stopped = pool.parse_many(raws, workers=worker_counts[-1], chunk_size=3)
+    assert next(stopped)[0][0] == 'MSH'
+    stopped.close()
+
+
+def test_benchmark():
+    gen = benchmark.MessageGenerator(seed=1)
+    oru = parse(gen.oru_r01(n_obx=5))
+    assert oru.MSH.msg_type.event_code.data == 'R01'
+    assert [obx.set_id.data for obx in oru.ORC.OBR.OBX_list] == ['1', '2', '3', '4', '5']
+    assert parse(gen.adt_a08()).PID.set_id.data == '1'
+    assert len(parse(gen.mfn(n_records=3)).MFE_list) == 3
+
+    #Both ORC/OBR groups are read, and an ORC without an OBR is fine.
+    message = parse(reverse_rep_ch(DATA) + 'ORC|RE' + CR)
+    values = benchmark._deep_access(message)
+    assert 'Iron Bind.Cap.(TIBC)' in values and 'Ferritin, Serum' in values
+
+    results = benchmark.run(count=2, n_obx=2, repeat=1)
+    assert sorted(results['results']) == ['ADT^A08', 'MFN^M02', 'ORU^R01']
+    assert results['results']['ORU^R01']['parse']['count'] == 2
+    multi = results['results']['ORU^R01']['multimessage']
+    assert multi['msgs_per_sec'] == 2 / multi['seconds'], "Two messages, not one full batch."
+
+    serialized = []
+    def serialize(message):
+        serialized.append(message.PID.node._raw)
+        return message.hl7
+    benchmark.measure(serialize, [reverse_rep_ch(DATA)], repeat=3, prepare=parse)
+    assert serialized[:3] == [None] * 3, "Every run should serialize from scratch."
+    assert benchmark.compare(results, results) == []
+
+
+def test_hl7_cache():
+    for lazy in (False, True):
+        base = parse(reverse_rep_ch(DATA), lazy=lazy)
+        before = base.hl7
+        pid_hl7 = base.PID.node.hl7
+        obx = base.ORC.OBR.OBX_list[0]
+        obx.obs_id.label.data = 'NEW LABEL'
+        assert base.PID.node.hl7 is pid_hl7, "Unchanged segments should reuse their text."
+        assert obx.obs_id.hl7 == '001347^NEW LABEL^L'
+        assert obx.hl7.startswith('OBX|1|NM|001347^NEW LABEL^L||476|')
+        assert base.hl7 == before.replace('Iron Bind.Cap.(TIBC)', 'NEW LABEL', 1)
+
+        obx.obs_id.set_from_str('1^2^3')
+        assert obx.hl7.startswith('OBX|1|NM|1^2^3||476|')
+        obx.data = {'code': 'OBX', 'set_id': '9'}
+        assert obx.hl7.startswith('OBX|9||')
+
+
+def test_extract_paths():
+    raw = reverse_rep_ch(DATA)
+    base = parse(raw)
+    extract = compile_paths(['MSH.msg_ctl_id', 'PID.pat_name.family_name', 'PID.pat_name',
+                             'ORC.OBR.OBX_list.obs_results', 'OBX[*].obs_id.label',
+                             'ORC_1.OBR.OBX.obs_id', 'ORC.OBR.OBX_3.obs_dttm', 'OBX[9].units'])
+    values = extract(raw)
+    assert values['MSH.msg_ctl_id'] == '0417'
+    assert values['PID.pat_name.family_name'] == 'Test'
+    assert values['PID.pat_name'] == base.PID.pat_name.data
+    assert values['ORC.OBR.OBX_list.obs_results'] == \
+        [obx.obs_results.data for obx in base.ORC.OBR.OBX_list]
+    assert len(values['OBX[*].obs_id.label']) == 5, "OBX[*] should match OBX at any depth."
+    assert values['ORC_1.OBR.OBX.obs_id'] == base.ORC_list[1].OBR.OBX.obs_id.data
+    assert values['ORC.OBR.OBX_3.obs_dttm'] == base.ORC.OBR.OBX_3.obs_dttm.data
+    assert values['OBX[9].units'] is None
+    assert compile_paths(['PID[*]'])(raw)['PID[*]'] == [base.PID.data]
+
+    #The same ParserConfig options as Parser, and bytes decoded by MSH-18.
+    flat = compile_paths(['OBR.OBX_list.set_id'], config=ParserConfig({'OBR': 1, 'OBX': 2}))
+    assert flat(raw)['OBR.OBX_list.set_id'] == ['1', '2', '3', '4']
+    by_lf = raw.replace(CR, '\n')
+    pid = compile_paths(['PID.pat_id_int'])
+    assert pid(by_lf)['PID.pat_id_int'] == '112233'
+    no_lf = compile_paths(['PID.pat_id_int'], config=ParserConfig(fall_back_to_lf=False))
+    assert no_lf(by_lf)['PID.pat_id_int'] is None
+    vt = raw.replace('112233', '1122' + VT + '33')
+    assert pid(vt)['PID.pat_id_int'] == '112233'
+    keep_vt = compile_paths(['PID.pat_id_int'], config=ParserConfig(remove_vt=False))
+    assert keep_vt(vt)['PID.pat_id_int'] == '1122' + VT + '33'
+    if bytes is not str:
+        utf8 = raw.replace('|P|2.3', '|P|2.3||||||UNICODE UTF-8', 1).replace('Test', 'T\u00e9st')
+        name = compile_paths(['PID.pat_name.family_name'])
+        assert name(utf8.encode('utf-8'))['PID.pat_name.family_name'] == 'T\u00e9st'
+
+    #Overlay-only fields, and segment codes read up to the field separator as parse() does.
+    site = DEFAULT_SPEC.overlay({'ZXX': {'subfields': [{'code': 'code', 'data_type': 'string'},
+                                                       {'code': 'value', 'data_type': 'string'}]}})
+    assert compile_paths(['ZXX.value'], spec=site)(raw.strip() + CR + 'ZXX|42')['ZXX.value'] == '42'
+    odd = raw.replace('PID|', 'PIDX|1|999|888' + CR + 'PID|', 1)
+    for read in (parse, pid):
+        try:
+            read(odd)
+        except Exception as e:
+            assert "'PIDX'" in str(e), e
+        else:
+            raise AssertionError("A PIDX line is not a PID segment.")
+
+    for bad in ['pat_name', 'PID.no_such_field']:
+        try:
+            compile_paths([bad])
+        except PathError:
+            pass
+        else:
+            raise AssertionError("'%s' should not compile." % (bad,))
+
+
+def test_columnar_export():
+    raw = reverse_rep_ch(DATA)
+    exporter = columnar.ColumnarExporter('OBX', types={'obs_results': 'number'}, batch_size=4)
+    batches = list(exporter.iter_batches([raw, parse(raw)]))
+    assert [len(b['set_id']) for b in batches] == [4, 4, 2]
+    first = batches[0]
+    assert first['msg_ctl_id'] == ['0417'] * 4
+    assert first['parent_set_id'] == ['1'] * 4 and batches[1]['parent_set_id'][0] == '2'
+    assert first['obs_results'] == [476.0, 462.0, 14.0, 3.0]
+    assert first['obs_id.label'][0] == 'Iron Bind.Cap.(TIBC)'
+    assert first['obs_dttm'][0] == datetime.datetime(2012, 10, 18, 7, 26)
+    assert first['last_obs_normal_va_date'][0] == datetime.datetime(1984, 6, 22)
+
+    #Bytes, and messages parsed from bytes, are decoded with their MSH-18 charset.
+    utf8 = raw.replace('|P|2.3', '|P|2.3||||||UNICODE UTF-8', 1).replace('ug/dL', '\u00b5g/dL')
+    for message in (utf8.encode('utf-8'), parse(utf8.encode('utf-8'))) if bytes is not str else ():
+        rows = next(columnar.ColumnarExporter('OBX').iter_batches([message]))
+        assert rows['units'][0] == '\u00b5g/dL' and rows['msg_ctl_id'][0] == '0417'
+
+    if columnar.numpy is not None:
+        arrays = next(exporter.iter_numpy([raw]))
+        assert str(arrays['obs_results'].dtype) == 'float64'
+        assert str(arrays['obs_dttm'].dtype) == 'datetime64[us]'
+        assert list(arrays['obs_id.label'].values())[:2] == ['Iron Bind.Cap.(TIBC)', 'UIBC']
+    if columnar.pyarrow is not None:
+        batch = next(exporter.iter_arrow([raw]))
+        assert batch.num_rows == 4 and batch.schema.names == exporter.names
+    else:
+        try:
+            exporter.write_parquet([raw], os.devnull)
+            assert False, "write_parquet should say that it needs pyarrow."
+        except ImportError:
+            pass
+
+
+def test_parse_bytes():
+    if bytes is str:
+        return  # Python 2 parses byte strings as text.
+    text = reverse_rep_ch(DATA).replace('|P|2.3', '|P|2.3||||||UNICODE UTF-8', 1)
+    text = text.replace('Test^Patient', 'M\u00fcller^Ren\u00e9e', 1)
+    raw = text.encode('utf-8')
+    for lazy in (False, True):
+        for buf in (raw, bytearray(raw), memoryview(raw)):
+            base = parse(buf, lazy=lazy)
+            assert base.PID.pat_name.family_name.data == 'M\u00fcller'
+            assert base.PID.pat_name.given_name.data == 'Ren\u00e9e'
+            assert base.ORC.OBR.OBX_list[0].obs_id.label.data == 'Iron Bind.Cap.(TIBC)'
+            assert base.PID.hl7 == parse(text, lazy=lazy).PID.hl7.encode('utf-8')
+            assert base.ORC.OBR.OBX_list[1].note == 'Results confirmed on\ndilution.'
+    base = parse(raw, lazy=True)
+    assert base.PID.node._child_nodes is None, "Untouched segments should not be decoded."
+    base.PID.pat_name.family_name.data = 'Gro\u00df'
+    assert base.PID.pat_name.hl7 == 'Gro\u00df^Ren\u00e9e^'.encode('utf-8')
+
+    latin = parse(reverse_rep_ch(DATA).replace('Test', 'T\u00e9st', 1).encode('latin-1'))
+    assert latin.PID.pat_name.family_name.data == 'T\u00e9st', "No MSH-18 means latin-1."
+
+    #Second bytes of these characters are '^' or '|', so they must be decoded before splitting.
+    for charset, name in (('ISO IR14', '\u30bf'), ('BIG-5', '\u30c6'),
+                          ('GB 18030-2000', '\u4661')):
+        text = reverse_rep_ch(DATA).replace('|P|2.3', '|P|2.3||||||' + charset, 1)
+        text = text.replace('Test^Patient', name + '^' + name, 1)
+        encoding = CHARSETS[charset]
+        assert b'^' in name.encode(encoding) or b'|' in name.encode(encoding)
+        for lazy in (False, True):
+            base = parse(text.encode(encoding), lazy=lazy)
+            assert base.PID.pat_name.family_name.data == name
+            assert base.PID.pat_name.given_name.data == name
+            assert base.PID.sex.data == 'F'
+            assert base.hl7 == parse(text, lazy=lazy).hl7
+    try:
+        parse(reverse_rep_ch(DATA).replace('|P|2.3', '|P|2.3||||||UTF-16', 1).encode('ascii'))
+    except ValueError as e:
+        assert 'UTF-16' in str(e)
+    else:
+        assert False, "UTF-16 can't be parsed from bytes."
+
+
+def test_intern_pool():
+    raw = reverse_rep_ch(DATA)
+    pool = intern.enable(max_size=1000)
+    try:
+        first, second = parse(raw), parse(raw.replace('0417', '0418'))
+        units = [obx.units.data for obx in first.ORC.OBR.OBX_list + second.ORC.OBR.OBX_list]
+        assert units[0] is units[1] is units[4], "Repeated values should share one object."
+        lazy = parse(raw, lazy=True)
+        assert lazy.ORC.OBR.OBX.units.data is units[0]
+        assert lazy.ORC.OBR.OBX.obs_dttm.data is first.ORC.OBR.OBX.obs_dttm.data
+        assert second.MSH.msg_ctl_id.data == '0418'
+        assert pool.hits > pool.misses and 0 < pool.hit_rate() < 1
+
+        small = intern.enable(max_size=10)
+        parse(raw)
+        assert len(small) == 10 and small.stats()['evictions'] > 0
+
+        #Threads share the pool; evictions must not break each other's lookups.
+        shared = intern.enable(max_size=50)
+        errors = []
+        def worker():
+            try:
+                for _ in range(20):
+                    parse(raw).ORC.OBR.OBX.units.data
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors and len(shared) == 50
+    finally:
+        intern.disable()
+
+
+def test_parse_cache():
+    raw = reverse_rep_ch(DATA)
+    cache = ParseCache(max_entries=2)
+    first = cache.parse(raw)
+    first.PID.pat_name.family_name.data = 'Changed'
+    second = cache.parse(raw)
+    assert second is not first and second.PID.pat_name.family_name.data == 'Test',\
+        "Changes to one caller's message must not reach the cache."
+    second.ORC.OBR.OBX.obs_id.label.data = 'Changed'
+    third = cache.parse(raw)
+    assert third.hl7 == parse(raw, lazy=True).hl7
+    assert third.ORC.OBR.OBX_list[1].note == 'Results confirmed on\ndilution.'
+    assert [s.code for s in third.ORC_list[1].OBR.child_segments] == ['OBX']
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.parse(raw, custom_levels={'ZPS': 1})
+    cache.parse(raw.replace('0417', '0418'))
+    assert cache.misses == 3 and cache.evictions == 1 and len(cache) == 2
+    small = ParseCache(max_bytes=100)
+    small.parse(raw)
+    assert len(small) == 0 and small.stats()['size_bytes'] == 0
+
+    #NTE texts count towards max_bytes.
+    sized = ParseCache()
+    sized.parse(raw)
+    before = sized.size_bytes
+    sized.parse(raw.replace('Results confirmed on', 'R' * 10000))
+    assert sized.size_bytes - before > 20000, "Both the raw text and the note's text grew."
+
+    shared = ParseCache(max_entries=3)
+    raws = [raw.replace('0417', str(i)) for i in range(6)]
+    errors = []
+    def work():
+        try:
+            for i in range(300):
+                message = shared.parse(raws[i % len(raws)])
+                assert message.MSH.msg_ctl_id.data == str(i % len(raws))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+    stats = shared.stats()
+    assert stats['hits'] + stats['misses'] == 2400 and stats['entries'] <= 3
+
+
+def test_segment_parents():
+    raw = reverse_rep_ch(DATA)
+    codes = [line[:3] for line in raw.split(CR) if line.strip()]
+    assert segment_parents(codes) == [-1, -1, -1, 2, 3, 3, 5, 5, 3, 3, -1, 10, 11, -1]
+    #Whatever follows a Z-segment without a level becomes its child.
+    assert segment_parents(['MSH', 'ZXX', 'PID', 'NTE']) == [-1, -1, 1, 2]
+    levels = dict(LEVELS, OBR=1, OBX=2)
+    assert segment_parents(['MSH', 'OBR', 'OBX', 'OBR'], levels) == [-1, -1, 1, -1]
+    try:
+        segment_parents(['OBX', 'PID'])
+        assert False, "A segment with nowhere to go must be rejected."
+    except ValueError:
+        pass
+
+    message = parse(raw)
+    assert [s.code for s in message.ORC_list[0].OBR.child_segments] == ['OBX'] * 4
+    assert message.ORC_list[0].OBR.OBX_list[1].NTE
+
+
+def test_instrument():
+    raw = reverse_rep_ch(DATA).replace('||19820620|', '||1982062X|')
+    calls = []
+    profiler = instrument.enable(callback=lambda *args: calls.append(args))
+    try:
+        message = parse(raw)
+        message.hl7
+        message.PID.hl7
+        message.PID.get_as_str()
+        message.PID.pat_name.hl7
+        coerced = profiler.stats()['stages']['coerce']['calls']
+        parse(raw, lazy=True).PID.date_of_birth.data
+    finally:
+        instrument.disable()
+    parse(raw).hl7
+
+    stats = profiler.stats()
+    assert stats['stages']['split']['calls'] == stats['stages']['build']['calls'] == 2
+    assert stats['stages']['serialize']['calls'] == 4, "Nested joins are not timed again."
+    assert coerced > 100 and stats['stages']['coerce']['calls'] > coerced
+    assert ('coerce', 'date_of_birth') in [call[:2] for call in calls]
+    assert stats['segments']['OBX']['count'] == 10 and stats['segments']['NTE']['count'] == 4
+    latency = stats['parse_latency']['ORU^R01']
+    assert latency['count'] == sum(latency['buckets'].values()) == 2
+    assert stats['coercion_failures'] == {'date_of_birth:date': 2}
+    assert ('parse', 'ORU^R01') in [call[:2] for call in calls]
+    assert ('build', 'PID') in [call[:2] for call in calls]
+    profiler.clear()
+    assert profiler.stats()['segments'] == {}
+
+
+def test_spec_overlay():
+    zxx = {'subfields': [{'code': 'code', 'data_type': 'string'},
+                         {'code': 'value', 'data_type': 'number'}]}
+    site = DEFAULT_SPEC.overlay({'ZXX': zxx}, name='site')
+    assert 'ZXX' in site and 'ZXX' not in DEFAULT_SPEC and 'ZXX' not in hl7fields
+    assert site.version != DEFAULT_SPEC.version and site.base is DEFAULT_SPEC
+    assert site.layout('ZXX') is site.layout('ZXX')
+    assert site.layout('PID') is not DEFAULT_SPEC.layout('PID')
+    try:
+        site['ZXX']['subfields'][0]['code'] = 'changed'
+        assert False, "Spec entries must be immutable."
+    except TypeError:
+        pass
+    zxx['subfields'][1]['code'] = 'changed'
+    assert site.layout('ZXX').position('value') == 1
+
+    raw = reverse_rep_ch(DATA) + 'ZXX|42' + CR
+    assert parse(raw, spec=site).ZXX.value.data == 42.0
+    try:
+        parse(raw)
+        assert False, "ZXX is only in the overlay."
+    except Exception as e:
+        assert 'not in specification' in str(e)
+    multi = MultiMessage(raw, additional_fields={'ZXX': zxx})
+    assert multi.messages[0].ZXX.changed.data == 42.0 and 'ZXX' not in DEFAULT_SPEC
+    assert ParseCache().parse(raw, spec=site).ZXX.value.data == 42.0
+
+    assert pickle.loads(pickle.dumps(site)) is site
+    assert pickle.loads(pickle.dumps(DEFAULT_SPEC)) is DEFAULT_SPEC
+    assert len(pickle.dumps(site)) < 1000, "Only the overlay should be pickled."
+
+    #Specs from other processes and layouts for spec dictionaries are not kept forever.
+    received = schema._load_spec('other-process', 7, {'ZXX': zxx}, (), 'remote')
+    assert schema._load_spec('other-process', 7, {'ZXX': zxx}, (), 'remote') is received
+    del received
+    gc.collect()
+    assert ('other-process', 7) not in schema._received
+    size, schema.LAYOUT_CACHE_SIZE = schema.LAYOUT_CACHE_SIZE, 2
+    try:
+        for delims in ('|^&~\\', '#^&~\\', '!^&~\\', '|^&~\\'):
+            assert get_layout('PID', list(delims), spec=hl7fields).child_delim == delims[0]
+        assert len(schema._layout_cache) == 2
+    finally:
+        schema.LAYOUT_CACHE_SIZE = size
+
+
+def test_emitter():
+    message = parse(reverse_rep_ch(DATA))
+    segments = []
+    stack = list(reversed(message._base.child_segments))
+    while stack:
+        segment = stack.pop()
+        segments.append((segment.code, segment.data))
+        stack.extend(reversed(segment.child_segments))
+    for code, data in segments:
+        emitted = compile_emitter(code)(data)
+        assert Segment(emitted).data == data, code
+        assert not emitted.endswith('|') and not emitted.endswith('^'), emitted
+    assert parse(emit_message(segments)).ORC.OBR.OBX_list[1].obs_results.data == \
+        message.ORC.OBR.OBX_list[1].obs_results.data
+
+    pid = compile_emitter('PID')
+    assert pid is compile_emitter('PID')
+    gc.collect()
+    before = len(emit._emitters)
+    site = DEFAULT_SPEC.overlay({'ZXX': {'subfields': [{'code': 'code', 'data_type': 'string'},
+                                                       {'code': 'when', 'data_type': 'timestamp'}]}})
+    zxx = compile_emitter('ZXX', site)
+    when = datetime.datetime(2012, 10, 18, 7, 26)
+    assert zxx({'when': when}) == 'ZXX|' + parser._to_str('timestamp', when)
+    assert len(emit._emitters) == before + 1
+    del site, zxx
+    gc.collect()
+    assert len(emit._emitters) == before, "Emitters should go away with their Spec."
+    data = {'set_id': 1, 'pat_name': {'family_name': 'Doe', 'given_name': 'Jane'},
+            'date_of_birth': datetime.date(1980, 1, 2)}
+    assert pid(data) == 'PID|1||||Doe^Jane||19800102'
+    assert Segment(pid(data)).data == Segment(Segment(code='PID', data=dict(data)).hl7).data
+    assert 'code' not in data
+    try:
+        pid({'code': 'OBX'})
+        assert False, "A 'code' that doesn't match the segment must be rejected."
+    except ValueError:
+        pass
+
+
+def test_batch_writer():
+    raw = reverse_rep_ch(DATA).strip()
+    messages = [parse(raw), raw.replace('0417', '0418'), raw.replace('0417', '0419').encode('ascii')]
+    out = io.BytesIO()
+    with BatchWriter(out, header={'send_app': 'ANKHOS'}, batch_size=2, buffer_size=100,
+                     compress=True) as writer:
+        writer.write_many(messages)
+    assert (writer.message_count, writer.batch_count) == (3, 2)
+
+    written = gzip.GzipFile(fileobj=io.BytesIO(out.getvalue())).read()
+    segments = written.decode('ascii').split(CR)
+    assert segments[0].startswith('FHS|^~\\&|ANKHOS|') and segments[1].startswith('BHS|^~\\&|')
+    envelope = [s if s[:3] != 'BHS' else 'BHS' for s in segments if s[:3] in ('BHS', 'BTS', 'FTS')]
+    assert envelope == ['BHS', 'BTS|2', 'BHS', 'BTS|1', 'FTS|2'] and segments[-1] == ''
+    read = list(iter_raw_messages(io.BytesIO(written)))
+    assert [parse(m).MSH.msg_ctl_id.data for m in read] == ['0417', '0418', '0419']
+    assert read[0] == messages[0]._base.get_as_str().encode('ascii')
+
+    out = io.BytesIO()
+    with BatchWriter(out, envelope=False) as writer:
+        writer.write(raw)
+    assert out.getvalue() == raw.encode('ascii') + b'\r'
+
+    if bytes is not str:
+        #Each message is encoded with its own MSH-18 charset.
+        utf8 = raw.replace('|P|2.3', '|P|2.3||||||UNICODE UTF-8', 1).replace('Test', '\u5f20')
+        big5 = raw.replace('|P|2.3', '|P|2.3||||||BIG-5', 1).replace('Test', '\u30c6')
+        out = io.BytesIO()
+        with BatchWriter(out) as writer:
+            writer.write_many([utf8, parse(utf8.encode('utf-8')), parse(big5.encode('big5')),
+                               raw.replace('Test', 'T\u00e9st')])
+        read = list(iter_raw_messages(io.BytesIO(out.getvalue())))
+        names = [parse(m).PID.pat_name.family_name.data for m in read]
+        assert names == ['\u5f20', '\u5f20', '\u30c6', 'T\u00e9st']
+        try:
+            BatchWriter(io.BytesIO(), header={'send_app': '\u5f20'})
+            assert False, "An FHS that can't be encoded must be rejected."
+        except ValueError:
+            pass
+        out = io.BytesIO()
+        BatchWriter(out, header={'send_app': '\u5f20'}, encoding='utf-8').close()
+        assert out.getvalue().startswith('FHS|^~\\&|\u5f20|'.encode('utf-8'))
+
+
+def test_archive_index():
+    raw = reverse_rep_ch(DATA).strip()
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'archive.hl7')
+        with open(path, 'wb') as f:
+            f.write(('FHS|^~\\&|LAB\nBHS|^~\\&|LAB\n' + raw + '\n' +
+                     raw.replace('0417', '0418').replace('112233', '555') +
+                     '\nBTS|2\nFTS|1\n').encode('ascii'))
+        archive = Archive(path)
+        assert len(archive) == 2 and os.path.exists(path + INDEX_SUFFIX)
+        entry, = archive.find(msg_ctl_id='0418')
+        assert (entry.msg_type, entry.timestamp, entry.patient_ids) == \
+            ('ORU^R01', '201210180743', ('555',))
+        assert archive.read(entry) == \
+            raw.replace('0417', '0418').replace('112233', '555').encode('ascii')
+        assert archive.parse(entry).PID.pat_id_int.data == '555'
+        assert [e.msg_ctl_id for e in archive.find(timestamp='20121018')] == ['0417', '0418']
+        assert len(archive.find(mrn='112233')) == 1 and archive.find(mrn='555', msg_type='ADT^A08') == []
+
+        with open(path, 'ab') as f:
+            f.write((raw.replace('0417', '0419') + '\r').encode('ascii'))
+        reopened = Archive(path, update=False)
+        assert len(reopened) == 2 and reopened.update() == 1
+        assert [e.msg_ctl_id for e in reopened] == ['0417', '0418', '0419']
+        assert Archive(path).find(msg_ctl_id='0419')[0].length == len(raw)
+
+        with open(path, 'wb') as f:
+            f.write(raw.encode('ascii'))
+        assert [e.msg_ctl_id for e in Archive(path)] == ['0417']
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_pickle_and_clone():
+    raw = reverse_rep_ch(DATA)
+    for lazy in (False, True):
+        message = parse(raw, lazy=lazy)
+        message.PID.pat_name.family_name.data = 'Changed'
+        message.ORC.OBR.OBX_list[1].obs_id.label.data = 'Label'
+        state = message._pickle_state()
+        assert state[0] == raw and len(state[1]) >= 2 and (len(state[1]) == 2 or not lazy)
+        for restored in (pickle.loads(pickle.dumps(message)), copy.deepcopy(message),
+                         message.clone()):
+            assert restored.hl7 == message.hl7
+            assert restored.PID.pat_name.family_name.data == 'Changed'
+            assert restored.ORC.OBR.OBX_list[1].note == 'Results confirmed on\ndilution.'
+            restored.PID.pat_name.family_name.data = 'Again'
+            assert message.PID.pat_name.family_name.data == 'Changed'
+        assert len(pickle.dumps(message, 2)) < len(raw) * 2
+
+    unchanged = parse(raw, lazy=True)
+    assert unchanged._pickle_state()[1] == ()
+    site = DEFAULT_SPEC.overlay({}, name='site')
+    restored = pickle.loads(pickle.dumps(parse(raw, spec=site, custom_levels={'ZPS': 1})))
+    assert restored._config.spec is site and restored._config.custom_levels == {'ZPS': 1}
+
+    built = Message()
+    built.add_segment(Segment(code='PID', data={'pat_id_int': '42'}))
+    assert pickle.loads(pickle.dumps(built)).PID.pat_id_int.data == '42'
+
+    obr = parse(raw).ORC.OBR
+    for restored in (pickle.loads(pickle.dumps(obr)), copy.deepcopy(obr), obr.clone()):
+        assert [s.code for s in restored.child_segments] == ['OBX'] * 4
+        assert restored.OBX_list[1].note == obr.OBX_list[1].note
+        assert restored.hl7 == obr.hl7
+
+
+def test_parser_config():
+    raw = reverse_rep_ch(DATA)
+    parser = Parser(custom_levels={'OBR': 1, 'OBX': 2})
+    config = parser.config
+    assert config.levels['OBR'] == 1 and LEVELS['OBR'] == 2
+    for message in (parser.parse(raw), parser(raw.encode('ascii'))):
+        assert [s.code for s in message.OBR.child_segments] == ['OBX'] * 4
+    assert parser.parse(raw).hl7 == parse(raw, {'OBR': 1, 'OBX': 2}).hl7
+    assert parser.parse(raw, lazy=True).OBR.OBX_list[1].note == 'Results confirmed on\ndilution.'
+    for attempt in (lambda: setattr(config, 'lazy', True),
+                    lambda: config.levels.update({'PID': 2})):
+        try:
+            attempt()
+        except (AttributeError, TypeError):
+            pass
+        else:
+            assert False, "ParserConfig should be immutable"
+    for options in ({'custom_levels': {'OBR': 'one'}}, {'custom_levels': {'OBR': -1}},
+                    {'delims': '||^~&'}, {'z_segments': 'ignore'}):
+        try:
+            ParserConfig(**options)
+        except ValueError:
+            pass
+        else:
+            assert False, "%r should be rejected" % (options,)
+
+    lazy = config.replace(lazy=True)
+    assert lazy.lazy and not config.lazy and lazy.levels == config.levels
+    assert pickle.loads(pickle.dumps(lazy)).levels == lazy.levels
+
+    site = DEFAULT_SPEC.overlay({'ZXX': {'subfields': [{'code': 'code'}]}})
+    feed = CR.join([raw.split(CR)[0], 'ZXX|1', 'PID|1||42'])
+    assert parse(feed, spec=site).ZXX.PID.pat_id_int.data == '42'
+    assert Parser(spec=site, z_segments='top').parse(feed).PID.pat_id_int.data == '42'
+    try:
+        Parser(spec=site, z_segments='strict').parse(feed)
+    except AssertionError as e:
+        assert 'ZXX' in str(e)
+    else:
+        assert False, "ZXX has no level"
+    strict = Parser(spec=site, z_segments='strict', custom_levels={'ZXX': 2}).parse(feed)
+    assert [s.code for s in strict.MSH.child_segments] == ['ZXX']
+
+    pid = 'PID|1||4' + VT + '2'
+    assert Parser(remove_vt=False).parse(pid).PID.pat_id_int.data == '4' + VT + '2'
+    assert parse(pid).PID.pat_id_int.data == '42'
+    assert Parser(delims='#^&~\\').parse('PID#1##42').PID.pat_id_int.data == '42'
+
+
 if __name__ == '__main__':
     run()
+    test_compiled_layouts()
+    test_lazy_parse()
+    test_dtm_codec()
+    test_iter_messages()
+    test_mllp_decoder()
+    test_mllp_loopback()
+    test_make_ack()
+    test_child_segment_index()
+    test_compact_nodes()
+    test_scanner()
+    test_parse_many()
+    test_benchmark()
+    test_hl7_cache()
+    test_extract_paths()
+    test_columnar_export()
+    test_parse_bytes()
+    test_intern_pool()
+    test_parse_cache()
+    test_segment_parents()
+    test_instrument()
+    test_spec_overlay()
+    test_emitter()
+    test_batch_writer()
+    test_archive_index()
+    test_pickle_and_clone()
+    test_parser_config()
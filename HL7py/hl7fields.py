@@ -31,6 +31,43 @@ FTS =  {'subfields': [{'code': 'code', 'data_type': 'string'},
                       {'code': 'trailer_comment', 'data_type': 'string'},]
 }
 
+#File header segment 2.15.6. As with MSH, the field separator itself isn't a field.
+FHS =  {'subfields': [{'code': 'code', 'data_type': 'string'},
+                      {'code': 'encoding_chars', 'data_type': 'string'},
+                      {'code': 'send_app', 'data_type': 'string'},
+                      {'code': 'send_fac', 'data_type': 'string'},
+                      {'code': 'recv_app', 'data_type': 'string'},
+                      {'code': 'recv_fac', 'data_type': 'string'},
+                      {'code': 'timestamp', 'data_type': 'timestamp'},
+                      {'code': 'security', 'data_type': 'string'},
+                      {'code': 'file_name', 'data_type': 'string'},
+                      {'code': 'header_comment', 'data_type': 'string'},
+                      {'code': 'file_ctl_id', 'data_type': 'string'},
+                      {'code': 'ref_file_ctl_id', 'data_type': 'string'},]
+}
+
+#Batch header segment 2.15.2
+BHS =  {'subfields': [{'code': 'code', 'data_type': 'string'},
+                      {'code': 'encoding_chars', 'data_type': 'string'},
+                      {'code': 'send_app', 'data_type': 'string'},
+                      {'code': 'send_fac', 'data_type': 'string'},
+                      {'code': 'recv_app', 'data_type': 'string'},
+                      {'code': 'recv_fac', 'data_type': 'string'},
+                      {'code': 'timestamp', 'data_type': 'timestamp'},
+                      {'code': 'security', 'data_type': 'string'},
+                      {'code': 'batch_name', 'data_type': 'string'},
+                      {'code': 'header_comment', 'data_type': 'string'},
+                      {'code': 'batch_ctl_id', 'data_type': 'string'},
+                      {'code': 'ref_batch_ctl_id', 'data_type': 'string'},]
+}
+
+#Batch trailer segment 2.15.3
+BTS =  {'subfields': [{'code': 'code', 'data_type': 'string'},
+                      {'code': 'batch_msg_count', 'data_type': 'string'},
+                      {'code': 'trailer_comment', 'data_type': 'string'},
+                      {'code': 'batch_totals', 'data_type': 'string'},]
+}
+
 
 IN2 =  {'subfields': [{'code': 'code', 'data_type': 'string'},
                       {'code': 'insured_employee_id','data_type': 'string'},
@@ -122,6 +159,9 @@ IN2 =  {'subfields': [{'code': 'code', 'data_type': 'string'},
 
 
 hl7fields = {'FTS':FTS,
+             'FHS': FHS,
+             'BHS': BHS,
+             'BTS': BTS,
              'EVN': {'subfields': [{'code': 'code', 'data_type': 'string'},
                                       {'code': 'event_code', 'data_type': 'string'},
                                       {'code': 'timestamp',
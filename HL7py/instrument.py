@@ -0,0 +1,155 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Optional timing and counters for the parser, for finding out where a slow feed spends
+its time.
+
+    from HL7py import instrument
+    profiler = instrument.enable()
+    ...
+    metrics.push(profiler.stats())
+
+While enabled, the profiler records
+
+- the time spent and number of calls per stage: 'split' (cleaning lines and working out
+  the segment hierarchy in parse()), 'build' (creating Segments and their Nodes),
+  'coerce' (converting field values to their data type, e.g. parsing timestamps; for
+  eager parses this time is also part of 'build') and 'serialize' (.hl7 of a Message,
+  Segment or Node, and Segment.get_as_str()),
+- the build time and number of segments per segment code,
+- a histogram of parse() latency per message type (MSH-9, e.g. 'ORU^R01'), and
+- the number of values that could not be coerced to their field's data type, per field.
+
+Segments parsed with lazy=True split their fields when they are first read, so only the
+creation of the segment counts as build time, and coercion is timed and its failures
+counted on access.
+
+When disabled (the default) the parser only checks that the module's profiler is None.
+Profilers are not locked; share one between threads only if approximate counts will do.
+"""
+import bisect
+from timeit import default_timer as clock
+
+#Upper bounds, in seconds, of the parse latency histogram buckets. Latencies above the
+#last bound are counted in a final overflow bucket.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0)
+
+STAGES = ('split', 'build', 'coerce', 'serialize')
+
+#The profiler used by the parser, or None when profiling is off.
+profiler = None
+
+
+class Profiler(object):
+    """
+    Per-stage timings, per-segment-code counters, parse latency histograms and coercion
+    failure counts. If callback is given it is called as callback(stage, key, seconds)
+    for every timing recorded, where key is the segment code for 'build', the message type
+    for 'parse', the field name for 'coerce' and None otherwise.
+    """
+    def __init__(self, callback=None, buckets=LATENCY_BUCKETS):
+        self.callback = callback
+        self.buckets = tuple(buckets)
+        self.clear()
+
+    def clear(self):
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.stage_calls = dict.fromkeys(STAGES, 0)
+        self.segment_seconds = {}
+        self.segment_counts = {}
+        self.latency = {}           #message type -> bucket counts
+        self.latency_seconds = {}   #message type -> total seconds
+        self.coercion_failures = {}
+
+    def stage(self, stage, seconds, key=None):
+        """
+        Record `seconds` spent in one call of `stage`.
+        """
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+        self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+        if self.callback is not None:
+            self.callback(stage, key, seconds)
+
+    def segment(self, code, seconds):
+        """
+        Record the build of one segment.
+        """
+        self.segment_seconds[code] = self.segment_seconds.get(code, 0.0) + seconds
+        self.segment_counts[code] = self.segment_counts.get(code, 0) + 1
+        if self.callback is not None:
+            self.callback('build', code, seconds)
+
+    def message(self, msg_type, seconds):
+        """
+        Record the total parse() time of one message of type msg_type.
+        """
+        counts = self.latency.get(msg_type)
+        if counts is None:
+            counts = self.latency[msg_type] = [0] * (len(self.buckets) + 1)
+            self.latency_seconds[msg_type] = 0.0
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.latency_seconds[msg_type] += seconds
+        if self.callback is not None:
+            self.callback('parse', msg_type, seconds)
+
+    def coercion_failed(self, field, data_type):
+        key = '%s:%s' % (field, data_type)
+        self.coercion_failures[key] = self.coercion_failures.get(key, 0) + 1
+
+    def stats(self):
+        """
+        Everything recorded so far as plain dicts, lists and numbers. Histogram bucket
+        bounds are given as strings ('0.001', ..., '+Inf').
+        """
+        bounds = ['%g' % (bound,) for bound in self.buckets] + ['+Inf']
+        return {
+            'stages': dict((stage, {'seconds': seconds, 'calls': self.stage_calls[stage]})
+                           for stage, seconds in self.stage_seconds.items()),
+            'segments': dict((code, {'seconds': seconds, 'count': self.segment_counts[code]})
+                             for code, seconds in self.segment_seconds.items()),
+            'parse_latency': dict((msg_type, {'buckets': dict(zip(bounds, counts)),
+                                              'count': sum(counts),
+                                              'seconds': self.latency_seconds[msg_type]})
+                                  for msg_type, counts in self.latency.items()),
+            'coercion_failures': dict(self.coercion_failures),
+        }
+
+
+def enable(callback=None, buckets=LATENCY_BUCKETS):
+    """
+    Turn profiling on for everything parsed from now on and return the profiler.
+    """
+    global profiler
+    profiler = Profiler(callback, buckets)
+    return profiler
+
+
+def disable():
+    """
+    Turn profiling off. The profiler returned by enable() keeps what it recorded.
+    """
+    global profiler
+    profiler = None
@@ -0,0 +1,130 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Optional interning of field values. Lab feeds repeat the same few values (units, value
+types, result statuses, facility and provider codes) across millions of segments; with
+interning on, every parsed copy of such a value is the same object, which cuts the
+memory held by long-lived collections of parsed messages.
+
+    from HL7py import intern
+    pool = intern.enable(max_size=100000)
+    ...
+    pool.stats()
+
+Values are pooled per field name, data type and encoding, and the least recently used
+entries are dropped once the pool is full. The pool is shared by all threads; lookups
+and evictions hold a lock, but values are converted outside of it.
+"""
+import collections
+import threading
+
+#Entries kept by a pool created with enable().
+MAX_SIZE = 65536
+
+#The pool used by the parser, or None when interning is off.
+pool = None
+
+
+class InternPool(object):
+    """
+    Bounded LRU map from (field, data type, encoding, raw text) to the pooled raw text
+    and its converted value.
+    """
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def leaf(self, layout, raw, convert):
+        """
+        Return (raw, value) for a leaf field, where value is convert(layout, raw). Both
+        are shared with every earlier lookup of the same text for the same kind of field.
+        """
+        key = (layout.code, layout.data_type, layout.encoding, raw)
+        entries = self._entries
+        with self._lock:
+            entry = entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                _move_to_end(entries, key, entry)
+                return entry
+            self.misses += 1
+        value = convert(layout, raw)
+        with self._lock:
+            #Another thread may have added the same text while this one converted it.
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = (raw, value)
+                if len(entries) > self.max_size:
+                    entries.popitem(last=False)
+                    self.evictions += 1
+        return entry
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hit_rate()}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+if hasattr(collections.OrderedDict, 'move_to_end'):
+    def _move_to_end(entries, key, entry):
+        entries.move_to_end(key)
+else:
+    def _move_to_end(entries, key, entry):
+        del entries[key]
+        entries[key] = entry
+
+
+def enable(max_size=MAX_SIZE):
+    """
+    Turn interning on for everything parsed from now on and return the pool.
+    """
+    global pool
+    pool = InternPool(max_size)
+    return pool
+
+
+def disable():
+    """
+    Turn interning off. Values already parsed keep sharing their objects.
+    """
+    global pool
+    pool = None
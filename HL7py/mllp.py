@@ -0,0 +1,359 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+MLLP (Minimal Lower Layer Protocol) transport. Each HL7 message on the wire is framed as
+
+    <VT> message <FS><CR>
+
+MLLPDecoder turns a stream of received bytes back into frames and can be used with any
+socket code. The asyncio server and client below are built on it and need Python 3.4+.
+"""
+import collections
+import logging
+from HL7py.constants import CR, FS, VT
+from HL7py.parser import parse, decode_message, encode_message, get_message_encoding
+from HL7py.ack import make_ack
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+logger = logging.getLogger(__name__)
+
+START_BLOCK = VT.encode('ascii')
+END_BLOCK = FS.encode('ascii')
+TRAILER = (FS + CR).encode('ascii')
+
+#Well-known MLLP port.
+DEFAULT_PORT = 2575
+#Text encoding for messages that don't name a character set in MSH-18.
+DEFAULT_ENCODING = 'latin-1'
+DEFAULT_MAX_FRAME_SIZE = 16 << 20
+#Frames being handled per connection before the connection stops reading.
+DEFAULT_MAX_PENDING = 32
+
+
+class MLLPError(Exception):
+    pass
+
+
+def encode_frame(message, encoding=DEFAULT_ENCODING):
+    """
+    Wrap a message (text or bytes) in an MLLP frame and return it as bytes.
+    """
+    if not isinstance(message, bytes):
+        message = message.encode(encoding)
+    return START_BLOCK + message + TRAILER
+
+
+class MLLPDecoder(object):
+    """
+    Incremental MLLP frame decoder. feed() takes whatever bytes were received and returns
+    the payloads of the frames completed by them. Bytes outside of a frame (such as the
+    CR after FS) are discarded. A single buffer is reused for the life of the decoder,
+    and the search for the end of a frame resumes where the last one stopped, so a large
+    frame arriving in many small reads is only scanned once.
+    """
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray()
+        #Offset in _buf of the VT that opened the current frame, or -1.
+        self._start = -1
+        #Offset in _buf to resume searching for FS from.
+        self._scanned = 0
+
+    def feed(self, data):
+        buf = self._buf
+        buf.extend(data)
+        frames = []
+        consumed = 0
+        while True:
+            if self._start < 0:
+                start = buf.find(START_BLOCK, consumed)
+                if start < 0:
+                    #Nothing but noise left; drop it.
+                    consumed = len(buf)
+                    break
+                self._start = start
+                self._scanned = start + 1
+            end = buf.find(END_BLOCK, self._scanned)
+            if end < 0:
+                self._scanned = len(buf)
+                if self._scanned - self._start > self.max_frame_size:
+                    self.reset()
+                    raise MLLPError("MLLP frame larger than %d bytes." % (self.max_frame_size,))
+                consumed = self._start
+                break
+            frames.append(bytes(buf[self._start + 1:end]))
+            consumed = end + 1
+            self._start = -1
+
+        if consumed:
+            del buf[:consumed]
+            if self._start >= 0:
+                self._start -= consumed
+                self._scanned -= consumed
+        return frames
+
+    def reset(self):
+        del self._buf[:]
+        self._start = -1
+        self._scanned = 0
+
+    @property
+    def buffered(self):
+        """Number of bytes waiting for the rest of their frame."""
+        return len(self._buf)
+
+
+def _is_awaitable(obj):
+    return asyncio.iscoroutine(obj) or isinstance(obj, asyncio.Future) or \
+        hasattr(obj, '__await__')
+
+
+class _MLLPProtocol(asyncio.Protocol if asyncio else object):
+    """
+    Frame decoding and flow control shared by the server and client protocols, which
+    define frame_received(frame). Reading is paused while the transport's write buffer
+    is full.
+
+    With `encoding` None (the default) text is encoded and decoded with the character set
+    in the message's MSH-18; otherwise that codec is used for every message.
+    """
+    def __init__(self, encoding=None, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.encoding = encoding
+        self.decoder = MLLPDecoder(max_frame_size)
+        self.transport = None
+        self.loop = None
+        self._writing_paused = False
+        self._reading_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_event_loop()
+
+    def data_received(self, data):
+        try:
+            frames = self.decoder.feed(data)
+        except MLLPError:
+            logger.exception("Closing MLLP connection.")
+            self.transport.close()
+            return
+        for frame in frames:
+            self.frame_received(frame)
+
+    def pause_writing(self):
+        self._writing_paused = True
+        self._update_reading()
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._update_reading()
+
+    def _should_pause_reading(self):
+        return self._writing_paused
+
+    def _update_reading(self):
+        if self.transport is None or self.transport.is_closing():
+            return
+        pause = self._should_pause_reading()
+        if pause and not self._reading_paused:
+            self.transport.pause_reading()
+        elif not pause and self._reading_paused:
+            self.transport.resume_reading()
+        self._reading_paused = pause
+
+    def _decode(self, frame):
+        if self.encoding is None:
+            return decode_message(frame)
+        return frame.decode(self.encoding)
+
+    def _encode(self, message, frame=None):
+        """
+        MLLP frame for a message; text with an empty MSH-18 gets the character set of
+        `frame`, the message it answers.
+        """
+        if self.encoding is not None:
+            return encode_frame(message, self.encoding)
+        if isinstance(message, bytes):
+            return encode_frame(message)
+        default = get_message_encoding(frame) if frame is not None else None
+        return encode_frame(encode_message(message, default))
+
+
+class MLLPServerProtocol(_MLLPProtocol):
+    """
+    One inbound MLLP connection. Each frame is passed through `parser` (parse() by
+    default; None hands the handler the message itself) and then to `handler`. Frames
+    stay bytes unless `encoding` is given, so parse() decodes them with their MSH-18
+    character set.
+
+    The handler returns the reply to send back (text, bytes, or None for no reply) or an
+    awaitable that resolves to one. If parsing or the handler fails, or a text reply
+    can't be encoded, an AE acknowledgement is sent instead. Replies are written in the order the frames arrived.
+    When `max_pending` frames are still being handled, or the peer is not reading its
+    replies, the connection stops reading until it catches up.
+    """
+    def __init__(self, handler, parser=parse, encoding=None,
+                 max_pending=DEFAULT_MAX_PENDING, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        _MLLPProtocol.__init__(self, encoding, max_frame_size)
+        self.handler = handler
+        self.parser = parser
+        self.max_pending = max_pending
+        self._pending = collections.deque()
+
+    def frame_received(self, frame):
+        try:
+            message = frame if self.encoding is None else frame.decode(self.encoding)
+            if self.parser is not None:
+                message = self.parser(message)
+            reply = self.handler(message)
+        except Exception:
+            logger.exception("MLLP handler failed.")
+            reply = _nak(frame)
+        if _is_awaitable(reply):
+            reply = asyncio.ensure_future(reply, loop=self.loop)
+            self._pending.append((reply, frame))
+            reply.add_done_callback(self._reply_done)
+            self._update_reading()
+        elif self._pending:
+            #Keep replies in order behind the ones still being worked on.
+            future = self.loop.create_future()
+            future.set_result(reply)
+            self._pending.append((future, frame))
+            self._update_reading()
+        else:
+            self._write(reply, frame)
+
+    def _reply_done(self, future):
+        pending = self._pending
+        while pending and pending[0][0].done():
+            done, frame = pending.popleft()
+            if done.cancelled():
+                continue
+            if done.exception() is not None:
+                logger.error("MLLP handler failed.", exc_info=done.exception())
+                self._write(_nak(frame), frame)
+                continue
+            self._write(done.result(), frame)
+        self._update_reading()
+
+    def _write(self, reply, frame):
+        if reply is None or self.transport is None or self.transport.is_closing():
+            return
+        try:
+            data = self._encode(reply, frame)
+        except (UnicodeError, ValueError):
+            logger.exception("Cannot encode MLLP reply.")
+            reply = _nak(frame)
+            if reply is None:
+                return
+            data = encode_frame(reply)
+        self.transport.write(data)
+
+    def _should_pause_reading(self):
+        return self._writing_paused or len(self._pending) >= self.max_pending
+
+    def connection_lost(self, exc):
+        for future, frame in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self.transport = None
+
+
+def _nak(frame):
+    """
+    AE acknowledgement for a frame that could not be handled, or None if the frame has no
+    MSH segment to acknowledge.
+    """
+    try:
+        return make_ack(frame, 'AE')
+    except ValueError:
+        logger.warning("Cannot acknowledge an MLLP frame without an MSH segment.")
+        return None
+
+
+class MLLPClientProtocol(_MLLPProtocol):
+    """
+    Outbound MLLP connection. send() frames a message and returns a future for the
+    reply, decoded as text; replies are matched to requests in the order they were sent.
+    If a request's future is cancelled (e.g. by a timeout), its reply is discarded when
+    it arrives, so later replies still reach their own requests.
+    """
+    def __init__(self, encoding=None, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        _MLLPProtocol.__init__(self, encoding, max_frame_size)
+        self._waiting = collections.deque()
+
+    def send(self, message):
+        if self.transport is None or self.transport.is_closing():
+            raise MLLPError("MLLP connection is closed.")
+        data = self._encode(message)
+        future = self.loop.create_future()
+        self._waiting.append(future)
+        self.transport.write(data)
+        return future
+
+    def frame_received(self, frame):
+        if not self._waiting:
+            logger.warning("Discarding unexpected MLLP reply.")
+            return
+        future = self._waiting.popleft()
+        if not future.done():
+            future.set_result(self._decode(frame))
+
+    def connection_lost(self, exc):
+        while self._waiting:
+            future = self._waiting.popleft()
+            if not future.done():
+                future.set_exception(exc or MLLPError("MLLP connection closed."))
+        self.transport = None
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+def start_server(handler, host=None, port=DEFAULT_PORT, loop=None, backlog=1024, **kwargs):
+    """
+    Return a coroutine that starts listening for MLLP connections and resolves to the
+    asyncio Server. Extra keyword arguments (parser, encoding, max_pending,
+    max_frame_size) are passed to MLLPServerProtocol. All connections are served by the
+    one event loop.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    return loop.create_server(lambda: MLLPServerProtocol(handler, **kwargs),
+                              host, port, backlog=backlog)
+
+
+def open_connection(host, port=DEFAULT_PORT, loop=None, **kwargs):
+    """
+    Return a coroutine that connects to an MLLP listener and resolves to a
+    (transport, MLLPClientProtocol) pair. Keyword arguments go to MLLPClientProtocol.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    return loop.create_connection(lambda: MLLPClientProtocol(**kwargs), host, port)
@@ -22,13 +22,26 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 
 """
+from __future__ import print_function
+import codecs
 import pprint
 import HL7py.constants as constants
 from HL7py.constants import *
 from HL7py.hl7fields import hl7fields as hl7fieldspec
+from HL7py.schema import Layout, Spec, DEFAULT_SPEC, compile_layout, get_layout, _FrozenDict
+from HL7py.dtm import parse_dtm, parse_dt, format_dtm, format_dt
+from HL7py import intern
+from HL7py import instrument
 from HL7py.test_messages import *
 import datetime
 
+#On Python 3, bytes input takes the bytes parsing path (on Python 2 bytes is str).
+_binary_type = bytes if bytes is not str else None
+_BYTES_CR = CR.encode('ascii')
+_BYTES_LF = LF.encode('ascii')
+_BYTES_VT = VT.encode('ascii')
+_BYTES_FS = FS.encode('ascii')
+
 
 
 def rep_ch(s):
@@ -55,37 +68,27 @@ def _to_data(data_type, val):
     """
     Attempt to coerce the value to the correct data type.
     """
-    #TODO: Clean up time parsing.
-
     if data_type.strip() == 'string':
         return str(val)
     if not val:
         return None
     if data_type.strip() == 'timestamp':
+        if isinstance(val, datetime.date):
+            return val
         try:
-            trial = datetime.datetime.strptime(val, constants.MINUTE_TIME_FORMAT)
-            return trial
-        except ValueError, e:
-            try:
-                trial = datetime.datetime.strptime(val, constants.SECOND_TIME_FORMAT)
-                return trial
-            except ValueError,e2:
-                try:
-                    trial = datetime.datetime.strptime(val, '%Y%m%d %H:%M:%S')
-                    return trial
-                except ValueError,e2:
-                    return val
-        except TypeError:
+            trial = parse_dtm(val)
+        except (TypeError, AttributeError):
             return val
-
+        if trial is None:
+            return val
+        return trial
 
     elif data_type.strip() == 'date':
+        if isinstance(val, datetime.date):
+            return val
         try:
-            trial = datetime.datetime.strptime(val, constants.DATE_TIME_FORMAT)
-            return trial
-        except ValueError, e:
-            return None
-        except TypeError:
+            return parse_dt(val)
+        except (TypeError, AttributeError):
             return val
     elif data_type == 'number':
         try:
@@ -99,15 +102,12 @@ def _to_data(data_type, val):
 def _to_str(data_type, val):
     if data_type == 'timestamp':
         try:
-            return datetime.datetime.strftime(val, constants.MINUTE_TIME_FORMAT)
-
-        except TypeError, te:
-            if val == '':
-                return ''
+            return format_dtm(val)
+        except (TypeError, AttributeError):
             return ''
     elif data_type == 'date':
         try:
-            return datetime.date.strftime(val, constants.DATE_TIME_FORMAT)
+            return format_dt(val)
         except:
             return ''
     else:
@@ -116,6 +116,78 @@ def _to_str(data_type, val):
         return str(val)
 
 
+def _decode(layout, raw):
+    """
+    Text of a raw value for a node parsed from bytes; text passes through unchanged.
+    """
+    if layout.encoding is not None and isinstance(raw, bytes):
+        return raw.decode(layout.encoding, 'replace')
+    return raw
+
+
+def _encode(layout, text):
+    if layout.encoding is not None and not isinstance(text, bytes):
+        return text.encode(layout.encoding)
+    return text
+
+
+#Shared by every leaf node, instead of an empty list each.
+_NO_CHILDREN = ()
+
+
+def _leaf_value(layout, raw):
+    profiler = instrument.profiler
+    if profiler is None:
+        return _to_data(layout.data_type, _decode(layout, raw))
+    started = instrument.clock()
+    value = _to_data(layout.data_type, _decode(layout, raw))
+    profiler.stage('coerce', instrument.clock() - started, layout.code)
+    if _coercion_failed(layout.data_type, raw, value):
+        profiler.coercion_failed(layout.code, layout.data_type)
+    return value
+
+
+def _coerce(layout, value):
+    """
+    _to_data for a value already stored in a node, timed as the 'coerce' stage.
+    """
+    profiler = instrument.profiler
+    if profiler is None:
+        return _to_data(layout.data_type, value)
+    started = instrument.clock()
+    value = _to_data(layout.data_type, value)
+    profiler.stage('coerce', instrument.clock() - started, layout.code)
+    return value
+
+
+def _serialize(serialize, obj):
+    """
+    serialize(obj), timed as the 'serialize' stage. Node.hl7, Segment.hl7/get_as_str()
+    and Message.hl7 all come through here; inside them, nodes are joined with the
+    untimed Node._get_as_str.
+    """
+    profiler = instrument.profiler
+    if profiler is None:
+        return serialize(obj)
+    started = instrument.clock()
+    text = serialize(obj)
+    profiler.stage('serialize', instrument.clock() - started)
+    return text
+
+
+def _coercion_failed(data_type, raw, value):
+    """
+    Whether _to_data gave up on a non-empty value (returned None or the text instead of a
+    date, timestamp or number).
+    """
+    if not raw:
+        return False
+    data_type = data_type.strip()
+    if data_type in ('timestamp', 'date'):
+        return not isinstance(value, datetime.date)
+    return data_type == 'number' and value is None
+
+
 class Node(object):
     """
     Construct a skeleton of a node tree to be filled in later by hl7 string or by data
@@ -128,15 +200,96 @@ class Node(object):
     python-ized, e.g. The subfield "Family Name" has been translated to family_name when
     accessing the attribute.
     """
-    def __init__(self, code='',delims = DEFAULT_DELIMS, delim_idx = 0, data_type='string', subfields=[],):
+    __slots__ = ('_layout', '_value', '_raw', '_child_nodes', '_parent')
+
+    def __init__(self, code='',delims = DEFAULT_DELIMS, delim_idx = 0, data_type='string', subfields=[],
+                 layout=None):
+        if layout is None:
+            layout = compile_layout(code, data_type, subfields, delims, delim_idx)
+        self._parent = None
+        self._fill(layout)
+
+    @classmethod
+    def from_layout(cls, layout):
+        """
+        Build a node tree from a precompiled Layout (see schema.py) without going through
+        the spec dictionaries.
+        """
+        node = cls.__new__(cls)
+        node._parent = None
+        node._fill(layout)
+        return node
+
+    @classmethod
+    def lazy(cls, layout, raw, parent=None):
+        """
+        Build a node that only remembers its raw HL7 text. Nothing is split or converted
+        until the node's data or one of its named children is first accessed, and an
+        untouched node serializes back to exactly the text it was given.
+        """
+        node = cls.__new__(cls)
+        node._layout = layout
+        node._value = None
+        node._raw = raw
+        node._child_nodes = None
+        node._parent = parent
+        return node
+
+    def _materialize(self):
+        """
+        Split a lazy node's raw text into lazy children (or convert it, for a leaf). The
+        raw text stays on as the node's cached serialization until something changes.
+        """
+        layout = self._layout
+        raw = self._raw
+        if not layout.children:
+            if intern.pool is None:
+                self._value = _leaf_value(layout, raw)
+            else:
+                self._raw, self._value = intern.pool.leaf(layout, raw, _leaf_value)
+            self._child_nodes = _NO_CHILDREN
+            return
+
+        sub_vals = raw.split(layout.child_delim)
+        n_vals = len(sub_vals)
+        lazy = self.lazy
+        empty = raw[:0]
+        self._child_nodes = [lazy(child_layout, sub_vals[i] if i < n_vals else empty, self)
+                             for i, child_layout in enumerate(layout.children)]
+
+    def _fill(self, layout):
+        self._layout = layout
         self._value = None
-        self._data_type = data_type
-        self._child_delim = delims[delim_idx]
-        self._code = code
-        self._child_nodes = []
-        for sf_dict in subfields:
-            sf_dict.update({'delims':delims,'delim_idx':delim_idx + 1})
-            self.add_node(Node(**sf_dict))
+        self._raw = None
+        if not layout.children:
+            self._child_nodes = _NO_CHILDREN
+            return
+        cls = self.__class__
+        child_nodes = self._child_nodes = []
+        for child_layout in layout.children:
+            child = cls.__new__(cls)
+            child._parent = self
+            child._fill(child_layout)
+            child_nodes.append(child)
+
+    def __getattr__(self, attr_name):
+        # Children are not stored as instance attributes; their names are looked up in
+        # the shared layout, and lazy nodes are split on first access.
+        if attr_name.startswith('_'):
+            raise AttributeError(attr_name)
+        i = self._layout.index.get(attr_name)
+        if i is None:
+            raise AttributeError("%r has no field '%s'" % (self, attr_name))
+        if self._child_nodes is None:
+            self._materialize()
+        return self._child_nodes[i]
+
+    def __dir__(self):
+        return sorted(set(dir(self.__class__)) | set(self._layout.index))
+
+    _code = property(lambda self: self._layout.code)
+    _data_type = property(lambda self: self._layout.data_type)
+    _child_delim = property(lambda self: self._layout.child_delim)
 
     def __repr__(self):
         return "<Node %s>" % (self._code,)
@@ -144,11 +297,28 @@ class Node(object):
 
     def add_node(self, node):
         """
-        Add a child node to this node and expose its code for attribute access.
+        Add a child node to this node and expose its code for attribute access. The node
+        gets its own copy of the layout, since compiled layouts are shared.
         """
-        self._child_nodes.append(node)
-        assert not node._code.startswith('_'), "Node names must not start with underscores."
-        setattr(self,node._code,node)
+        if self._child_nodes is None:
+            self._materialize()
+        self._invalidate()
+        layout = self._layout
+        self._layout = Layout(layout.code, layout.data_type, layout.delim_idx,
+                              layout.child_delim, layout.children + (node._layout,))
+        node._parent = self
+        self._child_nodes = list(self._child_nodes) + [node]
+
+    def _invalidate(self):
+        """
+        Forget the cached HL7 text of this node and of its ancestors, which all contain
+        it. A node is only ever cached if its children are, so the walk can stop at the
+        first ancestor that has nothing cached.
+        """
+        node = self
+        while node is not None and node._raw is not None:
+            node._raw = None
+            node = node._parent
 
     def set_from_str(self, s, delims=[], delim_idx=-1):
         """
@@ -161,17 +331,30 @@ class Node(object):
         as determined by the four characters in the message after MSH.
         """
 
+        s = _encode(self._layout, s)
+
+        #Lazy node, just swap in the new text.
+        if self._child_nodes is None:
+            self._invalidate()
+            self._raw = s
+            return
+
+        if self._raw is not None:
+            self._invalidate()
 
         #Leaf node
         if len(self._child_nodes) == 0:
-            self._value = _to_data(self._data_type, s)
+            if intern.pool is None:
+                self._value = _leaf_value(self._layout, s)
+            else:
+                self._value = intern.pool.leaf(self._layout, s, _leaf_value)[1]
             return
 
-        sub_vals = s.split(self._child_delim)
+        sub_vals = s.split(self._layout.child_delim)
         for i, node in enumerate(self._child_nodes):
             try:
                 node.set_from_str(sub_vals[i], delims, delim_idx + 1)
-            except IndexError, ie:
+            except IndexError as ie:
                 # This is the case where we have more nodes than values. This is OK per the
                 # HL7 specs so set them to ''. will result in something like
                 # ABC|1|3|3|7||||||||.
@@ -181,15 +364,20 @@ class Node(object):
 
     def _get_as_str(self):
         """
-        Returns the hl7 format of this node and all sub-nodes.
+        Returns the hl7 format of this node and all sub-nodes. The result is cached until
+        this node or one of its descendants is changed, so after a single edit only the
+        nodes on the path from the edited one up to the segment are joined again.
         """
+        raw = self._raw
+        if raw is not None:
+            return raw
         if not self._child_nodes:
-            return _to_str(self._data_type, self._value)
-
-        child_strs = []
-        for child in self._child_nodes:
-            child_strs.append(child._get_as_str())
-        return self._child_delim.join(child_strs)
+            raw = _encode(self._layout, _to_str(self._layout.data_type, self._value))
+        else:
+            raw = self._layout.child_delim.join([child._get_as_str()
+                                                 for child in self._child_nodes])
+        self._raw = raw
+        return raw
 
 
     def _set_from_data(self, args):
@@ -199,6 +387,10 @@ class Node(object):
         the tree has been constructed in an order specified by HL7Fields module.
         """
 
+        if self._child_nodes is None:
+            self._materialize()
+        if self._raw is not None:
+            self._invalidate()
 
         if args == None:
             self._value = None
@@ -214,14 +406,16 @@ class Node(object):
         for node in self._child_nodes:
             try:
                 node._set_from_data(args.get(node._code))
-            except Exception, e:
+            except Exception as e:
                 node._set_from_data(str(e))
 
 
     def _get_as_data(self):
         """Return the data for this node in list format (list of lists maybe)"""
+        if self._child_nodes is None:
+            self._materialize()
         if len(self._child_nodes) == 0:
-            return _to_data(self._data_type, self._value)
+            return _coerce(self._layout, self._value)
         else:
             sub_data = {}
             for node in self._child_nodes:
@@ -229,11 +423,16 @@ class Node(object):
             return sub_data
 
 
+    def _serialize(self):
+        return _serialize(Node._get_as_str, self)
+
     data = property(_get_as_data, _set_from_data)
-    hl7 = property(_get_as_str)
+    hl7 = property(_serialize)
 
     def fmt_tree(self, indent=''):
-        print indent + self._code + '|' + str(self._value)
+        if self._child_nodes is None:
+            self._materialize()
+        print(indent + self._code + '|' + str(self._value))
         indent += '  '
         for node in self._child_nodes:
             node.fmt_tree(indent)
@@ -255,14 +454,15 @@ class NTE():
         self._segments.append(NTE_line)
 
     def get_text(self):
-        return '\n'.join([seg.comment.hl7 for seg in self._segments])
+        return '\n'.join([_decode(seg.node._layout, seg.comment._get_as_str())
+                          for seg in self._segments])
 
 class Segment(object):
     """
     A segment is a line delimited by Carriage Return per HL7 specs. They begin with three
     upper-case characters and are separated by control characters, e.g.
 
-    MSH|^~\&|1100|BN|OPTX|BN002234|201210180743||ORU^R01|0417|P|2.3
+    MSH|^~\\&|1100|BN|OPTX|BN002234|201210180743||ORU^R01|0417|P|2.3
        ^
        This is the field separator specifier
 
@@ -271,8 +471,11 @@ class Segment(object):
     which we will use to access data from and parse each of these lines.
 
     """
+    __slots__ = ('_raw_text', 'code', 'child_segments', '_child_index', 'parent_seg', 'node',
+                 'NTE')
 
-    def __init__(self, raw_text = '',code = '', delims=delims, strict=False, data = {}):
+    def __init__(self, raw_text = '',code = '', delims=delims, strict=False, data = {},
+                 lazy=False, encoding=None, spec=DEFAULT_SPEC):
         '''
         A Segment can be constructed in two ways:
 
@@ -284,13 +487,23 @@ class Segment(object):
          of data whose attributes match all or a subset of nodes in the segment structure.
 
          The segment structure can be found in the HL7Fields.py file.
+
+        With lazy=True, a segment built from raw_text keeps the raw line and only splits
+        and converts the fields that are actually accessed. Fields that are never touched
+        are written back verbatim by .hl7.
+
+        raw_text may also be bytes, with bytes delims and the `encoding` to decode field
+        values with. Values are then decoded one field at a time as they are read, and
+        .hl7 returns bytes.
         '''
 
         if not strict:
             self._raw_text = raw_text.strip()
         else:
             self._raw_text = raw_text
-        self.code = self._raw_text.split(delims[0])[0]
+        self.code = self._raw_text.split(delims[0], 1)[0]
+        if encoding is not None:
+            self.code = self.code.decode('ascii')
 
         #Determine if we are creating this segment from HL7 text or from a dictionary.
         if not self._raw_text:
@@ -298,17 +511,23 @@ class Segment(object):
         if not self.code:
             raise ValueError("Unable to find code in specified message.")
         self.child_segments = []
+        self._child_index = {} #code -> child segments with that code, in order.
         self.parent_seg = None
         self.node = None
         self.NTE = ''
         if self.code == '___':
             return
 
-        if self.code not in hl7fieldspec:
+        layout = get_layout(self.code, delims, spec, encoding)
+        if layout is None:
             raise Exception("Message code not in specification: '%s'" % (self.code,))
 
-        self.node = Node(**hl7fieldspec.get(self.code))
-        if raw_text == '':
+        if lazy and raw_text:
+            self.node = Node.lazy(layout, raw_text)
+            return
+
+        self.node = Node.from_layout(layout)
+        if not raw_text:
             data_code = data.get('code')
             if self.code and\
                data_code and\
@@ -321,6 +540,22 @@ class Segment(object):
             delim_idx = 0
             self.node.set_from_str(raw_text, delims, delim_idx)
 
+    @classmethod
+    def lazy(cls, code, layout, raw_text):
+        """
+        Build a lazy segment from text that is already known to be a `code` segment
+        with the given compiled layout, skipping the checks in __init__.
+        """
+        seg = cls.__new__(cls)
+        seg._raw_text = raw_text
+        seg.code = code
+        seg.child_segments = []
+        seg._child_index = {}
+        seg.parent_seg = None
+        seg.node = Node.lazy(layout, raw_text)
+        seg.NTE = ''
+        return seg
+
     def add_to_NTE(self, NTE_line):
         """
         NTE segments are a special case. They always apply to the non-NTE segment that
@@ -344,7 +579,7 @@ class Segment(object):
 
         #this segment is always before its children.
         if self.node:
-            result = [self.node.hl7]
+            result = [self.node._get_as_str()]
         else:
             result = []
         for child in self.child_segments:
@@ -356,26 +591,40 @@ class Segment(object):
         Assemble list of strings generated by recursing through child segments and their
         subnodes.
         """
+        return _serialize(Segment._get_as_str, self)
+
+    def _get_as_str(self):
         hl7_list = self._get_recursive_hl7_list()
         if len(hl7_list) == 0:
             return ''
         elif len(hl7_list) == 1:
             return hl7_list[0]
-        return CR.join(hl7_list)
+        if isinstance(hl7_list[0], str):
+            return CR.join(hl7_list)
+        return _BYTES_CR.join(hl7_list)
 
     def __repr__(self):
         return self.code
 
     def add_child(self, segment):
+        """
+        Append a child segment. Always add children through here (rather than appending
+        to child_segments) so the per-code index used for attribute access stays current.
+        """
         segment.parent_seg = self
         self.child_segments.append(segment)
+        children = self._child_index.get(segment.code)
+        if children is None:
+            self._child_index[segment.code] = [segment]
+        else:
+            children.append(segment)
 
     def fmt_tree(self, indent=''):
         """
         Prints the tree format of this node and all of its sub-nodes. Useful for debugging.
         """
 
-        print indent, self.code
+        print(indent, self.code)
         for child in self.child_segments:
             child.fmt_tree(indent + '    ')
 
@@ -399,61 +648,125 @@ class Segment(object):
 
 
     def __getattr__(self, attr_name):
-        # If this segment was accessed like ORC.OBR.OBX_3, get the third
-        # OBX in this series.
-        if re_index_accessor.match(attr_name):
-            return self.child_segments[int(attr_name.split('_')[1])]
+        #Unset slots (e.g. while unpickling) must not be looked up as child segments.
+        if attr_name.startswith('_') or attr_name in _SEGMENT_SLOTS:
+            raise AttributeError(attr_name)
+        kind, code, n = _resolve_accessor(attr_name)
+        children = self._child_index.get(code)
+
+        # If this segment was accessed like ORC.OBR.OBX_3, get the OBX at index 3 of this
+        # series.
+        if kind is _INDEX_ACCESSOR:
+            if children is None:
+                raise IndexError("No %s segments." % (code,))
+            return children[n]
 
         # If this segment was accessed like ORC.OBR.OBX_list, get the list of OBX children.
-        elif re_list_accessor.match(attr_name):
-            result = []
-            for child in self.child_segments:
-                if child.code == attr_name.split('_list')[0]:
-                    result.append(child)
-            return result
+        # A new list, as before the index existed, so changing it can't corrupt the index.
+        elif kind is _LIST_ACCESSOR:
+            if children is None:
+                return []
+            return list(children)
 
         # Get the first child with matching segment code.
-        for child_seg in self.child_segments:
-            if child_seg.code == attr_name:
-                return child_seg
+        if children:
+            return children[0]
 
         # if there is no child segment of this code name, try going into the node which
         # contains the actual data of the segment.
         #if self.node:
         if attr_name == 'hl7':
+            hl7 = self.get_as_str()
+            if isinstance(hl7, str):
+                return VT + hl7 + FS + CR
+            return _BYTES_VT + hl7 + _BYTES_FS + _BYTES_CR
+        return getattr(self.node, attr_name)
+
+
+    def clone(self):
+        """
+        An independent copy of this segment and its children (see Message.clone).
+        """
+        return _build_segments(_segment_template(self, [], -1))[0]
+
+    def __reduce__(self):
+        #The segment texts and their layouts; nodes are rebuilt lazily.
+        return (_load_segment, (tuple(_segment_template(self, [], -1)),))
+
+    def __deepcopy__(self, memo):
+        return self.clone()
+
+
+_SEGMENT_SLOTS = frozenset(Segment.__slots__)
+
+_INDEX_ACCESSOR = 'index'
+_LIST_ACCESSOR = 'list'
+_NAME_ACCESSOR = 'name'
+_accessors = {}
+#Names remembered by _resolve_accessor. Attribute names can come from anywhere (e.g.
+#getattr() with names from a config file), so the memo must not grow without bound.
+ACCESSOR_CACHE_SIZE = 4096
 
-            return VT + self.get_as_str() + FS + CR
-        return self.node.__getattribute__(attr_name)
+
+def _resolve_accessor(attr_name):
+    """
+    Classify an attribute name as an OBX_3, OBX_list or plain OBX style accessor and
+    return (kind, segment code, index). The result is remembered for up to
+    ACCESSOR_CACHE_SIZE names, so the regular expressions only run once per distinct
+    name in the usual case.
+    """
+    accessor = _accessors.get(attr_name)
+    if accessor is None:
+        if re_index_accessor.match(attr_name):
+            code, n = attr_name.rsplit('_', 1)
+            accessor = (_INDEX_ACCESSOR, code, int(n))
+        elif re_list_accessor.match(attr_name):
+            accessor = (_LIST_ACCESSOR, attr_name[:-len('_list')], None)
+        else:
+            accessor = (_NAME_ACCESSOR, attr_name, None)
+        if len(_accessors) < ACCESSOR_CACHE_SIZE:
+            _accessors[attr_name] = accessor
+    return accessor
 
 
 class MultiMessage(object):
     """
     Parses a string that potentially has many Messages, separated by MSH. This class just
     abstracts out the parsing of MSH|(or whatever the field delimiter happens to be).
+
+    For large files use batch.iter_messages, which reads and parses one message at a time.
     """
-    def __init__(self,string, additional_fields = None):
-        #Add any custom fields to field parsing dict.
+    def __init__(self,string, additional_fields = None, lazy=False, spec=DEFAULT_SPEC):
+        #Add any custom fields on top of the spec, without changing it for anyone else.
         if additional_fields:
-            hl7fieldspec.update(additional_fields)
+            spec = spec.overlay(additional_fields)
+        parser = Parser(lazy=lazy, spec=spec)
         substrings = re_MSH_split.split(string)
         self.messages = []
         for i,substr in enumerate(substrings):
             if substr.strip() == '':
                 continue
-            self.messages.append(parse('MSH' + substr))
+            self.messages.append(parser.parse('MSH' + substr))
 
 class Message(object):
     """
     Message keeps track of the root Segment of the Segment/Node tree.
+
+    Messages can be pickled and deep-copied. A message is pickled as the text it was
+    parsed from, the fields that have been changed since and its ParserConfig; it is
+    parsed again lazily when loaded.
     """
-    def __init__(self,base = None,raw_text=''):
+    def __init__(self,base = None,raw_text='', config=None):
         if not base:
             self._base = Segment('___|NONE')
         else:
             self._base = base
         self.raw_text = raw_text
+        self._config = DEFAULT_CONFIG if config is None else config
 
     def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
         return self._base.__getattr__(item)
 
     def _event_code(self):
@@ -462,15 +775,320 @@ class Message(object):
     def _message_code(self):
         return self._base.MSH.msg_type.messa
     def add_segment(self,seg):
-        self._base.child_segments.append(seg)
+        self._base.add_child(seg)
 
     def add_segments(self,segments):
         for seg in segments:
             self.add_segment(seg)
 
+    def clone(self):
+        """
+        An independent copy of the message, e.g. to route it to several places that each
+        change it. The copy's segments start out as lazy views of this message's segment
+        texts, so only the fields that are accessed in the copy are split again.
+        """
+        return _build_message(self.raw_text, _message_template(self), self._config)
+
+    def __reduce__(self):
+        return (_load_message, self._pickle_state())
+
+    def __deepcopy__(self, memo):
+        return self.clone()
+
+    def _pickle_state(self):
+        """
+        (raw text, overrides, None, config), where overrides lists the (segment, field,
+        text) of every field whose text has changed since parsing; or, if segments were
+        added or removed, (None, None, template, config).
+        """
+        raw = self.raw_text
+        if raw:
+            binary = _binary_type is not None and isinstance(raw, _binary_type)
+            lines = _segment_lines(raw, binary, self._config)
+            segments = _line_order(self._base)
+            if len(lines) == len(segments) and\
+               all(line == segment._raw_text for line, segment in zip(lines, segments)):
+                return (raw, _overrides(segments), None, self._config)
+        return (None, None, _message_template(self), self._config)
 
 
-def parse(raw_text,custom_levels = None):
+
+def _line_order(base):
+    """
+    Every segment under base, NTEs included, in the order of the lines they came from.
+    """
+    segments = []
+    stack = [base]
+    while stack:
+        segment = stack.pop()
+        if segment is not base:
+            segments.append(segment)
+        if segment.NTE:
+            segments.extend(segment.NTE._segments)
+        stack.extend(reversed(segment.child_segments))
+    return segments
+
+
+def _overrides(segments):
+    """
+    (segment position, field position, text) of every field that differs from the line
+    the segment was parsed from. The field position is None if the whole segment text is
+    given, because fields were added or removed.
+    """
+    overrides = []
+    for i, segment in enumerate(segments):
+        node = segment.node
+        original = segment._raw_text
+        if node._raw is original:
+            continue
+        text = node._get_as_str()
+        if text == original:
+            continue
+        delim = node._layout.child_delim
+        fields = text.split(delim)
+        old_fields = original.split(delim)
+        if len(fields) != len(old_fields):
+            overrides.append((i, None, text))
+            continue
+        overrides.extend((i, j, field) for j, (field, old) in enumerate(zip(fields, old_fields))
+                         if field != old)
+    return tuple(overrides)
+
+
+def _load_message(raw_text, overrides, template, config):
+    """
+    Unpickle a Message (see Message._pickle_state).
+    """
+    if template is not None:
+        return _build_message('', template, config)
+    message = _parse(raw_text, config, lazy=True)
+    if overrides:
+        segments = _line_order(message._base)
+        edited = {}
+        for i, j, text in overrides:
+            edited.setdefault(i, []).append((j, text))
+        for i, fields in edited.items():
+            segment = segments[i]
+            layout = segment.node._layout
+            if fields[0][0] is None:
+                text = fields[0][1]
+            else:
+                parts = segment._raw_text.split(layout.child_delim)
+                for j, field in fields:
+                    parts[j] = field
+                text = layout.child_delim.join(parts)
+            segment.node = Node.lazy(layout, text)
+    return message
+
+
+def _segment_notes(segment):
+    if not segment.NTE:
+        return ()
+    return tuple((nte.node._layout, nte.node._get_as_str()) for nte in segment.NTE._segments)
+
+
+def _segment_template(segment, template, parent):
+    """
+    Append (code, layout, segment text, parent index, NTE texts) for a segment and its
+    descendants to `template`, in message order, and return it.
+    """
+    i = len(template)
+    template.append((segment.code, segment.node._layout, segment.node._get_as_str(), parent,
+                     _segment_notes(segment)))
+    for child in segment.child_segments:
+        _segment_template(child, template, i)
+    return template
+
+
+def _message_template(message):
+    """
+    Describe a message as a tuple of _segment_template rows. Parent index -1 is the root;
+    the root's own NTE texts, if any, come first with code None.
+    """
+    template = []
+    base = message._base
+    if base.NTE:
+        template.append((None, None, None, -1, _segment_notes(base)))
+    for child in base.child_segments:
+        _segment_template(child, template, -1)
+    return tuple(template)
+
+
+def _build_segments(template, base=None):
+    """
+    Build the segments of a template, with lazy nodes over its texts, and return them.
+    Rows with parent -1 are added to `base`, if given.
+    """
+    segments = []
+    for code, layout, text, parent, notes in template:
+        if code is None:
+            segment = base
+        else:
+            segment = Segment.lazy(code, layout, text)
+            if parent >= 0:
+                segments[parent].add_child(segment)
+            elif base is not None:
+                base.add_child(segment)
+        segments.append(segment)
+        if notes:
+            segment.NTE = NTE()
+            for layout, note in notes:
+                segment.NTE.add_text(Segment.lazy('NTE', layout, note))
+    return segments
+
+
+def _build_message(raw_text, template, config=None):
+    """
+    Build a new Message from a template (see _message_template).
+    """
+    base = Segment('___|NONE')
+    _build_segments(template, base)
+    return Message(base, raw_text, config)
+
+
+def _load_segment(template):
+    return _build_segments(template)[0]
+
+
+#Z-segment policies (see ParserConfig).
+Z_NEST = 'nest'
+Z_TOP = 'top'
+Z_STRICT = 'strict'
+Z_POLICIES = (Z_NEST, Z_TOP, Z_STRICT)
+
+
+class ParserConfig(object):
+    """
+    Immutable set of parse options, checked and precomputed once so that parsing with it
+    costs nothing extra per message. A config can be shared by any number of threads.
+
+    custom_levels   merged over constants.LEVELS into `levels` (see parse()).
+    lazy            default for Parser.parse(lazy=...).
+    spec            the schema.Spec segments are looked up in.
+    remove_vt       strip VT (0x0B) characters, as constants.REMOVE_VT.
+    fall_back_to_lf split on LF if there is no CR, as constants.FALL_BACK_TO_LF.
+    delims          delimiters for segments before the first MSH, as constants.delims.
+    z_segments      where Z-segments go:
+                    'nest'   (default) at level 1; a Z-segment without a level takes the
+                             segments that follow it as children.
+                    'top'    at level 1, and the segments that follow are placed after it.
+                    'strict' like any other segment, by its level.
+
+    The constants module is read when a config is made, so changing it afterwards does
+    not affect existing configs. Invalid options raise ValueError.
+    """
+    __slots__ = ('custom_levels', 'lazy', 'spec', 'remove_vt', 'fall_back_to_lf', 'delims',
+                 'z_segments', 'levels', '_byte_delims')
+
+    def __init__(self, custom_levels=None, lazy=False, spec=DEFAULT_SPEC, remove_vt=None,
+                 fall_back_to_lf=None, delims=None, z_segments=Z_NEST):
+        if remove_vt is None:
+            remove_vt = constants.REMOVE_VT
+        if fall_back_to_lf is None:
+            fall_back_to_lf = constants.FALL_BACK_TO_LF
+        if delims is None:
+            delims = constants.delims
+        delims = tuple(delims)
+        if len(delims) != 5 or len(set(delims)) != 5 or\
+           not all(isinstance(d, str) and len(d) == 1 for d in delims):
+            raise ValueError("delims must be 5 different characters, not %r." % (delims,))
+        if z_segments not in Z_POLICIES:
+            raise ValueError("z_segments must be one of %s, not %r."
+                             % (', '.join(Z_POLICIES), z_segments))
+        if not isinstance(spec, Spec):
+            raise ValueError("spec must be a schema.Spec, not %r." % (spec,))
+        levels = dict(LEVELS)
+        if custom_levels:
+            custom_levels = _FrozenDict(custom_levels)
+            levels.update(custom_levels)
+        else:
+            custom_levels = None
+        for code, level in levels.items():
+            if isinstance(level, bool) or not isinstance(level, int) or level < 0:
+                raise ValueError("Invalid level for code '%s': %r. Value must be a "
+                                 "non-negative int." % (code, level))
+        object.__setattr__(self, 'custom_levels', custom_levels)
+        object.__setattr__(self, 'lazy', bool(lazy))
+        object.__setattr__(self, 'spec', spec)
+        object.__setattr__(self, 'remove_vt', bool(remove_vt))
+        object.__setattr__(self, 'fall_back_to_lf', bool(fall_back_to_lf))
+        object.__setattr__(self, 'delims', delims)
+        object.__setattr__(self, 'z_segments', z_segments)
+        object.__setattr__(self, 'levels', _FrozenDict(levels))
+        object.__setattr__(self, '_byte_delims',
+                           tuple(d.encode('ascii') for d in delims) if _binary_type else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ParserConfig objects are immutable; use replace().")
+
+    def _options(self):
+        return {'custom_levels': dict(self.custom_levels) if self.custom_levels else None,
+                'lazy': self.lazy, 'spec': self.spec, 'remove_vt': self.remove_vt,
+                'fall_back_to_lf': self.fall_back_to_lf, 'delims': self.delims,
+                'z_segments': self.z_segments}
+
+    def replace(self, **changes):
+        """
+        A new config with some options changed.
+        """
+        options = self._options()
+        options.update(changes)
+        return ParserConfig(**options)
+
+    def __repr__(self):
+        return "<ParserConfig %s>" % (', '.join('%s=%r' % item
+                                                for item in sorted(self._options().items())
+                                                if item[0] != 'spec'),)
+
+    def __reduce__(self):
+        #Only the options that differ from the defaults, to keep pickled messages small.
+        defaults = DEFAULT_CONFIG._options()
+        return (_load_config, (dict((name, value) for name, value in self._options().items()
+                                    if value != defaults[name]),))
+
+
+def _load_config(options):
+    if not options:
+        return DEFAULT_CONFIG
+    return ParserConfig(**options)
+
+
+DEFAULT_CONFIG = ParserConfig()
+
+
+class Parser(object):
+    """
+    Parses messages with a fixed ParserConfig, given or built from the keyword options:
+
+        parser = Parser(custom_levels={'OBR': 1, 'OBX': 2}, lazy=True)
+        for raw in feed:
+            message = parser.parse(raw)
+
+    Use one Parser per feed; a Parser has no state besides its config, so it can be used
+    from many threads at once.
+    """
+    __slots__ = ('config',)
+
+    def __init__(self, config=None, **options):
+        if config is None:
+            config = ParserConfig(**options)
+        elif options:
+            config = config.replace(**options)
+        self.config = config
+
+    def __repr__(self):
+        return "<Parser %r>" % (self.config,)
+
+    def parse(self, raw_text, lazy=None):
+        """
+        Same as parse(raw_text) with this parser's options; `lazy` overrides config.lazy.
+        """
+        return _parse(raw_text, self.config, lazy)
+
+    __call__ = parse
+
+
+def parse(raw_text,custom_levels = None, lazy=False, spec=DEFAULT_SPEC):
     """
     Because of the way the HL7 spec is non-hierarchical, parsing a message depends on
     order of lines and an implicit hierarchy in relation to the segment code types. For
@@ -492,83 +1110,319 @@ def parse(raw_text,custom_levels = None):
     3. Pop down the stack and add as sibling or child of a lower-level segment?
     4. Encounter a NTE segment and put it with whatever the most recent segment is.
 
+    Pass lazy=True to defer splitting and type conversion of each segment until one of
+    its fields is accessed (see Segment).
+
+    raw_text may also be bytes (or a bytearray or memoryview), e.g. straight off a socket.
+    Field values are then decoded only when they are read, with the character set named
+    in MSH-18 (constants.CHARSETS), and .hl7 gives bytes back. Character sets whose
+    multibyte characters can contain delimiter bytes (constants.DECODE_FIRST, e.g.
+    Shift JIS, Big5, GB 18030) are the exception: those messages are decoded as a whole
+    first and then parsed like text, with raw_text and .hl7 as text.
+
+    Segments are looked up in `spec`, the standard hl7fields.py segments by default. Pass
+    an overlay (schema.Spec.overlay) for custom Z-segments and site-specific fields.
+
+    parse() checks its options on every call; to parse many messages with the same
+    options, make a Parser once and use Parser.parse.
     """
+    return _parse(raw_text, ParserConfig(custom_levels, lazy, spec))
+
 
+def _parse(raw_text, config, lazy=None):
+    """
+    parse() with a ParserConfig; `lazy` overrides config.lazy unless it is None.
+    """
+    if lazy is None:
+        lazy = config.lazy
+    spec = config.spec
+    profiler = instrument.profiler
+    if profiler is not None:
+        started = instrument.clock()
+
+    if isinstance(raw_text, memoryview):
+        raw_text = raw_text.tobytes()
+    elif isinstance(raw_text, bytearray):
+        raw_text = bytes(raw_text)
+    binary = _binary_type is not None and isinstance(raw_text, _binary_type)
+
+    #Pass 1: clean up the lines and read the segment codes and delimiters.
+    lines = _segment_lines(raw_text, binary, config)
+    if binary:
+        text = _decode_first(raw_text, lines)
+        if text is not None:
+            raw_text, binary = text, False
+            lines = _segment_lines(raw_text, binary, config)
+    codes = []
+    line_delims = []
+    line_encodings = []
+    seg_delims = config._byte_delims if binary else config.delims
+    encoding = None
+    for line in lines:
+        if 'MSH' == (line[0:3].decode('ascii') if binary else line[0:3]):
+            seg_delims = get_delims(line) #Delimiters could be different for every message.
+            if binary:
+                encoding = get_encoding(line, seg_delims)
+        code = _segment_code(line, seg_delims[0])
+        codes.append(code.decode('ascii') if binary else code)
+        line_delims.append(seg_delims)
+        line_encodings.append(encoding)
+
+    #Pass 2: work out where every segment goes in the tree.
+    parents = segment_parents(codes, config.levels, spec, config.z_segments)
+
+    #Pass 3: parse the fields and build the tree.
+    if profiler is not None:
+        built = instrument.clock()
+        profiler.stage('split', built - started)
     base = Segment('___|NONE')
+    segments = []
+    for line, code, parent, seg_delims, encoding in zip(lines, codes, parents, line_delims,
+                                                       line_encodings):
+        if profiler is not None:
+            seg_started = instrument.clock()
+        new_seg = Segment(line, delims=seg_delims, strict=True, lazy=lazy, encoding=encoding,
+                          spec=spec)
+        segments.append(new_seg)
+        parent_seg = base if parent < 0 else segments[parent]
+        if 'NTE' == code:
+            parent_seg.add_to_NTE(new_seg)
+        else:
+            parent_seg.add_child(new_seg)
+        if profiler is not None:
+            profiler.segment(code, instrument.clock() - seg_started)
 
-    last_seg = base #pointer to base; Don't change base directly.
-    last_level = 0
+    if profiler is not None:
+        done = instrument.clock()
+        profiler.stage('build', done - built)
+        profiler.message(_message_type(lines, codes, line_delims, binary), done - started)
+    return Message(base, raw_text, config)
 
 
-    #Some segments may have Line Feed instead of Carriage Return (CR is the standard though)
-    lines = raw_text.split(CR)
+def _segment_code(line, sep):
+    """
+    The code of a segment line: everything before its first field separator.
+    """
+    i = line.find(sep)
+    return line if i < 0 else line[:i]
+
+
+def _message_type(lines, codes, line_delims, binary):
+    """
+    MSH-9 message code and trigger event (e.g. 'ORU^R01') of the first MSH, for profiling.
+    """
+    if 'MSH' not in codes:
+        return ''
+    i = codes.index('MSH')
+    delims = line_delims[i]
+    fields = lines[i].split(delims[0])
+    if len(fields) <= MSH_MSG_TYPE:
+        return ''
+    msg_type = delims[1].join(fields[MSH_MSG_TYPE].split(delims[1])[:2])
+    return msg_type.decode('ascii', 'replace') if binary else msg_type
+
+
+def _segment_lines(raw_text, binary, config):
+    """
+    The non-blank lines of a message, stripped and (if config.remove_vt) without VT
+    characters.
+    """
+    if binary:
+        cr, lf, vt, fs, empty = _BYTES_CR, _BYTES_LF, _BYTES_VT, _BYTES_FS, b''
+    else:
+        cr, lf, vt, fs, empty = CR, LF, VT, FS, ''
 
-    if FALL_BACK_TO_LF and len(lines) == 1:
-        lines = raw_text.split(LF)
+    #Some segments may have Line Feed instead of Carriage Return (CR is the standard though)
+    lines = raw_text.split(cr)
 
-    LEVELS_COPY = LEVELS.copy()#Don't overwite constants.LEVELS if we end up using custom levels.
-    if custom_levels is not None:
-        LEVELS_COPY.update(custom_levels)
+    if config.fall_back_to_lf and len(lines) == 1:
+        lines = raw_text.split(lf)
 
+    lines = [line.strip() for line in lines]
+    if config.remove_vt:
+        lines = [line.replace(vt, empty) for line in lines]
+    return [line for line in lines if line.strip() not in (empty, fs)]
 
-    for line in lines:
-        line = line.strip()
-        if constants.REMOVE_VT:
-            line = line.replace(VT, '')
 
-        if line.strip() in ['', FS]:
+def segment_levels(codes, levels=LEVELS, spec=DEFAULT_SPEC, z_segments=Z_NEST):
+    """
+    Classify segment codes for segment_parents. Returns two lists: the level each segment
+    is placed at, and the level the next segment is compared against (they can differ for
+    Z-segments, see ParserConfig). NTE segments get None.
+    """
+    placed = list(map(levels.get, codes))
+    #Z-segments without a level leave the next comparison at 0, so whatever follows
+    #becomes their child (this is what comparing against None did on Python 2).
+    after = [level or 0 for level in placed]
+    for i, code in enumerate(codes):
+        level = placed[i]
+        if code == 'NTE':
+            placed[i] = after[i] = None
+        elif code.startswith('Z') and z_segments != Z_STRICT:
+            placed[i] = 1
+            if z_segments == Z_TOP:
+                after[i] = 1
+        elif not isinstance(level, int) or not level:
+            if code not in spec:
+                raise Exception("Message code not in specification: '%s'" % (code,))
+            assert level, "Missing level for code '%s'" % (code)
+            assert isinstance(level, int), "Invalid level for code '%s'. "\
+                                           "Value must be an int." % (code)
+    return placed, after
+
+
+def segment_parents(codes, levels=LEVELS, spec=DEFAULT_SPEC, z_segments=Z_NEST):
+    """
+    Because of the way the HL7 spec is non-hierarchical, where a segment belongs depends
+    on the order of the lines and an implicit hierarchy of segment codes, codified in
+    constants.LEVELS. Return the index of the parent of each segment (-1 for the root),
+    going through the codes once. For each line we either
+
+    1. add it as a sibling of the last segment (same level),
+    2. add it as a child of the last segment (higher level),
+    3. walk up the tree from the last segment once per level of difference and add it as
+       a sibling there (lower level), or
+    4. for an NTE, attach it to the most recent other segment; NTEs never change the
+       position in the tree.
+
+    levels maps codes to levels (constants.LEVELS updated with any custom levels); codes
+    missing from both levels and spec are reported as not in the specification.
+    z_segments is one of the ParserConfig Z-segment policies.
+    """
+    placed, after = segment_levels(codes, levels, spec, z_segments)
+    parents = []
+    last = -1           #the root
+    last_level = 0
+    for i in range(len(codes)):
+        level = placed[i]
+        #--Case 4--
+        if level is None:
+            parents.append(last)
             continue
-        if 'MSH' == line[0:3]:
-            delims = get_delims(line) #Delimiters could be different for every message.
+        #--Case 3--
+        if level < last_level:
+            for _ in range(last_level - level):
+                if last < 0:
+                    raise ValueError("Segment %d (%s) has no parent at level %d."
+                                     % (i, codes[i], level))
+                last = parents[last]
+        #--Case 2--
+        if level > last_level:
+            parents.append(last)
+        #--Case 1 (and 3)--
+        else:
+            if last < 0:
+                raise ValueError("Segment %d (%s) has no parent at level %d."
+                                 % (i, codes[i], level))
+            parents.append(parents[last])
+        last = i
+        last_level = after[i]
+    return parents
 
 
-        new_seg = Segment(line, delims=delims)
-        if 'NTE' == line[0:3]:
-            last_seg.add_to_NTE(new_seg)
-            continue #NTE is special case, it should not affect stack/tree traversal ever.
+def get_delims(msh):
+    #MSH lists the encoding characters as component, repetition, escape, subcomponent;
+    #reorder them to match constants.DEFAULT_DELIMS so delims[delim_idx] works. Slices
+    #rather than indexes keep bytes delimiters as bytes on Python 3.
+    delims = [msh[3:4], msh[4:5], msh[7:8], msh[5:6], msh[6:7]]
+    #Make sure that the delimiters are unique.
+    assert len(set(delims)) == len(delims)
+    return delims
 
-        new_level = LEVELS_COPY.get(new_seg.code)
-        if not new_seg.code.startswith('Z'):
-            assert new_level, "Missing level for code '%s'" % (new_seg.code)
-            assert isinstance(new_level, int), "Invalid level for code '%s'. "\
-                                               "Value must be an int." % (new_seg.code)
-        else:
-            new_level = 1
 
-        #--Case 3--
-        #Children are going home to live with ancestors. Set last_seg to the parent of the
-        #parent of the pare...[ad nauseum] -  Do this 'level_difference' times. This is akin
-        # to popping off of a stack but we don't actually want to pop things.
-        if new_level < last_level:
+#Positions of MSH-9 (message type) and MSH-18 (character set), as numbered in hl7fields.py.
+MSH_MSG_TYPE = 8
+MSH_CHARSET = 17
 
-            level_difference = last_level - new_level
-            for i in range(0, level_difference):
-                last_seg = last_seg.parent_seg
 
-            last_seg.parent_seg.add_child(new_seg)
-            last_seg = new_seg
-            last_level = LEVELS_COPY.get(new_seg.code)
+def _decode_first(raw_text, lines):
+    """
+    raw_text decoded as a whole if the first MSH of these bytes lines names a character
+    set in constants.DECODE_FIRST, otherwise None. CR and LF never occur inside the
+    characters of those sets, so the lines can be split before decoding.
+    """
+    for line in lines:
+        if line[0:3] == b'MSH':
+            encoding = get_encoding(line, get_delims(line))
+            if codecs.lookup(encoding).name in DECODE_FIRST:
+                return raw_text.decode(encoding, 'replace')
+            return None
+    return None
 
-        #--Case 2--
-        #New first child, need to increase our level indicator so that we know whether to
-        # add a sibling or a child on the next line. This is akin to a push operation
-        elif new_level > last_level:
-            last_seg.add_child(new_seg)
-            last_seg = new_seg
-            last_level = LEVELS_COPY.get(last_seg.code)
 
-        #--Case 1--
-        #New sibling of last node, let the parent node know. This is analagous to an append.
-        elif new_level == last_level:
-            last_seg.parent_seg.add_child(new_seg)
-            last_seg = new_seg
-            last_level = LEVELS_COPY.get(last_seg.code)
+def decode_message(raw_text):
+    """
+    The text of a message given as bytes (or a bytearray or memoryview), decoded as a
+    whole with the character set in MSH-18 of its first MSH segment (see get_encoding).
+    Text is returned unchanged. For code that reads raw messages without parse().
+    """
+    if isinstance(raw_text, memoryview):
+        raw_text = raw_text.tobytes()
+    elif isinstance(raw_text, bytearray):
+        raw_text = bytes(raw_text)
+    if _binary_type is None or not isinstance(raw_text, _binary_type):
+        return raw_text
+    return raw_text.decode(get_message_encoding(raw_text), 'replace')
 
-    return Message(base,raw_text)
 
+def encode_message(text, encoding=None):
+    """
+    The bytes of a message given as text, encoded with the character set in MSH-18 of its
+    first MSH segment, or with `encoding` (constants.DEFAULT_ENCODING if None) when MSH-18
+    is empty. Bytes are returned unchanged. The counterpart of decode_message().
+    """
+    if isinstance(text, bytes):
+        return text
+    return text.encode(get_message_encoding(text, None) or encoding or DEFAULT_ENCODING)
 
-def get_delims(msh):
-    delims = [msh[3], msh[4], msh[5], msh[6], msh[7]]
-    #Make sure that the delimiters are unique.
-    assert len(set(delims)) == len(delims)
-    return delims
+
+def get_message_encoding(raw_text, default=DEFAULT_ENCODING):
+    """
+    Python codec for the character set in MSH-18 of the first MSH segment of a message
+    (text or bytes), or `default` if it has no MSH segment or MSH-18 is empty.
+    """
+    binary = isinstance(raw_text, bytes)
+    start = raw_text.find(b'MSH' if binary else u'MSH')
+    if start < 0 or len(raw_text) < start + 8:
+        return default
+    end = len(raw_text)
+    for sep in ((_BYTES_CR, _BYTES_LF) if binary else (CR, LF)):
+        i = raw_text.find(sep, start)
+        if 0 <= i < end:
+            end = i
+    header = raw_text[start:end]
+    if not binary:
+        #Only the ASCII delimiters and MSH-18 are looked at.
+        header = header.encode('ascii', 'replace')
+    return get_encoding(header, get_delims(header), default)
+
+
+_ASCII_PROBE = u'MSH|^~\\&'
+
+
+def get_encoding(msh, delims, default=DEFAULT_ENCODING):
+    """
+    Python codec for the character set in MSH-18 of a bytes MSH segment (the first one,
+    if it repeats). Falls back to `default` when MSH-18 is empty or names an unknown
+    character set. Raises ValueError for codecs that don't encode ASCII as ASCII (e.g.
+    UTF-16), since the segments of such a message could not have been found in the first
+    place.
+    """
+    fields = msh.split(delims[0])
+    if len(fields) <= MSH_CHARSET:
+        return default
+    charset = fields[MSH_CHARSET].split(delims[3])[0].decode('ascii', 'replace').strip()
+    if not charset:
+        return default
+    encoding = CHARSETS.get(charset.upper())
+    if encoding is None:
+        try:
+            encoding = codecs.lookup(charset).name
+        except LookupError:
+            encoding = default
+    if encoding is None:
+        return None
+    if _ASCII_PROBE.encode(encoding) != _ASCII_PROBE.encode('ascii'):
+        raise ValueError("Unsupported character set in MSH-18: '%s'. Only character sets "
+                         "that encode ASCII as ASCII can be parsed." % (charset,))
+    return encoding
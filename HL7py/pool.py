@@ -0,0 +1,153 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Parsing many messages on several cores. parse_many() hands chunks of raw messages to a
+pool of worker processes; each worker parses its chunk and sends back a compact result
+per message (see message_data), so the parsed object trees never have to cross the
+process boundary.
+"""
+import collections
+import multiprocessing
+from HL7py.batch import iter_raw_messages, string_types
+from HL7py.schema import DEFAULT_SPEC
+from HL7py.parser import Parser, _line_order
+
+try:
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+except ImportError:
+    ProcessPoolExecutor = None
+
+#Messages sent to a worker at a time. Larger chunks mean less pickling overhead, smaller
+#chunks balance better when message sizes vary a lot.
+CHUNK_SIZE = 64
+
+#Chunks queued per worker, so a long input is never read into memory all at once.
+CHUNKS_PER_WORKER = 2
+
+
+def message_data(message):
+    """
+    Return a message as a list of (segment code, segment data) pairs in the order of its
+    lines, NTE segments included. This is the default result of parse_many: plain lists,
+    dicts and strings pickle far faster than the Node tree they come from.
+    """
+    return [(segment.code, segment.data) for segment in _line_order(message._base)]
+
+
+#The additional_fields a worker last saw and the Spec overlay made from them, so chunks
+#with the same fields share compiled layouts.
+_worker_spec = (None, DEFAULT_SPEC)
+
+
+def _spec_for(additional_fields):
+    global _worker_spec
+    fields, spec = _worker_spec
+    if additional_fields != fields:
+        spec = DEFAULT_SPEC.overlay(additional_fields) if additional_fields else DEFAULT_SPEC
+        _worker_spec = (additional_fields, spec)
+    return spec
+
+
+def _parse_chunk(raws, custom_levels, additional_fields, transform):
+    """
+    Worker side of parse_many: parse every message in a chunk and transform it.
+    """
+    spec = _spec_for(additional_fields)
+    parser = Parser(custom_levels=custom_levels, spec=spec)
+    return [transform(parser.parse(raw)) for raw in raws]
+
+
+def _chunks(source, chunk_size):
+    chunk = []
+    for raw in source:
+        chunk.append(raw)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_many(source, workers=None, chunk_size=CHUNK_SIZE, custom_levels=None,
+               additional_fields=None, ordered=True, transform=message_data):
+    """
+    Parse every message in `source` using a pool of `workers` processes (one per core by
+    default) and yield transform(message) for each. `source` is either an iterable of raw
+    messages or a path/file-like object, which is split on message boundaries with
+    batch.iter_raw_messages.
+
+    `transform` runs in the worker, so it must be a module-level function; it defaults to
+    message_data. Results come back in input order unless `ordered` is False, in which
+    case each chunk is yielded as soon as it is done. `custom_levels` and
+    `additional_fields` work as they do for parse and MultiMessage.
+
+    workers=1 parses in this process without starting a pool. A pool needs
+    concurrent.futures (Python 3, or the futures backport on Python 2).
+    """
+    if isinstance(source, string_types) or hasattr(source, 'read'):
+        source = iter_raw_messages(source)
+    chunks = _chunks(source, chunk_size)
+
+    if workers == 1:
+        for chunk in chunks:
+            for result in _parse_chunk(chunk, custom_levels, additional_fields, transform):
+                yield result
+        return
+
+    if ProcessPoolExecutor is None:
+        raise RuntimeError("parse_many needs concurrent.futures to use more than one worker.")
+    workers = workers or multiprocessing.cpu_count()
+    pool = ProcessPoolExecutor(workers)
+    pending = collections.deque()
+    try:
+        max_pending = workers * CHUNKS_PER_WORKER
+        for chunk in chunks:
+            pending.append(pool.submit(_parse_chunk, chunk, custom_levels,
+                                       additional_fields, transform))
+            while len(pending) >= max_pending:
+                for result in _finished(pending, ordered):
+                    yield result
+        while pending:
+            for result in _finished(pending, ordered):
+                yield result
+    finally:
+        #Also runs when the caller stops iterating early. Waiting for the pool to shut
+        #down keeps its management thread from outliving the pipes it reads from.
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def _finished(pending, ordered):
+    """
+    Wait for the next chunk to finish (the oldest one if `ordered`), remove it from
+    `pending` and return its results.
+    """
+    if ordered:
+        return pending.popleft().result()
+    done = wait(pending, return_when=FIRST_COMPLETED)[0]
+    future = done.pop()
+    pending.remove(future)
+    return future.result()
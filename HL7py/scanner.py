@@ -0,0 +1,263 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+"""
+Offset index over a raw message buffer. scan() tokenizes the message once and records the
+(start, end) offsets of every segment, field, component and subcomponent in flat integer
+arrays; no substrings are kept and none are created until a value is asked for. Works
+over str, bytes, bytearray and (on Python 3) memoryview input. For bytes-like buffers,
+view() returns a value as a memoryview slice without copying it.
+
+Positions follow hl7fields.py: field 0 is the segment code, and in MSH field 1 is the
+encoding characters.
+"""
+import bisect
+import operator
+import re
+from array import array
+from itertools import compress, count, repeat
+from HL7py.constants import DEFAULT_DELIMS
+
+try:
+    from itertools import imap as map
+except ImportError:
+    pass
+
+#Segments whose first field holds the encoding characters and must not be split.
+HEADER_CODES = ('MSH', 'FHS', 'BHS')
+#Characters that end a segment. VT and FS are MLLP framing left in the buffer.
+SEGMENT_SEPS = '\r\n\x0b\x1c'
+
+
+class MessageIndex(object):
+    """
+    Result of scan(). `segments`, `fields` and `components` are flat arrays of
+    (start, end, first child, stop child) records, where the children are records of the
+    next table down; `subcomponents` holds (start, end) pairs. `codes` has the segment
+    code of each segment.
+    """
+    __slots__ = ('buf', 'delims', 'codes', 'segments', 'fields', 'components',
+                 'subcomponents')
+
+    def __init__(self, buf, delims, codes, segments, fields, components, subcomponents):
+        self.buf = buf
+        self.delims = delims
+        self.codes = codes
+        self.segments = segments
+        self.fields = fields
+        self.components = components
+        self.subcomponents = subcomponents
+
+    def __len__(self):
+        return len(self.codes)
+
+    def find(self, code):
+        """
+        Return the indexes of the segments with the given code, in order.
+        """
+        return [i for i, c in enumerate(self.codes) if c == code]
+
+    def field_count(self, seg):
+        return self.segments[4 * seg + 3] - self.segments[4 * seg + 2]
+
+    def span(self, seg, field=None, comp=None, sub=None):
+        """
+        Return the (start, end) offsets of a segment, field, component or subcomponent,
+        or None if the message does not have it.
+        """
+        if not 0 <= seg < len(self.codes):
+            return None
+        table, i = self.segments, seg
+        for child_table, n in ((self.fields, field), (self.components, comp),
+                               (self.subcomponents, sub)):
+            if n is None:
+                break
+            first = table[4 * i + 2]
+            if not 0 <= n < table[4 * i + 3] - first:
+                return None
+            table, i = child_table, first + n
+        width = 2 if table is self.subcomponents else 4
+        return table[width * i], table[width * i + 1]
+
+    def value(self, seg, field=None, comp=None, sub=None):
+        """
+        Return the text of a segment, field, component or subcomponent (empty if the
+        message does not have it) in the type of the scanned buffer. Values from a
+        memoryview are returned as bytes.
+        """
+        span = self.span(seg, field, comp, sub)
+        if span is None:
+            value = self.buf[:0]
+        else:
+            value = self.buf[span[0]:span[1]]
+        if isinstance(value, memoryview):
+            return value.tobytes()
+        return value
+
+    def view(self, seg, field=None, comp=None, sub=None):
+        """
+        Like value(), but as a memoryview over the scanned bytes-like buffer, so nothing
+        is copied.
+        """
+        span = self.span(seg, field, comp, sub) or (0, 0)
+        return memoryview(self.buf)[span[0]:span[1]]
+
+
+def _as_text(value):
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    if isinstance(value, str):
+        return value
+    return value.decode('latin-1')
+
+
+def find_delims(buf, default=DEFAULT_DELIMS):
+    """
+    Read the delimiters of the first MSH segment in `buf`, in DEFAULT_DELIMS order.
+    """
+    msh = 'MSH' if isinstance(buf, str) else b'MSH'
+    match = re.search(msh, buf)
+    if match is None or len(buf) < match.start() + 8:
+        return default
+    header = _as_text(buf[match.start():match.start() + 8])
+    return [header[3], header[4], header[7], header[5], header[6]]
+
+
+_patterns = {}
+
+
+def _patterns_for(delims, binary):
+    key = (tuple(delims[:3]), binary)
+    patterns = _patterns.get(key)
+    if patterns is None:
+        field_sep, comp_sep, sub_sep = delims[:3]
+        boundary = '[%s]' % (re.escape(SEGMENT_SEPS + field_sep + comp_sep + sub_sep),)
+        #Group 1 is MSH-2 of each header segment.
+        header = '(?:^|[%s])(?:%s)%s([^%s]*)' % (
+            re.escape(SEGMENT_SEPS), '|'.join(HEADER_CODES), re.escape(field_sep),
+            re.escape(SEGMENT_SEPS + field_sep))
+        chars = lambda s: set(s)
+        if binary:
+            boundary = boundary.encode('latin-1')
+            header = header.encode('latin-1')
+            chars = lambda s: set(s[i:i + 1].encode('latin-1') for i in range(len(s)))
+        segment_kinds = frozenset(chars(SEGMENT_SEPS))
+        field_kinds = segment_kinds | chars(field_sep)
+        comp_kinds = field_kinds | chars(comp_sep)
+        patterns = _patterns[key] = (re.compile(boundary), re.compile(header),
+                                     segment_kinds, field_kinds, comp_kinds)
+    return patterns
+
+
+_match_end = operator.methodcaller('end')
+
+
+def _records(*columns):
+    #Interleave the columns with slice assignment, which stays in C.
+    width = len(columns)
+    flat = [0] * (width * len(columns[0]))
+    for i, column in enumerate(columns):
+        flat[i::width] = column
+    return array('l', flat)
+
+
+def scan(buf, delims=None):
+    """
+    Build a MessageIndex for one message (or several, e.g. a batch) held in `buf`.
+    Segments may end with CR or LF. Delimiters are read from the first MSH segment
+    unless given, in constants.DEFAULT_DELIMS order.
+
+    The buffer is tokenized by the re module in C, and each table is derived from the
+    boundary offsets with C-level iterators, so there is no Python-level loop over
+    fields and no piece of the buffer is copied.
+    """
+    if isinstance(buf, (memoryview, bytearray)) and not hasattr(re, 'fullmatch'):
+        #Python 2's re module cannot search a memoryview, and returns bytearray matches.
+        buf = bytes(buf)
+    if delims is None:
+        delims = find_delims(buf)
+    boundary, header, segment_kinds, field_kinds, comp_kinds = \
+        _patterns_for(delims, not isinstance(buf, str))
+
+    #Single characters are cached by Python, so findall() doesn't copy the buffer either.
+    kinds = boundary.findall(buf)
+    #after[i] is the offset just past boundary i; the last entry is len(buf) + 1.
+    after = list(map(_match_end, boundary.finditer(buf)))
+    after.append(len(buf) + 1)
+
+    #Component and subcomponent separators inside MSH-2 are the encoding characters.
+    keep = None
+    for match in header.finditer(buf):
+        if keep is None:
+            keep = [True] * len(kinds)
+        lo = bisect.bisect_left(after, match.start(1) + 1)
+        hi = bisect.bisect_right(after, match.end(1))
+        keep[lo:hi] = [False] * (hi - lo)
+    if keep is not None:
+        kinds = list(compress(kinds, keep))
+        after = list(compress(after, keep + [True]))
+
+    #Every piece between two boundaries is a subcomponent.
+    sub_starts = [0] + after[:-1]
+    sub_ends = list(map(operator.sub, after, repeat(1)))
+    subcomponents = _records(sub_starts, sub_ends)
+
+    #A component ends at each boundary that is not a subcomponent separator, and so on.
+    comp_last = list(compress(count(), map(comp_kinds.__contains__, kinds)))
+    comp_last.append(len(kinds))
+    comp_first = [0] + list(map(operator.add, comp_last[:-1], repeat(1)))
+    comp_starts = list(map(sub_starts.__getitem__, comp_first))
+    comp_ends = list(map(sub_ends.__getitem__, comp_last))
+    components = _records(comp_starts, comp_ends, comp_first,
+                          list(map(operator.add, comp_last, repeat(1))))
+
+    comp_kind = list(map(kinds.__getitem__, comp_last[:-1]))
+    field_last = list(compress(count(), map(field_kinds.__contains__, comp_kind)))
+    field_last.append(len(comp_last) - 1)
+    field_first = [0] + list(map(operator.add, field_last[:-1], repeat(1)))
+    field_starts = list(map(comp_starts.__getitem__, field_first))
+    field_ends = list(map(comp_ends.__getitem__, field_last))
+    fields = _records(field_starts, field_ends, field_first,
+                      list(map(operator.add, field_last, repeat(1))))
+
+    field_kind = list(map(comp_kind.__getitem__, field_last[:-1]))
+    seg_last = list(compress(count(), map(segment_kinds.__contains__, field_kind)))
+    seg_last.append(len(field_last) - 1)
+    seg_first = [0] + list(map(operator.add, seg_last[:-1], repeat(1)))
+    seg_starts = list(map(field_starts.__getitem__, seg_first))
+    seg_ends = list(map(field_ends.__getitem__, seg_last))
+
+    #Blank lines and framing characters leave empty segments behind; drop them. Their
+    #(empty) fields stay in the lower tables but are not reachable.
+    nonblank = list(map(operator.lt, seg_starts, seg_ends))
+    if not all(nonblank):
+        seg_starts, seg_ends, seg_first, seg_last = [
+            list(compress(column, nonblank))
+            for column in (seg_starts, seg_ends, seg_first, seg_last)]
+    segments = _records(seg_starts, seg_ends, seg_first,
+                        list(map(operator.add, seg_last, repeat(1))))
+    codes = [_as_text(buf[start:min(start + 3, end)])
+             for start, end in zip(seg_starts, seg_ends)]
+
+    return MessageIndex(buf, delims, codes, segments, fields, components, subcomponents)
@@ -0,0 +1,279 @@
+"""
+The MIT License
+
+Copyright (c) 2016 Ankhos Clinical Oncology Software
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+import collections
+import itertools
+import os
+import threading
+import weakref
+from HL7py.constants import DEFAULT_DELIMS
+from HL7py.hl7fields import hl7fields as hl7fieldspec
+from HL7py.intern import _move_to_end
+
+
+class _FrozenDict(dict):
+    """
+    A dict that can't be changed after it is built, for spec entries and Layout indexes.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Spec entries and layouts are immutable; use Spec.overlay().")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (_FrozenDict, (dict(self),))
+
+
+class Layout(object):
+    """
+    Compiled, read-only description of one node in a segment's field tree.
+
+    A Layout is built once from an entry of the hl7fields.py specification and then
+    shared by every Node created for that segment code. Children are stored by position
+    in a tuple and `index`, a read-only dict, maps the python-ized field name to that
+    position, so building or walking a Node tree never has to look at the nested spec
+    dictionaries again.
+
+    Layouts for messages parsed from bytes have bytes delimiters and the `encoding` their
+    values are decoded with; text layouts have no encoding.
+    """
+    __slots__ = ('code', 'data_type', 'delim_idx', 'child_delim', 'children', 'index',
+                 'encoding')
+
+    def __init__(self, code, data_type, delim_idx, child_delim, children, encoding=None):
+        index = {}
+        for i, child in enumerate(children):
+            assert not child.code.startswith('_'), "Node names must not start with underscores."
+            # Later fields win on duplicate names, same as repeated setattr() did.
+            index[child.code] = i
+        object.__setattr__(self, 'code', code)
+        object.__setattr__(self, 'data_type', data_type)
+        object.__setattr__(self, 'delim_idx', delim_idx)
+        object.__setattr__(self, 'child_delim', child_delim)
+        object.__setattr__(self, 'children', tuple(children))
+        object.__setattr__(self, 'index', _FrozenDict(index))
+        object.__setattr__(self, 'encoding', encoding)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Layout objects are immutable.")
+
+    def __repr__(self):
+        return "<Layout %s>" % (self.code,)
+
+    def __reduce__(self):
+        return (Layout, (self.code, self.data_type, self.delim_idx, self.child_delim,
+                         self.children, self.encoding))
+
+    def position(self, name):
+        """
+        Return the position of the child field called `name`, or None.
+        """
+        return self.index.get(name)
+
+
+def compile_layout(code='', data_type='string', subfields=(), delims=DEFAULT_DELIMS,
+                   delim_idx=0, encoding=None):
+    """
+    Turn one (possibly nested) spec dictionary into a Layout. The arguments mirror the
+    keys of the hl7fields.py dictionaries so a spec entry can be passed with **entry.
+    The spec dictionaries themselves are never modified.
+    """
+    children = [compile_layout(delims=delims, delim_idx=delim_idx + 1, encoding=encoding,
+                               **sf_dict)
+                for sf_dict in subfields]
+    return Layout(code, data_type, delim_idx, delims[delim_idx], children, encoding)
+
+
+#Layouts compiled by get_layout() for plain spec dictionaries, least recently used first.
+#Delimiters and encodings come from the messages, so the cache must not grow without bound.
+LAYOUT_CACHE_SIZE = 1024
+_layout_cache = collections.OrderedDict()
+_layout_lock = threading.Lock()
+
+
+def _freeze(value):
+    """
+    Read-only copy of a (nested) spec entry: dicts become _FrozenDicts, lists tuples.
+    """
+    if isinstance(value, dict):
+        return _FrozenDict((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+_versions = itertools.count(1)
+
+#Specs alive in this process by version, and Specs unpickled from other processes by
+#(origin, version), so a Spec that is pickled many times is rebuilt only once for as long
+#as anything still uses it.
+_live = weakref.WeakValueDictionary()
+_received = weakref.WeakValueDictionary()
+_ORIGIN = '%d-%s' % (os.getpid(), ''.join('%02x' % (c,) for c in bytearray(os.urandom(8))))
+
+
+class Spec(object):
+    """
+    An immutable set of segment definitions in the hl7fields.py format, with its own
+    cache of compiled Layouts.
+
+    Site-specific segments and fields are added with overlay(), which returns a new Spec
+    and leaves this one alone, so parsers using different overlays can run side by side
+    in one process without locks:
+
+        site = DEFAULT_SPEC.overlay({'ZPS': {'code': 'ZPS', 'subfields': [...]}})
+        parse(raw, spec=site)
+
+    Every Spec gets a new `version` number; `base` is the Spec it was overlaid on.
+    Entries are copied when the Spec is made, so later changes to the dictionaries
+    passed in are not seen. A pickled Spec only carries its differences from
+    DEFAULT_SPEC, and unpickles to the same Spec object for as long as that exists.
+    """
+    __slots__ = ('_entries', '_layouts', 'version', 'base', 'name', '__weakref__')
+
+    def __init__(self, entries=None, name='', base=None):
+        frozen = dict(base._entries) if base is not None else {}
+        for code, entry in (entries or {}).items():
+            frozen[code] = _freeze(entry)
+        self._entries = frozen
+        self._layouts = {}
+        self.version = next(_versions)
+        self.base = base
+        self.name = name
+        _live[self.version] = self
+
+    def overlay(self, entries, name=''):
+        """
+        Return a new Spec with `entries` (code -> segment definition) added to, or
+        replacing, the ones in this Spec.
+        """
+        return Spec(entries, name, self)
+
+    def layout(self, code, delims=DEFAULT_DELIMS, encoding=None):
+        """
+        Compiled Layout for a segment code and delimiter set, or None if the code is not
+        in this Spec. Layouts are compiled once per Spec and reused.
+        """
+        key = (code, tuple(delims), encoding)
+        layout = self._layouts.get(key)
+        if layout is None:
+            entry = self._entries.get(code)
+            if entry is None:
+                return None
+            layout = self._layouts[key] = compile_layout(delims=delims, encoding=encoding,
+                                                         **entry)
+        return layout
+
+    def get(self, code, default=None):
+        return self._entries.get(code, default)
+
+    def __getitem__(self, code):
+        return self._entries[code]
+
+    def __contains__(self, code):
+        return code in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def items(self):
+        return self._entries.items()
+
+    def __repr__(self):
+        return "<Spec %s v%d (%d segments)>" % (self.name or 'overlay', self.version,
+                                                 len(self._entries))
+
+    def __reduce__(self):
+        if self is DEFAULT_SPEC:
+            return (_default_spec, ())
+        default = DEFAULT_SPEC._entries
+        changed = dict((code, entry) for code, entry in self._entries.items()
+                       if default.get(code) is not entry)
+        removed = tuple(code for code in default if code not in self._entries)
+        return (_load_spec, (_ORIGIN, self.version, changed, removed, self.name))
+
+
+def _default_spec():
+    return DEFAULT_SPEC
+
+
+def _load_spec(origin, version, changed, removed, name):
+    """
+    Unpickle a Spec: the original if it is still alive in this process, one already
+    rebuilt from the same origin, or else DEFAULT_SPEC overlaid with its differences.
+    """
+    if origin == _ORIGIN:
+        spec = _live.get(version)
+    else:
+        spec = _received.get((origin, version))
+    if spec is None:
+        spec = DEFAULT_SPEC.overlay(changed, name)
+        for code in removed:
+            del spec._entries[code]
+        if origin != _ORIGIN:
+            _received[(origin, version)] = spec
+    return spec
+
+
+#The standard segments of hl7fields.py, as loaded at import. Parsers use this unless they
+#are given a Spec of their own.
+DEFAULT_SPEC = Spec(hl7fieldspec, name='hl7fields')
+
+
+def get_layout(code, delims=DEFAULT_DELIMS, spec=None, encoding=None):
+    """
+    Return the compiled Layout for a segment code and delimiter set, compiling it on
+    first use. Returns None if the code is not in the specification. Pass bytes
+    delimiters and an `encoding` for messages parsed from bytes.
+
+    spec is a Spec, whose own cache is used, or a plain dictionary in the hl7fields.py
+    format. For dictionaries the cache remembers which entry it compiled from, so
+    replacing an entry recompiles it on the next lookup. The default is DEFAULT_SPEC.
+    """
+    if spec is None:
+        spec = DEFAULT_SPEC
+    if isinstance(spec, Spec):
+        return spec.layout(code, delims, encoding)
+    seg_spec = spec.get(code)
+    key = (code, tuple(delims), encoding)
+    with _layout_lock:
+        cached = _layout_cache.get(key)
+        if cached is not None and cached[0] is seg_spec:
+            _move_to_end(_layout_cache, key, cached)
+            return cached[1]
+    if seg_spec is None:
+        return None
+    layout = compile_layout(delims=delims, encoding=encoding, **seg_spec)
+    with _layout_lock:
+        _layout_cache.pop(key, None)
+        _layout_cache[key] = (seg_spec, layout)
+        while len(_layout_cache) > LAYOUT_CACHE_SIZE:
+            _layout_cache.popitem(last=False)
+    return layout
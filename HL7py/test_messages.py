@@ -3,7 +3,7 @@ The real newline and carriage return characters in these strings will be replace
 reverse_rep_ch.  Keep in mind that messages in this format are for DEBUG PURPOSES ONLY.
 """
 DATA = '''
-MSH|^~\&|1100|BN|OPTX|BN002234|201210180743||ORU^R01|0417|P|2.3<CR>
+MSH|^~\\&|1100|BN|OPTX|BN002234|201210180743||ORU^R01|0417|P|2.3<CR>
 PID|1|123456789|112233|1234567|Test^Patient||19820620|F|||123 Fake St.^^Raleigh^NC^27607-||(123)456-7890||||||<CR>
 ORC|RE|29117637990^LAB|291176379902012^LAB||||||201210170000|||1366445686^Doctor^M^^^^^N<CR>
 OBR|1|29117637990^LAB|291176379902012^LAB|001321^Iron and TIBC^L|||201210171632|||||||201210171934||||M542856833||29117637990||201210180743|||F<CR>